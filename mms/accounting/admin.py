@@ -1,11 +1,43 @@
 from django.contrib import admin
 
-from .models import LedgerAccount, LedgerEntry, PaymentMethod
+from .models import LedgerAccount, LedgerEntry, PaymentMethod, \
+    BalanceSnapshot, balance_annotations
+from .pagination import LargeTablePaginator
 
-admin.site.register(LedgerEntry)
 admin.site.register(PaymentMethod)
 
 
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    # __str__ names both accounts, which may name their member
+    list_select_related = ('debit_account__member', 'credit_account__member')
+    # Matches an index, so pages need not sort the table
+    ordering = ('-effective_date', '-created_date', '-id')
+    paginator = LargeTablePaginator
+    show_full_result_count = False
+
+
+@admin.register(BalanceSnapshot)
+class BalanceSnapshotAdmin(admin.ModelAdmin):
+    list_display = ('account', 'period_end', 'debits', 'credits', 'balance')
+    list_filter = ('period_end',)
+    list_select_related = ('account__member',)
+
+
 @admin.register(LedgerAccount)
 class LedgerAccountAdmin(admin.ModelAdmin):
     list_display = ('__str__', 'balance', 'account_type', 'account_balance')
+
+    def get_queryset(self, request):
+        qs = super(LedgerAccountAdmin, self).get_queryset(request)
+        # __str__ follows the reverse member relation
+        qs = qs.select_related('member')
+        return qs.annotate(**balance_annotations())
+
+    def balance(self, obj):
+        return obj.annotated_balance
+    balance.admin_order_field = 'annotated_balance'
+
+    def account_balance(self, obj):
+        return obj.annotated_account_balance
+    account_balance.admin_order_field = 'annotated_account_balance'
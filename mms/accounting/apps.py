@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class AccountingConfig(AppConfig):
+    name = 'accounting'
+
+    def ready(self):
+        # Connects the balance cache's signal handlers
+        from . import cache  # NOQA
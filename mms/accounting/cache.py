@@ -0,0 +1,178 @@
+"""Caching of account balances in a Django cache.
+
+Balances are read far more often than entries are posted, so the stored
+totals of each :py:class:`LedgerAccount` can be kept in a shared cache.
+Entries are keyed by account and a per-account version number, and the
+version is bumped on :py:data:`accounting.signals.totals_changed`, which
+every posting, edit, deletion, bulk posting and rebuild sends for both
+sides.  Stale entries are never deleted, just no longer looked up, and
+expire after :py:data:`BALANCE_CACHE_TTL`.
+
+A version is read before the totals it is cached with, so a reader racing
+with a posting can only store its totals under the version the posting
+replaces.  Django 1.8 has no on-commit hook, though, so a reader that sees
+totals from before a posting commits may cache them under the new version;
+the TTL bounds how long such a value lives.
+
+Settings:
+
+``ACCOUNTING_BALANCE_CACHE``
+    Alias in ``CACHES`` of the cache to use.  Defaults to None, which
+    disables caching: every lookup reads the database and counts as a
+    miss.
+``ACCOUNTING_BALANCE_CACHE_TTL``
+    Seconds a cached balance is kept.  Defaults to 300.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.dispatch import receiver
+
+from collections import namedtuple
+import random
+import threading
+
+from .models import LedgerAccount
+from .signals import totals_changed
+
+BALANCE_CACHE = getattr(settings, "ACCOUNTING_BALANCE_CACHE", None)
+BALANCE_CACHE_TTL = getattr(settings, "ACCOUNTING_BALANCE_CACHE_TTL", 300)
+
+
+class CachedBalance(namedtuple('CachedBalance',
+                               ['account_type', 'debits', 'credits'])):
+    """Stored totals of one :py:class:`LedgerAccount`."""
+    __slots__ = ()
+
+    def _get_balance(self):
+        """Debits minus credits, like :py:attr:`LedgerAccount.balance`."""
+        return self.debits - self.credits
+    balance = property(_get_balance)
+
+    def _get_account_balance(self):
+        """Normal-sign balance, like
+        :py:attr:`LedgerAccount.account_balance`."""
+        if self.account_type < 0:
+            return self.balance
+        else:
+            return -self.balance
+    account_balance = property(_get_account_balance)
+
+
+class BalanceCache(object):
+    """Versioned cache of :py:class:`CachedBalance` by account primary key.
+
+    :param alias: alias of the Django cache to use, or None to disable
+        caching.
+    :param ttl: seconds a balance is kept.
+    :param prefix: prefix of the cache keys.
+    """
+    def __init__(self, alias=BALANCE_CACHE, ttl=BALANCE_CACHE_TTL,
+                 prefix='mms:balance'):
+        self.alias = alias
+        self.ttl = ttl
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        #: Balances answered by the cache.
+        self.hits = 0
+        #: Balances read from the database.
+        self.misses = 0
+        #: Version bumps.
+        self.invalidations = 0
+
+    def _get_stats(self):
+        """Hit, miss and invalidation counters as a dict."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'invalidations': self.invalidations}
+    stats = property(_get_stats)
+
+    def _get_cache(self):
+        return caches[self.alias] if self.alias is not None else None
+    cache = property(_get_cache)
+
+    def _version_key(self, pk):
+        return '%s:v:%d' % (self.prefix, pk)
+
+    def _versions(self, cache, pks):
+        keys = dict((self._version_key(pk), pk) for pk in pks)
+        versions = dict((keys[k], v)
+                        for k, v in cache.get_many(list(keys)).items())
+        missing = [pk for pk in pks if pk not in versions]
+        if missing:
+            # Evicted or never set.  Start from a random number rather than
+            # zero, so that balances cached under an evicted version do not
+            # match again.  Another process may add one first, so read them
+            # all back at once.
+            for pk in missing:
+                cache.add(self._version_key(pk), random.getrandbits(62), None)
+            added = cache.get_many([self._version_key(pk) for pk in missing])
+            for pk in missing:
+                versions[pk] = added.get(self._version_key(pk))
+        return versions
+
+    def get_many(self, pks):
+        """Returns a dict mapping each of the account primary keys *pks*
+        to its :py:class:`CachedBalance`, with one cache round trip for the
+        versions, one for the balances and one query for any misses.
+        Versions that are missing from the cache take one ``add`` each and
+        one more read.  Unknown accounts are absent."""
+        pks = list(set(pks))
+        cache = self.cache
+        found = {}
+        keys = {}
+        if cache is not None and pks:
+            versions = self._versions(cache, pks)
+            keys = dict((pk, '%s:%d:%s' % (self.prefix, pk, versions[pk]))
+                        for pk in pks)
+            cached = cache.get_many(list(keys.values()))
+            for pk, key in keys.items():
+                if key in cached:
+                    found[pk] = CachedBalance(*cached[key])
+
+        missing = [pk for pk in pks if pk not in found]
+        loaded = {}
+        if missing:
+            for row in LedgerAccount.objects.filter(pk__in=missing) \
+                    .values_list('pk', 'account_type', 'debit_total',
+                                 'credit_total'):
+                loaded[row[0]] = CachedBalance(*row[1:])
+            if cache is not None and loaded:
+                cache.set_many(dict((keys[pk], tuple(balance))
+                                    for pk, balance in loaded.items()),
+                               self.ttl)
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(missing)
+        found.update(loaded)
+        return found
+
+    def get(self, pk):
+        """Returns the :py:class:`CachedBalance` of account *pk*, or None
+        if there is no such account."""
+        return self.get_many([pk]).get(pk)
+
+    def invalidate(self, pks):
+        """Bumps the version of the accounts *pks*."""
+        cache = self.cache
+        if cache is None:
+            return
+        for pk in pks:
+            key = self._version_key(pk)
+            try:
+                cache.incr(key)
+            except ValueError:
+                # Not cached; the next lookup starts a new version
+                pass
+        with self._lock:
+            self.invalidations += len(pks)
+
+
+#: Shared :py:class:`BalanceCache`.
+balance_cache = BalanceCache()
+
+
+@receiver(totals_changed)
+def _totals_changed(sender, accounts, **kwargs):
+    balance_cache.invalidate(accounts)
@@ -0,0 +1,248 @@
+"""Export of the ledger to GnuCash.
+
+Entries are written as GnuCash's multi-split CSV transaction import format,
+one line per split: the debit side with a positive amount and the credit
+side with a negative one, both under the same transaction ID.
+
+Exports are incremental.  Each named export keeps an
+:py:class:`accounting.models.ExportWatermark` of the last entry it wrote,
+by (``modified_date``, primary key), and the next run only reads entries
+created or changed after it.  Entries are read in chunks along the
+matching index, so memory use depends on the chunk size and the number of
+accounts, not on the size of the ledger.
+
+GnuCash only uses the transaction ID to group the splits of one file, so
+an entry exported again after an edit would be imported as a second
+transaction.  Every edit and deletion therefore leaves a
+:py:class:`accounting.models.LedgerEntryRevision` with the entry's previous
+values, and an incremental export first writes a reversing transaction for
+the version of each changed or deleted entry that an earlier export wrote,
+followed by the entries' current versions.  The watermark tracks the
+revisions already taken into account as well.
+
+Settings:
+
+``GNUCASH_MEMBER_ACCOUNT_PREFIX``
+    Parent GnuCash account of member accounts without a
+    ``gnucash_account`` of their own.  Defaults to
+    ``"Liabilities:Member Accounts"``.
+``GNUCASH_EXPORT_LAG``
+    Seconds by which each export stays behind the present, so that entries
+    saved by transactions still in progress are not skipped.  Defaults to
+    60.
+"""
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Q
+from django.utils import timezone
+
+from collections import namedtuple
+from datetime import timedelta
+import csv
+
+from .models import LedgerAccount, LedgerEntry, LedgerEntryRevision, \
+    ExportWatermark
+
+GNUCASH_MEMBER_ACCOUNT_PREFIX = getattr(
+    settings, "GNUCASH_MEMBER_ACCOUNT_PREFIX", "Liabilities:Member Accounts")
+GNUCASH_EXPORT_LAG = getattr(settings, "GNUCASH_EXPORT_LAG", 60)
+
+#: Columns written, named as GnuCash's CSV importer names them.
+COLUMNS = ['Date', 'Transaction ID', 'Number', 'Description',
+           'Full Account Name', 'Amount Num.']
+
+ExportResult = namedtuple('ExportResult', ['entries', 'reversals',
+                                           'watermark'])
+
+
+def account_names():
+    """Returns a dict mapping every :py:class:`LedgerAccount` primary key to
+    its full GnuCash account name."""
+    names = {}
+    for acct in LedgerAccount.objects.select_related('member'):
+        if acct.gnucash_account:
+            names[acct.pk] = acct.gnucash_account
+            continue
+        try:
+            leaf = acct.member.name
+        except ObjectDoesNotExist:
+            leaf = "Account %d" % acct.pk
+        # Colons separate account levels in GnuCash
+        names[acct.pk] = "%s:%s" % (GNUCASH_MEMBER_ACCOUNT_PREFIX,
+                                    leaf.replace(':', '-'))
+    return names
+
+
+def _account_name(names, pk):
+    """Name of account *pk* in *names*, falling back to the default member
+    account name for accounts that have been deleted since."""
+    try:
+        return names[pk]
+    except KeyError:
+        return "%s:Account %d" % (GNUCASH_MEMBER_ACCOUNT_PREFIX, pk)
+
+
+def _chunked(qs, date_field, after, chunk_size):
+    """Yields the rows of the ``values_list`` queryset *qs*, which start
+    with (id, *date_field*), after the (date, id) pair *after*, reading
+    *chunk_size* rows at a time along the (*date_field*, id) index."""
+    qs = qs.order_by(date_field, 'id')
+    while True:
+        chunk = qs
+        if after is not None:
+            value, pk = after
+            chunk = chunk.filter(Q(**{date_field + '__gt': value}) |
+                                 Q(**{date_field: value, 'id__gt': pk}))
+        rows = list(chunk[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        after = rows[-1][1], rows[-1][0]
+
+
+def changed_entries(after=None, until=None, chunk_size=5000):
+    """Yields (id, modified_date, effective_date, details, debit_account_id,
+    credit_account_id, amount) tuples of the entries modified after
+    *after*, in (``modified_date``, id) order, reading *chunk_size* rows
+    at a time.
+
+    :param after: (modified_date, id) of the last entry already seen, or
+        None for all entries.
+    :param until: optional :class:`datetime.datetime`; entries modified
+        later are left out.
+    """
+    qs = LedgerEntry.objects.all()
+    if until is not None:
+        qs = qs.filter(modified_date__lte=until)
+    return _chunked(qs.values_list('id', 'modified_date', 'effective_date',
+                                   'details', 'debit_account_id',
+                                   'credit_account_id', 'amount'),
+                    'modified_date', after, chunk_size)
+
+
+def changed_revisions(after=None, until=None, chunk_size=5000):
+    """Yields (id, changed_date, entry_id, modified_date, effective_date,
+    details, debit_account_id, credit_account_id, amount) tuples of the
+    :py:class:`LedgerEntryRevision` rows recorded after *after*, like
+    :py:func:`changed_entries`.
+
+    :param after: (changed_date, id) of the last revision already seen, or
+        None for all revisions.
+    """
+    qs = LedgerEntryRevision.objects.all()
+    if until is not None:
+        qs = qs.filter(changed_date__lte=until)
+    return _chunked(qs.values_list('id', 'changed_date', 'entry_id',
+                                   'modified_date', 'effective_date',
+                                   'details', 'debit_account_id',
+                                   'credit_account_id', 'amount'),
+                    'changed_date', after, chunk_size)
+
+
+def exported_versions(revisions, exported):
+    """Picks the revisions holding a version an earlier export wrote: the
+    first revision of each entry, if the entry's (modified_date, id) at the
+    time is not after *exported*.
+
+    :param revisions: rows from :py:func:`changed_revisions`.
+    :param exported: (modified_date, id) of the last exported entry.
+    """
+    seen = set()
+    for row in revisions:
+        entry_id, modified = row[2], row[3]
+        if entry_id in seen:
+            continue
+        seen.add(entry_id)
+        if (modified, entry_id) <= exported:
+            yield row
+
+
+def write_entries(stream, entries, names):
+    """Writes *entries* from :py:func:`changed_entries` to *stream* as
+    CSV splits, without a header.
+
+    :param names: dict from :py:func:`account_names`.
+    :return: (number of entries, last entry) tuple.
+    """
+    writer = csv.writer(stream, lineterminator='\n')
+    count = 0
+    last = None
+    for last in entries:
+        pk, modified, effective, details, debit, credit, amount = last
+        txn = [effective.isoformat(), 'mms-%d' % pk, pk, details]
+        writer.writerow(txn + [names[debit], amount])
+        writer.writerow(txn + [names[credit], -amount])
+        count += 1
+    return count, last
+
+
+def write_reversals(stream, revisions, names):
+    """Writes a reversing transaction for each of *revisions* from
+    :py:func:`exported_versions`, like :py:func:`write_entries`.
+
+    :return: number of reversals.
+    """
+    writer = csv.writer(stream, lineterminator='\n')
+    count = 0
+    for row in revisions:
+        (pk, changed, entry_id, modified, effective, details, debit, credit,
+         amount) = row
+        txn = [effective.isoformat(), 'mms-%d-r%d' % (entry_id, pk),
+               entry_id, 'Reversal: %s' % details]
+        writer.writerow(txn + [_account_name(names, debit), -amount])
+        writer.writerow(txn + [_account_name(names, credit), amount])
+        count += 1
+    return count
+
+
+def export(stream, name='gnucash', full=False, chunk_size=5000, lag=None):
+    """Writes the entries created or changed since the last export called
+    *name* to *stream*, preceded by reversals of the previously exported
+    versions of entries changed or deleted since, and moves its watermark
+    forward.
+
+    The watermark is only saved once everything has been written, so an
+    export that fails part way is simply repeated in full by the next run.
+
+    :param full: export every entry, ignoring the watermark.
+    :param lag: seconds to stay behind the present; defaults to
+        :py:data:`GNUCASH_EXPORT_LAG`.
+    :return: :py:class:`ExportResult` with the number of entries and
+        reversals written and the updated :py:class:`ExportWatermark`.
+    """
+    if lag is None:
+        lag = GNUCASH_EXPORT_LAG
+    until = timezone.now() - timedelta(seconds=lag)
+    watermark, created = ExportWatermark.objects.get_or_create(name=name)
+    after = None
+    revisions_after = None
+    if watermark.modified_date is not None and not full:
+        after = watermark.modified_date, watermark.entry_id
+        if watermark.revision_date is not None:
+            revisions_after = watermark.revision_date, watermark.revision_id
+
+    names = account_names()
+    csv.writer(stream, lineterminator='\n').writerow(COLUMNS)
+    reversals = 0
+    if after is not None:
+        reversals = write_reversals(stream, exported_versions(
+            changed_revisions(revisions_after, until, chunk_size), after),
+            names)
+    # The revisions up to here are taken into account, or, without an
+    # earlier export, have nothing left to reverse
+    last_revision = LedgerEntryRevision.objects.filter(
+        changed_date__lte=until).order_by('-changed_date', '-id') \
+        .values_list('id', 'changed_date').first()
+    count, last = write_entries(
+        stream, changed_entries(after, until, chunk_size), names)
+
+    if last is not None:
+        watermark.entry_id = last[0]
+        watermark.modified_date = last[1]
+    if last_revision is not None:
+        watermark.revision_id = last_revision[0]
+        watermark.revision_date = last_revision[1]
+    if last is not None or last_revision is not None:
+        watermark.save()
+    return ExportResult(count, reversals, watermark)
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounting.reports import chart_of_accounts
+
+
+class Command(BaseCommand):
+    help = ("Prints the GnuCash account tree with the rolled-up balance of "
+            "every level.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?', default=None,
+            help="Only print the tree below this account path.")
+        parser.add_argument(
+            '--depth', dest='depth', type=int, default=None,
+            help="Only print this many levels.")
+
+    def handle(self, *args, **options):
+        root = chart_of_accounts(options['path'])
+        if options['path']:
+            root = root.find(options['path'])
+            if root is None:
+                raise CommandError("No accounts under %s" % options['path'])
+        line = "%-60s %8s %14s"
+        self.stdout.write(line % ("Account", "Accounts", "Balance"))
+        for depth, node in root.walk():
+            if options['depth'] is not None and depth > options['depth']:
+                continue
+            balance = node.account_balance
+            self.stdout.write(line % (
+                '  ' * depth + (node.name or "Total"), node.accounts,
+                node.balance if balance is None else balance))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from accounting.models import BalanceSnapshot
+
+
+class Command(BaseCommand):
+    help = ("Records a closing-balance snapshot of every LedgerAccount as of "
+            "the given period end date (YYYY-MM-DD, inclusive).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('period_end')
+
+    def handle(self, *args, **options):
+        period_end = parse_date(options['period_end'])
+        if period_end is None:
+            raise CommandError("Invalid date: %s" % options['period_end'])
+        count = BalanceSnapshot.objects.close_period(period_end)
+        self.stdout.write("Closed %s for %d account(s)." % (period_end, count))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from accounting.gnucash import export
+
+import io
+
+
+class Command(BaseCommand):
+    help = ("Writes the ledger entries created or changed since the last "
+            "export as GnuCash CSV transactions, after reversals of the "
+            "exported versions of entries changed or deleted since.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output', '-o', dest='output', default=None,
+            help="File to write to; defaults to standard output.")
+        parser.add_argument(
+            '--full', action='store_true', default=False,
+            help="Export every entry, not only new and changed ones.")
+        parser.add_argument(
+            '--name', dest='name', default='gnucash',
+            help="Name of the export whose watermark to use.")
+        parser.add_argument(
+            '--chunk-size', dest='chunk_size', type=int, default=5000,
+            help="Number of entries read per query.")
+
+    def handle(self, *args, **options):
+        kwargs = dict(name=options['name'], full=options['full'],
+                      chunk_size=options['chunk_size'])
+        if options['output'] is None:
+            export(self.stdout, **kwargs)
+            return
+        with io.open(options['output'], 'w', encoding='utf-8',
+                     newline='') as stream:
+            result = export(stream, **kwargs)
+        self.stderr.write("Exported %d entries and %d reversals up to %s" % (
+            result.entries, result.reversals, result.watermark.modified_date))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounting.models import LedgerAccount
+
+
+class Command(BaseCommand):
+    help = ("Recomputes the stored debit/credit running totals on every "
+            "LedgerAccount from its LedgerEntry rows.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true', default=False,
+            help="Only report drift between stored and recomputed totals; "
+                 "exit with an error if any is found.")
+
+    def handle(self, *args, **options):
+        if options['check']:
+            drift = LedgerAccount.objects.verify_balances()
+            for d in drift:
+                self.stdout.write(
+                    "%s: stored debits %s credits %s, actual debits %s "
+                    "credits %s" % (d.account, d.stored_debits,
+                                    d.stored_credits, d.debits, d.credits))
+            if drift:
+                raise CommandError("%d account(s) have drifted" % len(drift))
+            self.stdout.write("All account totals verified.")
+        else:
+            fixed = LedgerAccount.objects.rebuild_balances()
+            self.stdout.write("Rebuilt totals; %d account(s) corrected."
+                              % fixed)
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from accounting.reports import trial_balance
+
+
+class Command(BaseCommand):
+    help = ("Prints a trial balance of the entire ledger and exits with an "
+            "error if it does not balance.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--as-of', dest='as_of', default=None,
+            help="Only include entries effective on or before this date "
+                 "(YYYY-MM-DD).")
+        parser.add_argument(
+            '--summary', action='store_true', default=False,
+            help="Only print the per-type totals.")
+
+    def handle(self, *args, **options):
+        as_of = None
+        if options['as_of'] is not None:
+            as_of = parse_date(options['as_of'])
+            if as_of is None:
+                raise CommandError("Invalid date: %s" % options['as_of'])
+
+        tb = trial_balance(as_of)
+        line = "%-60s %14s %14s %14s"
+        self.stdout.write(line % ("Account", "Debits", "Credits", "Balance"))
+        if not options['summary']:
+            for r in tb.rows:
+                self.stdout.write(line % (r.account, r.debits, r.credits,
+                                          r.account_balance))
+            self.stdout.write("")
+        for t in tb.type_totals.values():
+            self.stdout.write(line % (t['label'], t['debits'], t['credits'],
+                                      t['account_balance']))
+        self.stdout.write(line % ("Total", tb.debits, tb.credits, tb.total))
+
+        if not tb.is_balanced:
+            raise CommandError("Ledger is out of balance by %s" % tb.total)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Sum
+from decimal import Decimal
+
+
+def populate_totals(apps, schema_editor):
+    LedgerAccount = apps.get_model('accounting', 'LedgerAccount')
+    LedgerEntry = apps.get_model('accounting', 'LedgerEntry')
+    for side, field in (('debit_account', 'debit_total'),
+                        ('credit_account', 'credit_total')):
+        rows = LedgerEntry.objects.order_by().values(side).annotate(
+            total=Sum('amount'))
+        for row in rows:
+            LedgerAccount.objects.filter(pk=row[side]).update(
+                **{field: row['total']})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0005_auto_20150405_2102'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ledgeraccount',
+            name='credit_total',
+            field=models.DecimalField(default=Decimal('0.00'), editable=False, max_digits=14, decimal_places=2),
+        ),
+        migrations.AddField(
+            model_name='ledgeraccount',
+            name='debit_total',
+            field=models.DecimalField(default=Decimal('0.00'), editable=False, max_digits=14, decimal_places=2),
+        ),
+        migrations.AlterField(
+            model_name='paymentmethod',
+            name='api',
+            field=models.PositiveSmallIntegerField(default=0, choices=[(0, 'None'), (1, 'Stripe')]),
+        ),
+        migrations.RunPython(populate_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0006_ledgeraccount_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('period_end', models.DateField()),
+                ('debits', models.DecimalField(max_digits=14, decimal_places=2)),
+                ('credits', models.DecimalField(max_digits=14, decimal_places=2)),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+                ('account', models.ForeignKey(related_name='snapshots', to='accounting.LedgerAccount')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='balancesnapshot',
+            unique_together=set([('account', 'period_end')]),
+        ),
+    ]
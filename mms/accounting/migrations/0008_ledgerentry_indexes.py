@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0007_balancesnapshot'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='ledgerentry',
+            index_together=set([('debit_account', 'effective_date', 'created_date', 'id'), ('effective_date', 'created_date', 'id'), ('credit_account', 'effective_date', 'created_date', 'id')]),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0008_ledgerentry_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportWatermark',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('modified_date', models.DateTimeField(blank=True, null=True)),
+                ('entry_id', models.IntegerField(default=0)),
+                ('updated_date', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='ledgerentry',
+            index_together=set([('credit_account', 'effective_date', 'created_date', 'id'), ('debit_account', 'effective_date', 'created_date', 'id'), ('effective_date', 'created_date', 'id'), ('modified_date', 'id')]),
+        ),
+    ]
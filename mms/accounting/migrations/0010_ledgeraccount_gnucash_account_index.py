@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0009_exportwatermark'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ledgeraccount',
+            name='gnucash_account',
+            field=models.CharField(max_length=191, blank=True, db_index=True),
+        ),
+    ]
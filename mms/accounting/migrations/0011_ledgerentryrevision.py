@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0010_ledgeraccount_gnucash_account_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEntryRevision',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('entry_id', models.IntegerField()),
+                ('changed_date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('deleted', models.BooleanField(default=False)),
+                ('effective_date', models.DateField()),
+                ('modified_date', models.DateTimeField()),
+                ('debit_account_id', models.IntegerField()),
+                ('credit_account_id', models.IntegerField()),
+                ('amount', models.DecimalField(max_digits=8, decimal_places=2)),
+                ('details', models.TextField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='exportwatermark',
+            name='revision_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='exportwatermark',
+            name='revision_id',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterIndexTogether(
+            name='ledgerentryrevision',
+            index_together=set([('changed_date', 'id')]),
+        ),
+    ]
@@ -1,9 +1,168 @@
-from django.db import models
-from django.db.models import Sum, Q
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connections, models, transaction
+from django.db.models import Sum, Q, F, Case, When, ExpressionWrapper
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 
+from collections import defaultdict, namedtuple
 from decimal import Decimal
 
+from .signals import totals_changed
+
+
+BalanceDrift = namedtuple('BalanceDrift', [
+    'account', 'stored_debits', 'stored_credits', 'debits', 'credits'])
+
+
+def balance_annotations(prefix=''):
+    """Annotations computing :py:attr:`LedgerAccount.balance` and
+    :py:attr:`LedgerAccount.account_balance` in the database from the
+    stored running totals, e.g. for sortable admin columns.
+
+    :param prefix:
+        Lookup path to the :py:class:`LedgerAccount`, e.g. ``'account__'``
+        when annotating a model with a foreign key to it.
+    :return:
+        dict with ``annotated_balance`` and ``annotated_account_balance``
+        expressions, for passing to
+        :meth:`django.db.models.query.QuerySet.annotate`.
+    """
+    output = models.DecimalField(max_digits=15, decimal_places=2)
+    debits = F(prefix + 'debit_total')
+    credits = F(prefix + 'credit_total')
+    return {
+        'annotated_balance': ExpressionWrapper(debits - credits,
+                                               output_field=output),
+        'annotated_account_balance': Case(
+            When(**{prefix + 'account_type__lt': 0,
+                    'then': ExpressionWrapper(debits - credits,
+                                              output_field=output)}),
+            default=ExpressionWrapper(credits - debits, output_field=output),
+            output_field=output),
+    }
+
+
+class LedgerAccountManager(models.Manager):
+    #: Most accounts named in a single query by :py:meth:`adjust_totals`
+    ADJUST_BATCH_SIZE = 500
+
+    def computed_totals(self, accounts=None):
+        """Recomputes debit and credit totals from scratch, using one grouped
+        aggregate over :py:class:`LedgerEntry` per side.
+
+        :param accounts:
+            Optional iterable of :py:class:`LedgerAccount` primary keys to
+            limit the computation to.  Defaults to all accounts.
+        :return:
+            dict mapping account primary key to a (debits, credits) tuple.
+            Accounts without any entries are absent.
+        """
+        totals = defaultdict(lambda: [Decimal('0.00'), Decimal('0.00')])
+        for idx, side in enumerate(('debit_account', 'credit_account')):
+            qs = LedgerEntry.objects.all()
+            if accounts is not None:
+                qs = qs.filter(**{'%s__in' % side: accounts})
+            qs = qs.order_by().values(side).annotate(total=Sum('amount'))
+            for row in qs:
+                totals[row[side]][idx] = row['total']
+        return dict((k, tuple(v)) for k, v in totals.items())
+
+    def adjust_totals(self, debits=None, credits=None, instances=()):
+        """Atomically adds amounts to the stored running totals and sends
+        :py:data:`accounting.signals.totals_changed`.
+
+        :param debits: dict mapping account primary key to a debit delta.
+        :param credits: dict mapping account primary key to a credit delta.
+        :param instances:
+            :py:class:`LedgerAccount` instances already in memory which should
+            reflect the new totals without being reloaded.
+        """
+        debits = debits or {}
+        credits = credits or {}
+        # One update per distinct pair of deltas rather than per account;
+        # a posting run mostly moves the same amount between many accounts
+        groups = defaultdict(list)
+        for pk in set(debits) | set(credits):
+            deltas = (debits.get(pk) or 0, credits.get(pk) or 0)
+            if any(deltas):
+                groups[deltas].append(pk)
+        changed = sorted(pk for pks in groups.values() for pk in pks)
+        batches = [changed[i:i + self.ADJUST_BATCH_SIZE]
+                   for i in range(0, len(changed), self.ADJUST_BATCH_SIZE)]
+        if len(changed) > 1 and \
+                connections[self.db].features.has_select_for_update:
+            # An UPDATE locks its rows in whatever order it finds them, so
+            # lock them first in primary key order, so that concurrent
+            # postings cannot deadlock
+            for batch in batches:
+                list(self.select_for_update().filter(pk__in=batch)
+                     .order_by('pk').values_list('pk', flat=True))
+        for (debit, credit), pks in sorted(groups.items()):
+            changes = {}
+            if debit:
+                changes['debit_total'] = F('debit_total') + debit
+            if credit:
+                changes['credit_total'] = F('credit_total') + credit
+            pks.sort()
+            for i in range(0, len(pks), self.ADJUST_BATCH_SIZE):
+                self.filter(pk__in=pks[i:i + self.ADJUST_BATCH_SIZE]) \
+                    .update(**changes)
+        if changed:
+            totals_changed.send(sender=self.model, accounts=changed)
+
+        seen = set()
+        for acct in instances:
+            if acct is None or id(acct) in seen:
+                continue
+            seen.add(id(acct))
+            acct.debit_total += debits.get(acct.pk, 0)
+            acct.credit_total += credits.get(acct.pk, 0)
+
+    def verify_balances(self, accounts=None):
+        """Compares the stored running totals against freshly computed ones.
+
+        :param accounts:
+            Optional iterable of :py:class:`LedgerAccount` primary keys to
+            check.  Defaults to all accounts.
+        :return: list of :py:class:`BalanceDrift` for mismatched accounts.
+        """
+        computed = self.computed_totals(accounts)
+        qs = self.all()
+        if accounts is not None:
+            qs = qs.filter(pk__in=accounts)
+        drift = []
+        for acct in qs.iterator():
+            debits, credits = computed.get(
+                acct.pk, (Decimal('0.00'), Decimal('0.00')))
+            if acct.debit_total != debits or acct.credit_total != credits:
+                drift.append(BalanceDrift(acct, acct.debit_total,
+                                          acct.credit_total, debits, credits))
+        return drift
+
+    def rebuild_balances(self, accounts=None):
+        """Recomputes the stored running totals from scratch.
+
+        :param accounts:
+            Optional iterable of :py:class:`LedgerAccount` primary keys to
+            rebuild.  Defaults to all accounts.
+        :return: number of accounts whose stored totals were corrected.
+        """
+        with transaction.atomic():
+            qs = self.select_for_update()
+            if accounts is not None:
+                qs = qs.filter(pk__in=accounts)
+            # Lock the rows so concurrent postings wait for the rebuild
+            list(qs.values_list('pk'))
+            drift = self.verify_balances(accounts)
+            for d in drift:
+                self.filter(pk=d.account.pk).update(
+                    debit_total=d.debits, credit_total=d.credits)
+        if drift:
+            totals_changed.send(sender=self.model,
+                                accounts=[d.account.pk for d in drift])
+        return len(drift)
+
 
 class LedgerAccount(models.Model):
     """A particular account in the accounting ledger system.
@@ -41,6 +200,12 @@ class LedgerAccount(models.Model):
         Type of account, based on double-entry bookkeeping principles.  This
         is from *our* perspective: an account where a member deposits money
         would be a Liability account.
+    :param debit_total:
+        Running total of all debit transactions on this account.  Maintained
+        by :py:class:`LedgerEntry`; see
+        :py:meth:`LedgerAccountManager.rebuild_balances`.
+    :param credit_total:
+        Running total of all credit transactions on this account.
     """
     TYPE_ASSET = -1
     TYPE_EXPENSE = -2
@@ -54,8 +219,38 @@ class LedgerAccount(models.Model):
         (TYPE_LIABILITY, 'Liability'),
         (TYPE_INCOME, 'Income'),
     )
-    gnucash_account = models.TextField(blank=True)
+    # Indexed for prefix searches down the account tree.  Bounded, since
+    # MySQL cannot index TEXT columns; 191 characters fit the 767 byte key
+    # limit of InnoDB with utf8mb4.
+    gnucash_account = models.CharField(max_length=191, blank=True,
+                                       db_index=True)
     account_type = models.SmallIntegerField(choices=TYPE_CHOICES)
+    debit_total = models.DecimalField(max_digits=14, decimal_places=2,
+                                      default=Decimal('0.00'), editable=False)
+    credit_total = models.DecimalField(max_digits=14, decimal_places=2,
+                                       default=Decimal('0.00'),
+                                       editable=False)
+
+    objects = LedgerAccountManager()
+
+    #: Fields only :py:class:`LedgerAccountManager` writes.
+    TOTAL_FIELDS = ('debit_total', 'credit_total')
+
+    def save(self, *args, **kwargs):
+        """Saves the account.  Updates leave out :py:attr:`TOTAL_FIELDS`,
+        which are changed in place by
+        :py:meth:`LedgerAccountManager.adjust_totals` and
+        :py:meth:`LedgerAccountManager.rebuild_balances`, so that saving an
+        instance loaded before a posting cannot write its old totals
+        back."""
+        if not self._state.adding and not kwargs.get('force_insert'):
+            update_fields = kwargs.get('update_fields')
+            if update_fields is None:
+                update_fields = [f.name for f in self._meta.concrete_fields
+                                 if not f.primary_key]
+            kwargs['update_fields'] = [f for f in update_fields
+                                       if f not in self.TOTAL_FIELDS]
+        super(LedgerAccount, self).save(*args, **kwargs)
 
     def __str__(self):
         if self.gnucash_account is not None and len(self.gnucash_account) > 0:
@@ -65,34 +260,28 @@ class LedgerAccount(models.Model):
             try:
                 return "%s account for member %s" % (
                     self.get_account_type_display(), self.member.name)
-            except models.fields.related.RelatedObjectDoesNotExist:
+            except ObjectDoesNotExist:
                 return "%s account %d" % (self.get_account_type_display(),
                                           self.pk)
 
     def _get_credits(self):
-        """The sum of all credit transactions on this account.
+        """The sum of all credit transactions on this account, as stored in
+        :py:attr:`credit_total`.
 
         >>> acct.credits
         Decimal('42.00')
         """
-        agg = self.credit_transactions.all().aggregate(Sum('amount'))
-        the_sum = agg['amount__sum']
-        if the_sum is None:
-            the_sum = Decimal('0.00')
-        return the_sum
+        return self.credit_total
     credits = property(_get_credits)
 
     def _get_debits(self):
-        """The sum of all debit transactions on this account.
+        """The sum of all debit transactions on this account, as stored in
+        :py:attr:`debit_total`.
 
         >>> acct.debits
         Decimal('23.23')
         """
-        agg = self.debit_transactions.all().aggregate(Sum('amount'))
-        the_sum = agg['amount__sum']
-        if the_sum is None:
-            the_sum = Decimal('0.00')
-        return the_sum
+        return self.debit_total
     debits = property(_get_debits)
 
     def _get_balance(self):
@@ -148,9 +337,115 @@ class LedgerAccount(models.Model):
         """
         qq = Q(debit_account=self) | Q(credit_account=self)
         txns = LedgerEntry.objects.filter(qq)
-        txns = txns.order_by('effective_date', 'created_date')
+        txns = txns.order_by('effective_date', 'created_date', 'id')
         return txns
 
+    def get_totals_as_of(self, date):
+        """Debit and credit totals of this account as of the end of *date*.
+
+        Starts from the latest :py:class:`BalanceSnapshot` on or before
+        *date* and only sums the :py:class:`LedgerEntry` rows effective
+        after it.
+
+        :param date: :class:`datetime.date` to compute the totals for.
+        :return: (debits, credits) tuple of decimals.
+        """
+        snap = self.snapshots.filter(period_end__lte=date).order_by(
+            '-period_end').first()
+        debits = credits = Decimal('0.00')
+        txns = LedgerEntry.objects.filter(effective_date__lte=date)
+        if snap is not None:
+            debits, credits = snap.debits, snap.credits
+            txns = txns.filter(effective_date__gt=snap.period_end)
+
+        agg = txns.filter(debit_account=self).aggregate(Sum('amount'))
+        debits += agg['amount__sum'] or 0
+        agg = txns.filter(credit_account=self).aggregate(Sum('amount'))
+        credits += agg['amount__sum'] or 0
+        return debits, credits
+
+    def get_balance_as_of(self, date):
+        """Like :py:attr:`balance`, but as of the end of *date*.
+
+        >>> acct.get_balance_as_of(date(2015, 3, 31))
+        Decimal('-27.00')
+        """
+        debits, credits = self.get_totals_as_of(date)
+        return debits - credits
+
+    def get_account_balance_as_of(self, date):
+        """Like :py:attr:`account_balance`, but as of the end of *date*."""
+        if self.account_type < 0:
+            return self.get_balance_as_of(date)
+        else:
+            return -self.get_balance_as_of(date)
+
+
+class LedgerEntryQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        """Refused: a bulk update would bypass the running totals, balance
+        snapshots and revisions that :py:meth:`LedgerEntry.save` and
+        :py:meth:`LedgerEntryManager.bulk_post` maintain.
+
+        :raise TypeError: always.
+        """
+        raise TypeError("LedgerEntry rows cannot be bulk updated; save() "
+                        "each entry instead")
+
+
+class LedgerEntryManager(models.Manager.from_queryset(LedgerEntryQuerySet)):
+    def bulk_post(self, entries, batch_size=None, need_pks=False):
+        """Inserts many unsaved :py:class:`LedgerEntry` instances at once.
+
+        Unlike :meth:`django.db.models.query.QuerySet.bulk_create`, this
+        also applies them to the running totals of the affected
+        :py:class:`LedgerAccount` instances (one update per account) and
+        invalidates the :py:class:`BalanceSnapshot` rows they fall into, all
+        in one transaction.
+
+        :param entries: list of unsaved :py:class:`LedgerEntry` instances.
+        :param batch_size: passed on to ``bulk_create``.
+        :param need_pks:
+            Set primary keys on *entries*, e.g. to link them to other
+            rows.  On backends that cannot return them from a bulk insert,
+            rows are then inserted one statement each; the totals and
+            snapshots are still updated in bulk.
+        :return: the created entries.  Unless *need_pks* is set, primary
+            keys are only set on backends that return them from
+            ``bulk_create``.
+        """
+        debits = defaultdict(Decimal)
+        credits = defaultdict(Decimal)
+        earliest = {}
+        amount_field = self.model._meta.get_field('amount')
+        date_field = self.model._meta.get_field('effective_date')
+        for e in entries:
+            e.amount = amount_field.to_python(e.amount)
+            e.effective_date = date_field.to_python(e.effective_date)
+            debits[e.debit_account_id] += e.amount
+            credits[e.credit_account_id] += e.amount
+            for pk in (e.debit_account_id, e.credit_account_id):
+                if pk not in earliest or e.effective_date < earliest[pk]:
+                    earliest[pk] = e.effective_date
+
+        can_return_pks = getattr(connections[self.db].features,
+                                 'can_return_ids_from_bulk_insert', False)
+        with transaction.atomic():
+            if need_pks and not can_return_pks:
+                for e in entries:
+                    # Plain insert; the bookkeeping in LedgerEntry.save()
+                    # is done in bulk below
+                    models.Model.save(e, force_insert=True)
+            else:
+                entries = self.bulk_create(entries, batch_size=batch_size)
+            LedgerAccount.objects.adjust_totals(debits, credits)
+            by_date = defaultdict(list)
+            for pk, date in earliest.items():
+                by_date[date].append(pk)
+            for date, pks in by_date.items():
+                BalanceSnapshot.objects.invalidate(pks, date)
+        return entries
+
 
 class LedgerEntry(models.Model):
     """A financial transaction, implemented as a transfer between two
@@ -186,14 +481,66 @@ class LedgerEntry(models.Model):
     amount = models.DecimalField(max_digits=8, decimal_places=2)
     details = models.TextField()
 
+    objects = LedgerEntryManager()
+
     class Meta:
         verbose_name = 'ledger entry'
         verbose_name_plural = 'ledger entries'
+        # Account listings in date order (see
+        # LedgerAccount.get_account_transactions) and the admin listing
+        index_together = [
+            ('debit_account', 'effective_date', 'created_date', 'id'),
+            ('credit_account', 'effective_date', 'created_date', 'id'),
+            ('effective_date', 'created_date', 'id'),
+            # Incremental exports; see accounting.gnucash
+            ('modified_date', 'id'),
+        ]
 
     def __str__(self):
         return "Amount %.2f (debit '%s', credit '%s', description '%s')" % (
             self.amount, self.debit_account, self.credit_account, self.details)
 
+    def _cached_accounts(self):
+        """The debit and credit :py:class:`LedgerAccount` instances already
+        attached to this entry, without hitting the database."""
+        return [getattr(self, self._meta.get_field(f).get_cache_name(), None)
+                for f in ('debit_account', 'credit_account')]
+
+    def save(self, *args, **kwargs):
+        """Saves the entry and updates the running totals of the affected
+        :py:class:`LedgerAccount` instances in the same transaction.  Any
+        :py:class:`BalanceSnapshot` of those accounts covering the effective
+        date is invalidated."""
+        self.amount = self._meta.get_field('amount').to_python(self.amount)
+        self.effective_date = self._meta.get_field(
+            'effective_date').to_python(self.effective_date)
+        with transaction.atomic():
+            old = None
+            if self.pk is not None:
+                old = LedgerEntry.objects.select_for_update().filter(
+                    pk=self.pk).values('debit_account', 'credit_account',
+                                       'amount', 'effective_date',
+                                       'modified_date', 'details').first()
+            super(LedgerEntry, self).save(*args, **kwargs)
+
+            debits = defaultdict(Decimal)
+            credits = defaultdict(Decimal)
+            if old is not None:
+                LedgerEntryRevision.objects.record(
+                    self.pk, old, changed_date=self.modified_date)
+                debits[old['debit_account']] -= old['amount']
+                credits[old['credit_account']] -= old['amount']
+                BalanceSnapshot.objects.invalidate(
+                    [old['debit_account'], old['credit_account']],
+                    old['effective_date'])
+            debits[self.debit_account_id] += self.amount
+            credits[self.credit_account_id] += self.amount
+            LedgerAccount.objects.adjust_totals(debits, credits,
+                                                self._cached_accounts())
+            BalanceSnapshot.objects.invalidate(
+                [self.debit_account_id, self.credit_account_id],
+                self.effective_date)
+
     def account_net(self, account):
         """Net effect of this transaction on *account*.
 
@@ -207,14 +554,209 @@ class LedgerEntry(models.Model):
         :param account:
             Account to compute net effect upon.
         """
+        # Compare keys so that neither account has to be fetched
         amt = 0
-        if self.debit_account == account:
+        if self.debit_account_id == account.pk:
             amt += self.amount
-        if self.credit_account == account:
+        if self.credit_account_id == account.pk:
             amt -= self.amount
         return amt
 
 
+class LedgerEntryRevisionManager(models.Manager):
+    def record(self, entry_id, values, changed_date=None, deleted=False):
+        """Stores the version of a :py:class:`LedgerEntry` that is being
+        changed or deleted.
+
+        :param entry_id: primary key of the entry.
+        :param values: dict of the entry's ``debit_account``,
+            ``credit_account``, ``amount``, ``effective_date``,
+            ``modified_date`` and ``details`` before the change.
+        :param changed_date: time of the change; defaults to now.
+        :param deleted: True if the entry is being deleted.
+        """
+        return self.create(
+            entry_id=entry_id, deleted=deleted,
+            changed_date=changed_date or timezone.now(),
+            debit_account_id=values['debit_account'],
+            credit_account_id=values['credit_account'],
+            amount=values['amount'],
+            effective_date=values['effective_date'],
+            modified_date=values['modified_date'],
+            details=values['details'])
+
+
+class LedgerEntryRevision(models.Model):
+    """A previous version of a :py:class:`LedgerEntry`, recorded whenever
+    an entry is changed or deleted, so that incremental exports can reverse
+    the version they exported before.  See :py:mod:`accounting.gnucash`.
+
+    :param entry_id: primary key of the entry, which may no longer exist.
+    :param debit_account_id: primary key of the debited
+        :py:class:`LedgerAccount`, which may no longer exist either; likewise
+        ``credit_account_id``.
+    :param changed_date: when the entry was changed or deleted.
+    :param deleted: True if the entry was deleted.
+
+    The other fields hold the entry's values before the change.
+    """
+    entry_id = models.IntegerField()
+    changed_date = models.DateTimeField(default=timezone.now)
+    deleted = models.BooleanField(default=False)
+    effective_date = models.DateField()
+    modified_date = models.DateTimeField()
+    # Plain ids rather than foreign keys, like entry_id, so that deleting an
+    # account along with its entries isn't blocked by their revisions
+    debit_account_id = models.IntegerField()
+    credit_account_id = models.IntegerField()
+    amount = models.DecimalField(max_digits=8, decimal_places=2)
+    details = models.TextField()
+
+    objects = LedgerEntryRevisionManager()
+
+    class Meta:
+        # Incremental exports; see accounting.gnucash
+        index_together = [('changed_date', 'id')]
+
+    def __str__(self):
+        return "%s of entry %d at %s" % (
+            "Deletion" if self.deleted else "Change", self.entry_id,
+            self.changed_date)
+
+
+class BalanceSnapshotManager(models.Manager):
+    def invalidate(self, accounts, date):
+        """Drops the snapshots of *accounts* whose period includes *date*,
+        e.g. after a back-dated :py:class:`LedgerEntry` was posted.
+
+        :param accounts: iterable of :py:class:`LedgerAccount` primary keys.
+        :param date: effective date of the change.
+        """
+        self.filter(account__in=set(accounts), period_end__gte=date).delete()
+
+    def close_period(self, period_end, accounts=None):
+        """Records closing balances of every account as of *period_end*.
+
+        Totals are computed from each account's previous snapshot, so
+        closing a month only sums the entries effective within it.
+        Existing snapshots for *period_end* are replaced.
+
+        :param period_end: :class:`datetime.date` ending the period.
+        :param accounts:
+            Optional iterable of :py:class:`LedgerAccount` primary keys.
+            Defaults to all accounts.
+        :return: number of snapshots created.
+        """
+        with transaction.atomic():
+            acct_qs = LedgerAccount.objects.all()
+            if accounts is not None:
+                acct_qs = acct_qs.filter(pk__in=accounts)
+            acct_ids = list(acct_qs.values_list('pk', flat=True))
+
+            self.filter(account__in=acct_ids, period_end=period_end).delete()
+
+            # Latest earlier snapshot per account
+            opening = {}
+            prior = self.filter(account__in=acct_ids,
+                                period_end__lt=period_end)
+            prior = prior.order_by('account', 'period_end').values_list(
+                'account', 'period_end', 'debits', 'credits')
+            for pk, end, debits, credits in prior.iterator():
+                opening[pk] = (end, debits, credits)
+
+            # Group accounts by the date they were last closed, so each
+            # group needs one grouped aggregate per side
+            groups = defaultdict(list)
+            for pk in acct_ids:
+                groups[opening.get(pk, (None,))[0]].append(pk)
+
+            totals = dict((pk, [Decimal('0.00'), Decimal('0.00')])
+                          for pk in acct_ids)
+            for pk, (end, debits, credits) in opening.items():
+                totals[pk] = [debits, credits]
+            for since, pks in groups.items():
+                txns = LedgerEntry.objects.filter(
+                    effective_date__lte=period_end)
+                if since is not None:
+                    txns = txns.filter(effective_date__gt=since)
+                for idx, side in enumerate(('debit_account',
+                                            'credit_account')):
+                    rows = txns.filter(**{'%s__in' % side: pks}).order_by()
+                    rows = rows.values(side).annotate(total=Sum('amount'))
+                    for row in rows:
+                        totals[row[side]][idx] += row['total']
+
+            self.bulk_create([
+                BalanceSnapshot(account_id=pk, period_end=period_end,
+                                debits=debits, credits=credits)
+                for pk, (debits, credits) in totals.items()])
+        return len(totals)
+
+
+class BalanceSnapshot(models.Model):
+    """Closing debit and credit totals of a :py:class:`LedgerAccount` at
+    the end of a period, used as a checkpoint by
+    :py:meth:`LedgerAccount.get_totals_as_of`.
+
+    Snapshots are created by :py:meth:`BalanceSnapshotManager.close_period`
+    and dropped automatically when a :py:class:`LedgerEntry` effective on
+    or before :py:attr:`period_end` is posted, edited or deleted.
+
+    :param account: :py:class:`LedgerAccount` this snapshot belongs to.
+    :param period_end:
+        :class:`django.db.models.DateField` with the last day (inclusive)
+        covered by this snapshot.
+    :param debits: Total of all debits effective up to :py:attr:`period_end`.
+    :param credits:
+        Total of all credits effective up to :py:attr:`period_end`.
+    """
+    account = models.ForeignKey(LedgerAccount, related_name="snapshots")
+    period_end = models.DateField()
+    debits = models.DecimalField(max_digits=14, decimal_places=2)
+    credits = models.DecimalField(max_digits=14, decimal_places=2)
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    objects = BalanceSnapshotManager()
+
+    class Meta:
+        unique_together = ('account', 'period_end')
+
+    def __str__(self):
+        return "%s as of %s" % (self.account, self.period_end)
+
+    def _get_balance(self):
+        """Raw closing balance, i.e. :py:attr:`debits` minus
+        :py:attr:`credits`."""
+        return self.debits - self.credits
+    balance = property(_get_balance)
+
+
+class ExportWatermark(models.Model):
+    """How far an incremental export of :py:class:`LedgerEntry` rows has
+    got, as the last (:py:attr:`LedgerEntry.modified_date`, primary key)
+    exported and the last (:py:attr:`LedgerEntryRevision.changed_date`,
+    primary key) taken into account.  See :py:mod:`accounting.gnucash`.
+
+    :param name: unique name of the export.
+    :param modified_date: ``modified_date`` of the last exported entry, or
+        None if nothing has been exported yet.
+    :param entry_id: primary key of the last exported entry.
+    :param revision_date: ``changed_date`` of the last revision seen, or
+        None if there was none.
+    :param revision_id: primary key of the last revision seen.
+    :param updated_date: time of the last export.
+    """
+    name = models.CharField(max_length=50, unique=True)
+    modified_date = models.DateTimeField(null=True, blank=True)
+    entry_id = models.IntegerField(default=0)
+    revision_date = models.DateTimeField(null=True, blank=True)
+    revision_id = models.IntegerField(default=0)
+    updated_date = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "Export '%s' up to %s" % (self.name, self.modified_date)
+
+
 class PaymentMethod(models.Model):
     """A valid method of payment, for adding money to a member's account.
 
@@ -273,3 +815,28 @@ class PaymentMethod(models.Model):
             return "%s (via %s)" % (self.name, self.get_api_display())
         else:
             return "%s" % self.name
+
+
+@receiver(post_delete, sender=LedgerEntry)
+def _ledgerentry_post_delete(sender, instance, **kwargs):
+    """Backs a deleted :py:class:`LedgerEntry` out of the running totals,
+    invalidates the snapshots it was part of and records its last version
+    as a :py:class:`LedgerEntryRevision`.
+
+    Runs inside the deletion transaction, so this also covers bulk
+    :py:meth:`django.db.models.query.QuerySet.delete` calls."""
+    LedgerEntryRevision.objects.record(instance.pk, {
+        'debit_account': instance.debit_account_id,
+        'credit_account': instance.credit_account_id,
+        'amount': instance.amount,
+        'effective_date': instance.effective_date,
+        'modified_date': instance.modified_date,
+        'details': instance.details,
+    }, deleted=True)
+    LedgerAccount.objects.adjust_totals(
+        {instance.debit_account_id: -instance.amount},
+        {instance.credit_account_id: -instance.amount},
+        instance._cached_accounts())
+    BalanceSnapshot.objects.invalidate(
+        [instance.debit_account_id, instance.credit_account_id],
+        instance.effective_date)
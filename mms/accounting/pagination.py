@@ -0,0 +1,182 @@
+"""Pagination of large listings, such as the ledger entries.
+
+:py:class:`KeysetPaginator` continues each page from the ordering values
+of the last row of the previous one, so that with a matching index every
+page costs the same as the first.  :py:class:`LargeTablePaginator` is a
+drop-in :class:`django.core.paginator.Paginator` for the admin, which
+needs page numbers: it estimates the count of unfiltered listings of large
+tables and skips through primary keys only.
+
+Settings:
+
+``ACCOUNTING_APPROXIMATE_COUNT_THRESHOLD``
+    Estimated number of rows above which unfiltered listings show the
+    estimate rather than an exact count.  Defaults to 100000.
+"""
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+
+from functools import reduce
+import base64
+import json
+import operator
+
+APPROXIMATE_COUNT_THRESHOLD = getattr(
+    settings, "ACCOUNTING_APPROXIMATE_COUNT_THRESHOLD", 100000)
+
+
+def estimate_count(model, using='default'):
+    """Cheap estimate of the number of rows in the table of *model*, from
+    the database statistics where there are any."""
+    conn = connections[using]
+    qn = conn.ops.quote_name
+    table = model._meta.db_table
+    with conn.cursor() as cursor:
+        if conn.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s",
+                           [table])
+        elif conn.vendor == 'mysql':
+            cursor.execute("SELECT table_rows FROM information_schema.tables "
+                           "WHERE table_schema = DATABASE() AND "
+                           "table_name = %s", [table])
+        else:
+            # Deleted rows leave gaps, so this errs on the high side
+            cursor.execute("SELECT MAX(%s) FROM %s" % (
+                qn(model._meta.pk.column), qn(table)))
+        row = cursor.fetchone()
+    return max(0, int(row[0] or 0)) if row else 0
+
+
+class LargeTablePaginator(Paginator):
+    """:class:`django.core.paginator.Paginator` for tables too large to
+    count or skip through.
+
+    The count of an unfiltered listing is :py:func:`estimate_count` once
+    that reaches *threshold*; filtered listings are counted exactly.  A page
+    first reads just the primary keys up to it, which the database can do
+    from an index, and then fetches its rows by primary key.
+    """
+    threshold = APPROXIMATE_COUNT_THRESHOLD
+    #: Whether :py:attr:`count` is an estimate.
+    approximate = False
+
+    def _get_count(self):
+        if self._count is None:
+            qs = self.object_list
+            if not qs.query.where:
+                estimate = estimate_count(qs.model, qs.db)
+                if estimate >= self.threshold:
+                    self._count = estimate
+                    self.approximate = True
+            if self._count is None:
+                self._count = qs.count()
+        return self._count
+    count = property(_get_count)
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        top = bottom + self.per_page
+        if top + self.orphans >= self.count and not self.approximate:
+            top = self.count
+        pks = list(self.object_list.values_list('pk', flat=True)[bottom:top])
+        objects = self.object_list.in_bulk(pks)
+        return self._get_page([objects[pk] for pk in pks if pk in objects],
+                              number, self)
+
+
+class KeysetPage(object):
+    """One page of a :py:class:`KeysetPaginator`.
+
+    :param object_list: the rows on this page.
+    :param next_cursor: cursor of the next page, or None on the last one.
+    """
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator(object):
+    """Pages through *queryset* in *ordering* by seeking past the last row
+    of the previous page, rather than with an offset.
+
+    :param queryset: :class:`django.db.models.query.QuerySet` to page
+        through.
+    :param per_page: number of rows per page.
+    :param ordering: field names, optionally prefixed with ``-``; the last
+        one must be unique, e.g. ``id``.
+
+    >>> paginator = KeysetPaginator(acct.get_account_transactions(), 50,
+    ...                             ('effective_date', 'created_date', 'id'))
+    >>> page = paginator.page()
+    >>> page = paginator.page(page.next_cursor)
+    """
+    def __init__(self, queryset, per_page, ordering):
+        self.queryset = queryset.order_by(*ordering)
+        self.per_page = int(per_page)
+        self.ordering = list(ordering)
+        meta = queryset.model._meta
+        self.fields = [meta.pk if name.lstrip('-') == 'pk'
+                       else meta.get_field(name.lstrip('-'))
+                       for name in self.ordering]
+
+    def encode_cursor(self, obj):
+        """Cursor of the page following *obj*."""
+        values = [field.value_to_string(obj) for field in self.fields]
+        return base64.urlsafe_b64encode(
+            json.dumps(values).encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        """Ordering values encoded in *cursor*.
+
+        :raise ValueError: if *cursor* is not a valid cursor.
+        """
+        try:
+            values = json.loads(base64.urlsafe_b64decode(
+                cursor.encode('ascii')).decode('utf-8'))
+            if len(values) == len(self.fields):
+                return [field.to_python(value)
+                        for field, value in zip(self.fields, values)]
+        except (TypeError, ValueError, ValidationError):
+            pass
+        raise ValueError("Invalid cursor %r" % cursor)
+
+    def seek(self, values):
+        """Filters the queryset to the rows after *values*."""
+        clauses = []
+        for i, name in enumerate(self.ordering):
+            lookups = dict((prev.lstrip('-'), value) for prev, value in
+                           zip(self.ordering[:i], values[:i]))
+            op = 'lt' if name.startswith('-') else 'gt'
+            lookups['%s__%s' % (name.lstrip('-'), op)] = values[i]
+            clauses.append(Q(**lookups))
+        return self.queryset.filter(reduce(operator.or_, clauses))
+
+    def page(self, cursor=None):
+        """Returns the :py:class:`KeysetPage` after *cursor*, or the first
+        page if it is None.
+
+        :raise ValueError: if *cursor* is not a valid cursor.
+        """
+        qs = self.queryset
+        if cursor is not None:
+            qs = self.seek(self.decode_cursor(cursor))
+        # One row extra tells whether there is a next page
+        rows = list(qs[:self.per_page + 1])
+        next_cursor = None
+        if len(rows) > self.per_page:
+            rows = rows[:self.per_page]
+            next_cursor = self.encode_cursor(rows[-1])
+        return KeysetPage(rows, next_cursor)
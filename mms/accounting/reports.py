@@ -0,0 +1,395 @@
+from django.db import connection
+from django.db.models import Count, Q, Sum
+
+from collections import namedtuple, OrderedDict
+from datetime import timedelta
+from decimal import Decimal
+import sqlite3
+
+from .gnucash import GNUCASH_MEMBER_ACCOUNT_PREFIX
+from .models import LedgerAccount, LedgerEntry
+
+
+class TrialBalanceRow(namedtuple('TrialBalanceRow',
+                                 ['account', 'debits', 'credits'])):
+    """Debit and credit totals of a single :py:class:`LedgerAccount` within
+    a :py:class:`TrialBalance`."""
+    __slots__ = ()
+
+    def _get_balance(self):
+        """Debits minus credits, like :py:attr:`LedgerAccount.balance`."""
+        return self.debits - self.credits
+    balance = property(_get_balance)
+
+    def _get_account_balance(self):
+        """Normal-sign balance, like
+        :py:attr:`LedgerAccount.account_balance`."""
+        if self.account.account_type < 0:
+            return self.balance
+        else:
+            return -self.balance
+    account_balance = property(_get_account_balance)
+
+
+class TrialBalance(object):
+    """A trial balance across the entire ledger.
+
+    :param rows: list of :py:class:`TrialBalanceRow`, one per account.
+    :param as_of: date the trial balance was computed for, or None.
+    """
+    def __init__(self, rows, as_of=None):
+        self.rows = rows
+        self.as_of = as_of
+
+    def _get_debits(self):
+        """Sum of all debits."""
+        return sum((r.debits for r in self.rows), Decimal('0.00'))
+    debits = property(_get_debits)
+
+    def _get_credits(self):
+        """Sum of all credits."""
+        return sum((r.credits for r in self.rows), Decimal('0.00'))
+    credits = property(_get_credits)
+
+    def _get_total(self):
+        """Sum of :py:attr:`TrialBalanceRow.balance` across all accounts.
+        Anything other than zero means the ledger is out of balance."""
+        return self.debits - self.credits
+    total = property(_get_total)
+
+    def _get_is_balanced(self):
+        """True if total debits equal total credits."""
+        return self.total == 0
+    is_balanced = property(_get_is_balanced)
+
+    def get_type_totals(self):
+        """Debit, credit and normal-sign totals per account type.
+
+        :return:
+            :class:`collections.OrderedDict` mapping each
+            :py:attr:`LedgerAccount.account_type` value to a dict with
+            ``label``, ``debits``, ``credits`` and ``account_balance`` keys.
+        """
+        totals = OrderedDict()
+        for value, label in LedgerAccount.TYPE_CHOICES:
+            totals[value] = {'label': label,
+                             'debits': Decimal('0.00'),
+                             'credits': Decimal('0.00'),
+                             'account_balance': Decimal('0.00')}
+        for r in self.rows:
+            t = totals[r.account.account_type]
+            t['debits'] += r.debits
+            t['credits'] += r.credits
+            t['account_balance'] += r.account_balance
+        return totals
+    type_totals = property(get_type_totals)
+
+
+def _to_decimal(value):
+    # Some backends (e.g. SQLite) hand back SUM() of a decimal column as a
+    # float or integer
+    return Decimal(str(value)).quantize(Decimal('0.01'))
+
+
+def trial_balance(as_of=None):
+    """Computes a :py:class:`TrialBalance` with a single grouped query over
+    :py:class:`LedgerEntry`, unioning both sides of every entry, plus one
+    query to load the accounts.
+
+    :param as_of:
+        Optional :class:`datetime.date`; only entries effective on or before
+        it are included.
+    """
+    meta = LedgerEntry._meta
+    table = connection.ops.quote_name(meta.db_table)
+    debit_col = connection.ops.quote_name(
+        meta.get_field('debit_account').column)
+    credit_col = connection.ops.quote_name(
+        meta.get_field('credit_account').column)
+    amount_col = connection.ops.quote_name(meta.get_field('amount').column)
+    date_col = connection.ops.quote_name(
+        meta.get_field('effective_date').column)
+
+    where = ''
+    params = []
+    if as_of is not None:
+        where = ' WHERE %s <= %%s' % date_col
+        as_of_db = meta.get_field('effective_date').get_db_prep_value(
+            as_of, connection)
+        params = [as_of_db, as_of_db]
+
+    sql = (
+        "SELECT acct, SUM(dr), SUM(cr) FROM ("
+        "SELECT %(debit)s AS acct, %(amount)s AS dr, 0 AS cr "
+        "FROM %(table)s%(where)s "
+        "UNION ALL "
+        "SELECT %(credit)s AS acct, 0 AS dr, %(amount)s AS cr "
+        "FROM %(table)s%(where)s"
+        ") sides GROUP BY acct" % {
+            'debit': debit_col, 'credit': credit_col, 'amount': amount_col,
+            'table': table, 'where': where})
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        sums = dict((acct, (_to_decimal(dr), _to_decimal(cr)))
+                    for acct, dr, cr in cursor.fetchall())
+
+    # One unfiltered query rather than an IN list of every account, which
+    # could exceed the database's limit on query parameters;
+    # select_related so that str(account) doesn't query per row
+    accounts = dict((acct.pk, acct) for acct in
+                    LedgerAccount.objects.select_related('member').iterator()
+                    if acct.pk in sums)
+    rows = [TrialBalanceRow(accounts[pk], dr, cr)
+            for pk, (dr, cr) in sorted(sums.items())]
+    return TrialBalance(rows, as_of)
+
+
+class AccountNode(object):
+    """One level of the GnuCash account tree built by
+    :py:func:`chart_of_accounts`, with the totals of every
+    :py:class:`LedgerAccount` at or below it.
+
+    :param name: last component of :py:attr:`path`.
+    :param path: colon-separated GnuCash account path; empty for the root.
+    :param children: :class:`collections.OrderedDict` mapping names to
+        child nodes, in name order.
+    :param debits: sum of the debit totals.
+    :param credits: sum of the credit totals.
+    :param accounts: number of ledger accounts.
+    :param account_types: set of their
+        :py:attr:`LedgerAccount.account_type` values.
+    """
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.children = OrderedDict()
+        self.debits = Decimal('0.00')
+        self.credits = Decimal('0.00')
+        self.accounts = 0
+        self.account_types = set()
+
+    def __str__(self):
+        return self.path
+
+    def _get_balance(self):
+        """Debits minus credits, like :py:attr:`LedgerAccount.balance`."""
+        return self.debits - self.credits
+    balance = property(_get_balance)
+
+    def _get_account_balance(self):
+        """Normal-sign balance, like
+        :py:attr:`LedgerAccount.account_balance`, or None if the subtree
+        mixes debit and credit accounts."""
+        signs = set(t < 0 for t in self.account_types)
+        if signs == set([True]):
+            return self.balance
+        elif signs == set([False]):
+            return -self.balance
+        return None
+    account_balance = property(_get_account_balance)
+
+    def find(self, path):
+        """Returns the node for *path* below this one, or None."""
+        node = self
+        for name in path.split(':') if path else []:
+            node = node.children.get(name)
+            if node is None:
+                return None
+        return node
+
+    def walk(self, depth=0):
+        """Yields (depth, node) for this node and everything below it,
+        parents before children."""
+        yield depth, self
+        for child in self.children.values():
+            for item in child.walk(depth + 1):
+                yield item
+
+    def as_dict(self):
+        """Nested dict of this subtree, e.g. for JSON."""
+        balance = self.account_balance
+        return OrderedDict([
+            ('name', self.name),
+            ('path', self.path),
+            ('accounts', self.accounts),
+            ('debits', str(self.debits)),
+            ('credits', str(self.credits)),
+            ('account_balance', None if balance is None else str(balance)),
+            ('children', [c.as_dict() for c in self.children.values()]),
+        ])
+
+
+def account_path(gnucash_account):
+    """Tree path of an account; accounts without a ``gnucash_account`` are
+    member accounts, filed under
+    :py:data:`accounting.gnucash.GNUCASH_MEMBER_ACCOUNT_PREFIX`."""
+    return gnucash_account or GNUCASH_MEMBER_ACCOUNT_PREFIX
+
+
+def accounts_under(path, exact=False):
+    """Returns a :class:`django.db.models.query.QuerySet` of the
+    :py:class:`LedgerAccount` instances at or, unless *exact*, below
+    *path*."""
+    q = Q(gnucash_account=path)
+    if not exact:
+        q |= Q(gnucash_account__startswith=path + ':')
+    member = GNUCASH_MEMBER_ACCOUNT_PREFIX
+    if path == member or (not exact and member.startswith(path + ':')):
+        q |= Q(gnucash_account='')
+    return LedgerAccount.objects.filter(q)
+
+
+def chart_of_accounts(path=None):
+    """Builds the GnuCash account tree from
+    :py:attr:`LedgerAccount.gnucash_account` paths, with the stored totals
+    rolled up to every level.
+
+    Totals come from one query grouped by path; the rollup is done in
+    memory, so the cost depends on the number of distinct paths rather
+    than the number of accounts.
+
+    :param path: optional path to limit the tree to.
+    :return: the root :py:class:`AccountNode`.
+
+    >>> chart_of_accounts().find('Liabilities:Member Accounts').credits
+    Decimal('1234.00')
+    """
+    qs = LedgerAccount.objects.all() if not path else accounts_under(path)
+    rows = qs.order_by().values('gnucash_account', 'account_type').annotate(
+        debits=Sum('debit_total'), credits=Sum('credit_total'),
+        accounts=Count('id'))
+
+    root = AccountNode('', '')
+    for row in rows:
+        debits = _to_decimal(row['debits'] or 0)
+        credits = _to_decimal(row['credits'] or 0)
+        nodes = [root]
+        names = account_path(row['gnucash_account']).split(':')
+        for i, name in enumerate(names):
+            node = nodes[-1].children.get(name)
+            if node is None:
+                node = AccountNode(name, ':'.join(names[:i + 1]))
+                nodes[-1].children[name] = node
+            nodes.append(node)
+        for node in nodes:
+            node.debits += debits
+            node.credits += credits
+            node.accounts += row['accounts']
+            node.account_types.add(row['account_type'])
+
+    for depth, node in root.walk():
+        node.children = OrderedDict(sorted(node.children.items()))
+    return root
+
+
+class StatementRow(namedtuple('StatementRow',
+                              ['entry_id', 'effective_date', 'details',
+                               'net', 'balance', 'account_balance'])):
+    """One :py:class:`LedgerEntry` on an account statement.
+
+    :param net: :py:meth:`LedgerEntry.account_net` for the account.
+    :param balance: running :py:attr:`LedgerAccount.balance` after this
+        entry.
+    :param account_balance: running
+        :py:attr:`LedgerAccount.account_balance` after this entry.
+    """
+    __slots__ = ()
+
+
+def supports_window_functions(conn=connection):
+    """True if the database can compute ``SUM(...) OVER (...)``."""
+    if conn.vendor in ('postgresql', 'oracle'):
+        return True
+    if conn.vendor == 'sqlite':
+        return sqlite3.sqlite_version_info >= (3, 25, 0)
+    if conn.vendor == 'mysql':
+        return conn.mysql_version >= (8, 0)
+    return False
+
+
+def account_statement(account, start=None, end=None, chunk_size=2000):
+    """Yields the :py:class:`StatementRow` of every entry on *account*, in
+    :py:meth:`LedgerAccount.get_account_transactions` order.
+
+    Signed amounts, and where the database supports window functions the
+    running balance, are computed in SQL.  Entries are read in chunks of
+    *chunk_size*, each picking up after the last row of the previous one,
+    so memory use does not depend on the number of entries.
+
+    :param start: optional :class:`datetime.date` of the first entry; the
+        running balance starts from the balance at the end of the previous
+        day.
+    :param end: optional :class:`datetime.date` of the last entry.
+    """
+    meta = LedgerEntry._meta
+    qn = connection.ops.quote_name
+    cols = dict((name, qn(meta.get_field(name).column))
+                for name in ('id', 'effective_date', 'created_date',
+                             'details', 'debit_account', 'credit_account',
+                             'amount'))
+    date_field = meta.get_field('effective_date')
+    created_field = meta.get_field('created_date')
+
+    net = ("(CASE WHEN %(debit_account)s = %%s THEN %(amount)s ELSE 0 END - "
+           "CASE WHEN %(credit_account)s = %%s THEN %(amount)s ELSE 0 END)"
+           % cols)
+    order = "%(effective_date)s, %(created_date)s, %(id)s" % cols
+    window = supports_window_functions()
+    if window:
+        running = "SUM(%s) OVER (ORDER BY %s ROWS UNBOUNDED PRECEDING)" % (
+            net, order)
+    else:
+        # Summed up below instead
+        running = "0"
+
+    where = ["(%(debit_account)s = %%s OR %(credit_account)s = %%s)" % cols]
+    where_params = [account.pk, account.pk]
+    carry = Decimal('0.00')
+    if start is not None:
+        where.append("%(effective_date)s >= %%s" % cols)
+        where_params.append(date_field.get_db_prep_value(start, connection))
+        carry = account.get_balance_as_of(start - timedelta(days=1))
+    if end is not None:
+        where.append("%(effective_date)s <= %%s" % cols)
+        where_params.append(date_field.get_db_prep_value(end, connection))
+    select_params = [account.pk, account.pk] * (2 if window else 1)
+
+    sign = 1 if account.account_type < 0 else -1
+    after = None
+    while True:
+        clauses = list(where)
+        params = select_params + where_params
+        if after is not None:
+            # Strictly after the last row of the previous chunk
+            clauses.append(
+                "(%(effective_date)s > %%s OR (%(effective_date)s = %%s AND "
+                "(%(created_date)s > %%s OR (%(created_date)s = %%s AND "
+                "%(id)s > %%s))))" % cols)
+            date, created, pk = after
+            date = date_field.get_db_prep_value(date, connection)
+            created = created_field.get_db_prep_value(created, connection)
+            params = params + [date, date, created, created, pk]
+
+        sql = ("SELECT %s, %s, %s, %s, %s, %s FROM %s WHERE %s ORDER BY %s "
+               "LIMIT %d" % (cols['id'], cols['effective_date'],
+                             cols['created_date'], cols['details'], net,
+                             running, qn(meta.db_table),
+                             ' AND '.join(clauses), order, chunk_size))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+
+        balance = carry
+        for pk, date, created, details, amount, total in rows:
+            amount = _to_decimal(amount)
+            if window:
+                balance = carry + _to_decimal(total)
+            else:
+                balance += amount
+            yield StatementRow(pk, date, details, amount, balance,
+                               sign * balance)
+        if len(rows) < chunk_size:
+            return
+        carry = balance
+        after = rows[-1][1], rows[-1][2], rows[-1][0]
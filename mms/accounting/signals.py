@@ -0,0 +1,8 @@
+from django.dispatch import Signal
+
+#: Sent whenever the stored running totals of one or more
+#: :py:class:`accounting.models.LedgerAccount` instances change, whether by
+#: saving or deleting a single :py:class:`accounting.models.LedgerEntry`,
+#: a bulk posting, or a rebuild.  ``accounts`` is a list of the affected
+#: account primary keys.
+totals_changed = Signal(providing_args=['accounts'])
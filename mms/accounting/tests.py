@@ -1,3 +1,783 @@
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.core.cache import cache
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from accounting.models import LedgerAccount, LedgerEntry, BalanceSnapshot, \
+    ExportWatermark, LedgerEntryRevision
+from accounting.reports import account_statement, chart_of_accounts, \
+    trial_balance
+from accounting import gnucash, reports
+from accounting.cache import BalanceCache
+from accounting.pagination import KeysetPaginator, LargeTablePaginator
+from instrumentation.testing import QueryBudgetMixin
+from members.models import Member
+from datetime import date
+import io
+import json
+from decimal import Decimal
 
-# Create your tests here.
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class LedgerAccountTotalsTestCase(TestCase):
+    def setUp(self):
+        self.asset = LedgerAccount.objects.create(
+            gnucash_account="Assets:Checking",
+            account_type=LedgerAccount.TYPE_ASSET,
+        )
+        self.income = LedgerAccount.objects.create(
+            gnucash_account="Income:Member Dues:Full",
+            account_type=LedgerAccount.TYPE_INCOME,
+        )
+        self.liability = LedgerAccount.objects.create(
+            gnucash_account="Liability:Member Accounts",
+            account_type=LedgerAccount.TYPE_LIABILITY,
+        )
+
+    def reload(self, acct):
+        return LedgerAccount.objects.get(pk=acct.pk)
+
+    def test_adjust_totals_groups_updates(self):
+        accounts = [LedgerAccount.objects.create(
+            account_type=LedgerAccount.TYPE_LIABILITY) for i in range(5)]
+        credits = dict((a.pk, Decimal('10.00')) for a in accounts)
+        credits[self.income.pk] = Decimal('20.00')
+        with CaptureQueriesContext(connection) as ctx:
+            LedgerAccount.objects.adjust_totals(
+                {self.asset.pk: Decimal('70.00')}, credits)
+        updates = [q for q in ctx.captured_queries
+                   if 'UPDATE "accounting_ledgeraccount"' in q['sql']]
+        self.assertEqual(len(updates), 3)
+        for acct in accounts:
+            self.assertEqual(self.reload(acct).credits, Decimal('10.00'))
+        self.assertEqual(self.reload(self.income).credits, Decimal('20.00'))
+        self.assertEqual(self.reload(self.asset).debits, Decimal('70.00'))
+
+    def test_create(self):
+        LedgerEntry.objects.create(debit_account=self.asset,
+                                   credit_account=self.income,
+                                   amount="50.00", details="dues")
+        self.assertEqual(self.asset.debits, Decimal('50.00'))
+        self.assertEqual(self.income.credits, Decimal('50.00'))
+        self.assertEqual(self.reload(self.asset).balance, Decimal('50.00'))
+        self.assertEqual(self.reload(self.income).account_balance,
+                         Decimal('50.00'))
+
+    def test_edit_amount_and_account(self):
+        txn = LedgerEntry.objects.create(debit_account=self.asset,
+                                         credit_account=self.income,
+                                         amount="50.00", details="dues")
+        txn.amount = Decimal('20.00')
+        txn.credit_account = self.liability
+        txn.save()
+        self.assertEqual(self.reload(self.asset).debits, Decimal('20.00'))
+        self.assertEqual(self.reload(self.income).credits, Decimal('0.00'))
+        self.assertEqual(self.reload(self.liability).credits,
+                         Decimal('20.00'))
+
+    def test_delete(self):
+        txn = LedgerEntry.objects.create(debit_account=self.asset,
+                                         credit_account=self.income,
+                                         amount="50.00", details="dues")
+        LedgerEntry.objects.create(debit_account=self.asset,
+                                   credit_account=self.income,
+                                   amount="10.00", details="dues")
+        txn.delete()
+        self.assertEqual(self.reload(self.asset).debits, Decimal('10.00'))
+        LedgerEntry.objects.all().delete()
+        self.assertEqual(self.reload(self.asset).debits, Decimal('0.00'))
+        self.assertEqual(self.reload(self.income).credits, Decimal('0.00'))
+
+    def test_stale_save_keeps_totals(self):
+        stale = self.reload(self.income)
+        LedgerEntry.objects.create(debit_account=self.asset,
+                                   credit_account=self.income,
+                                   amount="10.00", details="dues")
+        stale.gnucash_account = "Income:Dues"
+        stale.save()
+        income = self.reload(self.income)
+        self.assertEqual(income.gnucash_account, "Income:Dues")
+        self.assertEqual(income.credits, Decimal('10.00'))
+        stale.save(update_fields=['credit_total'])
+        self.assertEqual(self.reload(self.income).credits, Decimal('10.00'))
+        self.assertEqual(LedgerAccount.objects.verify_balances(), [])
+
+    def test_bulk_update_refused(self):
+        LedgerEntry.objects.create(debit_account=self.asset,
+                                   credit_account=self.income,
+                                   amount="10.00", details="dues")
+        with self.assertRaises(TypeError):
+            LedgerEntry.objects.update(amount=Decimal('20.00'))
+        with self.assertRaises(TypeError):
+            LedgerEntry.objects.filter(details="dues").update(details="x")
+        self.assertEqual(self.reload(self.asset).debits, Decimal('10.00'))
+
+    def test_verify_and_rebuild(self):
+        LedgerEntry.objects.create(debit_account=self.asset,
+                                   credit_account=self.income,
+                                   amount="50.00", details="dues")
+        self.assertEqual(LedgerAccount.objects.verify_balances(), [])
+
+        LedgerAccount.objects.filter(pk=self.asset.pk).update(
+            debit_total=Decimal('99.00'))
+        drift = LedgerAccount.objects.verify_balances()
+        self.assertEqual(len(drift), 1)
+        self.assertEqual(drift[0].account, self.asset)
+        self.assertEqual(drift[0].stored_debits, Decimal('99.00'))
+        self.assertEqual(drift[0].debits, Decimal('50.00'))
+
+        self.assertEqual(LedgerAccount.objects.rebuild_balances(), 1)
+        self.assertEqual(LedgerAccount.objects.verify_balances(), [])
+        self.assertEqual(self.reload(self.asset).debits, Decimal('50.00'))
+
+
+class BalanceSnapshotTestCase(TestCase):
+    def setUp(self):
+        self.asset = LedgerAccount.objects.create(
+            gnucash_account="Assets:Checking",
+            account_type=LedgerAccount.TYPE_ASSET,
+        )
+        self.income = LedgerAccount.objects.create(
+            gnucash_account="Income:Member Dues:Full",
+            account_type=LedgerAccount.TYPE_INCOME,
+        )
+        for day, amount in ((date(2015, 1, 15), "50.00"),
+                            (date(2015, 2, 15), "30.00"),
+                            (date(2015, 3, 15), "20.00")):
+            LedgerEntry.objects.create(effective_date=day,
+                                       debit_account=self.asset,
+                                       credit_account=self.income,
+                                       amount=amount, details="dues")
+
+    def test_as_of_without_snapshots(self):
+        self.assertEqual(self.asset.get_balance_as_of(date(2014, 12, 31)),
+                         Decimal('0.00'))
+        self.assertEqual(self.asset.get_balance_as_of(date(2015, 2, 15)),
+                         Decimal('80.00'))
+        self.assertEqual(
+            self.income.get_account_balance_as_of(date(2015, 3, 31)),
+            Decimal('100.00'))
+
+    def test_close_period(self):
+        self.assertEqual(
+            BalanceSnapshot.objects.close_period(date(2015, 1, 31)), 2)
+        self.assertEqual(
+            BalanceSnapshot.objects.close_period(date(2015, 2, 28)), 2)
+        snap = BalanceSnapshot.objects.get(account=self.asset,
+                                           period_end=date(2015, 2, 28))
+        self.assertEqual(snap.debits, Decimal('80.00'))
+        self.assertEqual(snap.credits, Decimal('0.00'))
+        self.assertEqual(self.asset.get_balance_as_of(date(2015, 3, 31)),
+                         Decimal('100.00'))
+        self.assertEqual(self.income.get_balance_as_of(date(2015, 2, 28)),
+                         Decimal('-80.00'))
+
+    def test_as_of_uses_snapshot(self):
+        BalanceSnapshot.objects.close_period(date(2015, 2, 28))
+        # Tamper with the snapshot to prove it is used as the start point
+        BalanceSnapshot.objects.filter(account=self.asset).update(
+            debits=Decimal('1000.00'))
+        self.assertEqual(self.asset.get_balance_as_of(date(2015, 3, 31)),
+                         Decimal('1020.00'))
+        self.assertEqual(self.asset.get_balance_as_of(date(2015, 1, 31)),
+                         Decimal('50.00'))
+
+    def test_backdated_entry_invalidates(self):
+        BalanceSnapshot.objects.close_period(date(2015, 1, 31))
+        BalanceSnapshot.objects.close_period(date(2015, 2, 28))
+        LedgerEntry.objects.create(effective_date=date(2015, 2, 1),
+                                   debit_account=self.asset,
+                                   credit_account=self.income,
+                                   amount="5.00", details="late")
+        self.assertEqual(
+            list(self.asset.snapshots.values_list('period_end', flat=True)),
+            [date(2015, 1, 31)])
+        self.assertEqual(self.asset.get_balance_as_of(date(2015, 2, 28)),
+                         Decimal('85.00'))
+
+    def test_deleted_entry_invalidates(self):
+        BalanceSnapshot.objects.close_period(date(2015, 1, 31))
+        LedgerEntry.objects.filter(effective_date=date(2015, 1, 15)).delete()
+        self.assertEqual(BalanceSnapshot.objects.count(), 0)
+        self.assertEqual(self.asset.get_balance_as_of(date(2015, 1, 31)),
+                         Decimal('0.00'))
+
+
+class TrialBalanceTestCase(TestCase):
+    def setUp(self):
+        self.asset = LedgerAccount.objects.create(
+            gnucash_account="Assets:Checking",
+            account_type=LedgerAccount.TYPE_ASSET,
+        )
+        self.income = LedgerAccount.objects.create(
+            gnucash_account="Income:Member Dues:Full",
+            account_type=LedgerAccount.TYPE_INCOME,
+        )
+        self.liability = LedgerAccount.objects.create(
+            gnucash_account="Liability:Member Accounts",
+            account_type=LedgerAccount.TYPE_LIABILITY,
+        )
+        LedgerEntry.objects.create(effective_date=date(2015, 1, 1),
+                                   debit_account=self.liability,
+                                   credit_account=self.income,
+                                   amount="50.00", details="dues")
+        LedgerEntry.objects.create(effective_date=date(2015, 2, 1),
+                                   debit_account=self.asset,
+                                   credit_account=self.liability,
+                                   amount="30.25", details="payment")
+
+    def test_trial_balance(self):
+        with self.assertNumQueries(2):
+            tb = trial_balance()
+            rows = dict((r.account.pk, r) for r in tb.rows)
+        self.assertTrue(tb.is_balanced)
+        self.assertEqual(tb.debits, Decimal('80.25'))
+        self.assertEqual(tb.credits, Decimal('80.25'))
+        self.assertEqual(rows[self.liability.pk].debits, Decimal('50.00'))
+        self.assertEqual(rows[self.liability.pk].credits, Decimal('30.25'))
+        self.assertEqual(rows[self.liability.pk].account_balance,
+                         Decimal('-19.75'))
+        self.assertEqual(rows[self.asset.pk].account_balance,
+                         Decimal('30.25'))
+
+        types = tb.type_totals
+        self.assertEqual(types[LedgerAccount.TYPE_INCOME]['account_balance'],
+                         Decimal('50.00'))
+        self.assertEqual(types[LedgerAccount.TYPE_EXPENSE]['debits'],
+                         Decimal('0.00'))
+
+    def test_trial_balance_as_of(self):
+        tb = trial_balance(date(2015, 1, 31))
+        self.assertTrue(tb.is_balanced)
+        self.assertEqual(tb.debits, Decimal('50.00'))
+        self.assertEqual(len(tb.rows), 2)
+
+    def test_many_accounts(self):
+        # More accounts than SQLite's historic 999 query parameters
+        LedgerAccount.objects.bulk_create([
+            LedgerAccount(account_type=LedgerAccount.TYPE_LIABILITY)
+            for i in range(1100)])
+        LedgerEntry.objects.bulk_post([
+            LedgerEntry(debit_account_id=self.asset.pk,
+                        credit_account_id=pk, amount="1.00",
+                        details="payment")
+            for pk in LedgerAccount.objects.filter(
+                gnucash_account='').values_list('pk', flat=True)])
+        with self.assertNumQueries(2):
+            tb = trial_balance()
+        self.assertEqual(len(tb.rows), 1103)
+        self.assertTrue(tb.is_balanced)
+
+
+class LedgerAccountAdminTestCase(TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+        self.income = LedgerAccount.objects.create(
+            gnucash_account="Income:Member Dues:Full",
+            account_type=LedgerAccount.TYPE_INCOME,
+        )
+
+    def add_accounts(self, count):
+        for i in range(count):
+            acct = LedgerAccount.objects.create(
+                account_type=LedgerAccount.TYPE_LIABILITY)
+            LedgerEntry.objects.create(debit_account=acct,
+                                       credit_account=self.income,
+                                       amount="10.00", details="dues")
+
+    def changelist_queries(self, params=None):
+        url = reverse('admin:accounting_ledgeraccount_changelist')
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, params or {})
+        self.assertEqual(response.status_code, 200)
+        return len(ctx)
+
+    def test_changelist_query_count_is_constant(self):
+        self.add_accounts(2)
+        small = self.changelist_queries()
+        self.add_accounts(10)
+        self.assertEqual(self.changelist_queries(), small)
+
+    def test_changelist_sort_by_balance(self):
+        self.add_accounts(2)
+        url = reverse('admin:accounting_ledgeraccount_changelist')
+        response = self.client.get(url, {'o': '2'})
+        self.assertEqual(
+            [a.annotated_balance for a in response.context['cl'].result_list],
+            [Decimal('-20.00'), Decimal('10.00'), Decimal('10.00')])
+        response = self.client.get(url, {'o': '-4'})
+        self.assertEqual(
+            [a.annotated_account_balance
+             for a in response.context['cl'].result_list],
+            [Decimal('20.00'), Decimal('-10.00'), Decimal('-10.00')])
+
+
+class LedgerEntryAdminTestCase(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+
+    def test_changelist_query_budget(self):
+        income = LedgerAccount.objects.create(
+            gnucash_account="Income:Member Dues:Full",
+            account_type=LedgerAccount.TYPE_INCOME,
+        )
+        for i in range(20):
+            LedgerEntry.objects.create(
+                debit_account=LedgerAccount.objects.create(
+                    account_type=LedgerAccount.TYPE_LIABILITY),
+                credit_account=income, amount="10.00", details="dues")
+        url = reverse('admin:accounting_ledgerentry_changelist')
+        with self.assertQueryBudget(8):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+
+class AccountStatementTestCase(TestCase):
+    def setUp(self):
+        self.member = LedgerAccount.objects.create(
+            account_type=LedgerAccount.TYPE_LIABILITY)
+        self.income = LedgerAccount.objects.create(
+            gnucash_account="Income:Member Dues:Full",
+            account_type=LedgerAccount.TYPE_INCOME)
+        self.bank = LedgerAccount.objects.create(
+            gnucash_account="Assets:Bank",
+            account_type=LedgerAccount.TYPE_ASSET)
+        for day in (1, 2, 2, 3, 5, 8, 13):
+            LedgerEntry.objects.create(
+                debit_account=self.member, credit_account=self.income,
+                amount="10.00", details="dues",
+                effective_date=date(2015, 3, day))
+            if day % 2:
+                LedgerEntry.objects.create(
+                    debit_account=self.bank, credit_account=self.member,
+                    amount="15.00", details="payment",
+                    effective_date=date(2015, 3, day))
+        LedgerEntry.objects.create(debit_account=self.bank,
+                                   credit_account=self.income,
+                                   amount="99.00", details="other")
+
+    def expected(self, start=None, end=None):
+        balance = 0
+        rows = []
+        for txn in self.member.get_account_transactions():
+            balance += txn.account_net(self.member)
+            if (start is None or txn.effective_date >= start) and \
+                    (end is None or txn.effective_date <= end):
+                rows.append((txn.pk, txn.account_net(self.member), balance))
+        return rows
+
+    def check(self, **kwargs):
+        for chunk_size in (1, 2, 3, 100):
+            rows = list(account_statement(self.member, chunk_size=chunk_size,
+                                          **kwargs))
+            self.assertEqual([(r.entry_id, r.net, r.balance) for r in rows],
+                             self.expected(**kwargs))
+            for r in rows:
+                self.assertEqual(r.account_balance, -r.balance)
+
+    def test_statement(self):
+        self.check()
+        self.check(start=date(2015, 3, 3), end=date(2015, 3, 8))
+
+    def test_statement_without_window_functions(self):
+        with mock.patch.object(reports, 'supports_window_functions',
+                               return_value=False):
+            self.check()
+            self.check(start=date(2015, 3, 3))
+
+    def test_views(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+        url = reverse('account-statement', args=[self.member.pk, 'csv'])
+        response = self.client.get(url, {'start': '2015-03-13'})
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines, [
+            'entry,effective_date,details,amount,balance',
+            '%d,2015-03-13,dues,10.00,-25.00' % self.expected()[-2][0],
+            '%d,2015-03-13,payment,-15.00,-10.00' % self.expected()[-1][0],
+        ])
+
+        url = reverse('account-statement', args=[self.member.pk, 'json'])
+        response = self.client.get(url)
+        rows = json.loads(b''.join(response.streaming_content).decode())
+        self.assertEqual(len(rows), 11)
+        self.assertEqual(rows[-1]['balance'], '-10.00')
+
+        self.assertEqual(self.client.get(url, {'end': '2015-02-30'})
+                         .status_code, 400)
+
+
+class PaginationTestCase(TestCase):
+    def setUp(self):
+        self.member = LedgerAccount.objects.create(
+            account_type=LedgerAccount.TYPE_LIABILITY)
+        income = LedgerAccount.objects.create(
+            gnucash_account="Income:Member Dues:Full",
+            account_type=LedgerAccount.TYPE_INCOME)
+        for day in (5, 1, 3, 3, 3, 2, 9, 1):
+            LedgerEntry.objects.create(
+                debit_account=self.member, credit_account=income,
+                amount="10.00", details="dues",
+                effective_date=date(2015, 3, day))
+        self.expected = list(self.member.get_account_transactions())
+
+    def test_keyset_pages(self):
+        for ordering in [('effective_date', 'created_date', 'id'),
+                         ('-effective_date', '-created_date', '-id')]:
+            paginator = KeysetPaginator(
+                self.member.get_account_transactions(), 3, ordering)
+            seen = []
+            cursor = None
+            while True:
+                page = paginator.page(cursor)
+                seen.extend(page)
+                if not page.has_next():
+                    break
+                cursor = page.next_cursor
+            expected = self.expected
+            if ordering[0].startswith('-'):
+                expected = expected[::-1]
+            self.assertEqual(seen, expected)
+
+        with self.assertRaises(ValueError):
+            paginator.page('bogus')
+
+    def test_large_table_paginator(self):
+        qs = LedgerEntry.objects.order_by('-effective_date', '-created_date',
+                                          '-id')
+        paginator = LargeTablePaginator(qs, 3)
+        self.assertEqual(paginator.count, 8)
+        self.assertFalse(paginator.approximate)
+        self.assertEqual(paginator.page(3).object_list, list(qs)[6:])
+
+        with mock.patch.object(LargeTablePaginator, 'threshold', 5):
+            paginator = LargeTablePaginator(qs, 3)
+            self.assertEqual(paginator.count, 8)
+            self.assertTrue(paginator.approximate)
+            self.assertEqual(paginator.page(2).object_list, list(qs)[3:6])
+            # Filtered listings are always counted
+            paginator = LargeTablePaginator(qs.filter(amount=10), 3)
+            self.assertEqual(paginator.count, 8)
+            self.assertFalse(paginator.approximate)
+
+    def test_entries_view(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+        url = reverse('account-entries', args=[self.member.pk])
+        with mock.patch('accounting.views.ENTRIES_PER_PAGE', 5):
+            first = json.loads(self.client.get(url).content.decode())
+            second = json.loads(self.client.get(
+                url, {'cursor': first['next']}).content.decode())
+        self.assertEqual([e['entry'] for e in first['entries'] +
+                          second['entries']],
+                         [txn.pk for txn in self.expected])
+        self.assertIsNone(second['next'])
+        self.assertEqual(self.client.get(url, {'cursor': 'x'}).status_code,
+                         400)
+
+
+class GnucashExportTestCase(TestCase):
+    def setUp(self):
+        self.bank = LedgerAccount.objects.create(
+            gnucash_account="Assets:Bank",
+            account_type=LedgerAccount.TYPE_ASSET)
+        self.member = LedgerAccount.objects.create(
+            account_type=LedgerAccount.TYPE_LIABILITY)
+        self.entries = [
+            LedgerEntry.objects.create(
+                debit_account=self.bank, credit_account=self.member,
+                amount=amount, details="payment %d" % i,
+                effective_date=date(2015, 3, i + 1))
+            for i, amount in enumerate(("10.00", "20.00", "30.00"))]
+
+    def export(self, **kwargs):
+        stream = io.StringIO()
+        result = gnucash.export(stream, lag=0, chunk_size=2, **kwargs)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(lines[0], ','.join(gnucash.COLUMNS))
+        return result, lines[1:]
+
+    def test_incremental(self):
+        result, lines = self.export()
+        self.assertEqual(result.entries, 3)
+        pk = self.entries[0].pk
+        self.assertEqual(lines[:2], [
+            '2015-03-01,mms-%d,%d,payment 0,Assets:Bank,10.00' % (pk, pk),
+            '2015-03-01,mms-%d,%d,payment 0,Liabilities:Member Accounts:'
+            'Account %d,-10.00' % (pk, pk, self.member.pk),
+        ])
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(ExportWatermark.objects.get(name='gnucash').entry_id,
+                         self.entries[2].pk)
+
+        # Nothing new
+        result, lines = self.export()
+        self.assertEqual((result.entries, lines), (0, []))
+
+        # One changed twice, one new, one new and changed
+        self.entries[0].details = "corrected"
+        self.entries[0].save()
+        self.entries[0].amount = "12.00"
+        self.entries[0].save()
+        new = LedgerEntry.objects.create(
+            debit_account=self.bank, credit_account=self.member,
+            amount="5.00", details="new")
+        new.amount = "6.00"
+        new.save()
+        result, lines = self.export()
+        self.assertEqual((result.entries, result.reversals), (2, 1))
+        revision = LedgerEntryRevision.objects.filter(entry_id=pk) \
+            .earliest('changed_date')
+        self.assertEqual(lines[:2], [
+            '2015-03-01,mms-%d-r%d,%d,Reversal: payment 0,Assets:Bank,'
+            '-10.00' % (pk, revision.pk, pk),
+            '2015-03-01,mms-%d-r%d,%d,Reversal: payment 0,Liabilities:'
+            'Member Accounts:Account %d,10.00' % (pk, revision.pk, pk,
+                                                  self.member.pk),
+        ])
+        self.assertEqual([line.split(',')[1] for line in lines[2::2]],
+                         ['mms-%d' % pk, 'mms-%d' % new.pk])
+        self.assertEqual(lines[2].split(',')[-1], '12.00')
+
+        # Deleted
+        self.entries[1].delete()
+        result, lines = self.export()
+        self.assertEqual((result.entries, result.reversals), (0, 1))
+        self.assertEqual([line.split(',')[-1] for line in lines],
+                         ['-20.00', '20.00'])
+        result, lines = self.export()
+        self.assertEqual((result.entries, result.reversals, lines),
+                         (0, 0, []))
+
+        # A full export leaves nothing to reverse
+        self.entries[2].details = "changed"
+        self.entries[2].save()
+        result, lines = self.export(full=True)
+        self.assertEqual((result.entries, result.reversals), (3, 0))
+        result, lines = self.export()
+        self.assertEqual((result.entries, result.reversals), (0, 0))
+
+    def test_deltas_add_up(self):
+        # Importing every delta gives the balances of the ledger
+        result, lines = self.export()
+        self.entries[0].amount = "15.00"
+        self.entries[0].save()
+        self.entries[1].delete()
+        lines += self.export()[1]
+        self.entries[0].delete()
+        LedgerEntry.objects.create(
+            debit_account=self.bank, credit_account=self.member,
+            amount="7.00", details="new")
+        lines += self.export()[1]
+
+        totals = {}
+        for line in lines:
+            account, amount = line.split(',')[-2:]
+            totals[account] = totals.get(account, 0) + Decimal(amount)
+        self.assertEqual(totals['Assets:Bank'],
+                         LedgerAccount.objects.get(pk=self.bank.pk).balance)
+        self.assertEqual(totals['Assets:Bank'], Decimal('37.00'))
+
+    def test_account_deleted(self):
+        self.export()
+        member = self.member.pk
+        self.member.delete()
+        self.assertEqual(LedgerEntryRevision.objects.filter(
+            credit_account_id=member, deleted=True).count(), 3)
+        result, lines = self.export()
+        self.assertEqual((result.entries, result.reversals), (0, 3))
+        self.assertEqual(
+            sorted(line.split(',')[-1] for line in lines[1::2]),
+            ['10.00', '20.00', '30.00'])
+        self.assertEqual(
+            set(line.split(',')[-2] for line in lines[1::2]),
+            set(['Liabilities:Member Accounts:Account %d' % member]))
+
+    def test_lag(self):
+        stream = io.StringIO()
+        result = gnucash.export(stream, name='lagged', lag=3600)
+        self.assertEqual(result.entries, 0)
+        self.assertIsNone(result.watermark.modified_date)
+
+
+class ChartOfAccountsTestCase(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        bank = LedgerAccount.objects.create(
+            gnucash_account="Assets:Bank",
+            account_type=LedgerAccount.TYPE_ASSET)
+        full = LedgerAccount.objects.create(
+            gnucash_account="Income:Member Dues:Full",
+            account_type=LedgerAccount.TYPE_INCOME)
+        starving = LedgerAccount.objects.create(
+            gnucash_account="Income:Member Dues:Starving",
+            account_type=LedgerAccount.TYPE_INCOME)
+        self.members = [LedgerAccount.objects.create(
+            account_type=LedgerAccount.TYPE_LIABILITY) for i in range(3)]
+        for member, dues in zip(self.members, (full, full, starving)):
+            LedgerEntry.objects.create(debit_account=member,
+                                       credit_account=dues,
+                                       amount="50.00", details="dues")
+            LedgerEntry.objects.create(debit_account=bank,
+                                       credit_account=member,
+                                       amount="20.00", details="payment")
+
+    def test_tree(self):
+        with self.assertQueryBudget(1):
+            root = chart_of_accounts()
+        self.assertEqual(list(root.children), ['Assets', 'Income',
+                                               'Liabilities'])
+        self.assertEqual(root.balance, Decimal('0.00'))
+        self.assertIsNone(root.account_balance)
+
+        dues = root.find('Income:Member Dues')
+        self.assertEqual(list(dues.children), ['Full', 'Starving'])
+        self.assertEqual(dues.account_balance, Decimal('150.00'))
+        self.assertEqual(dues.children['Full'].account_balance,
+                         Decimal('100.00'))
+
+        members = root.find('Liabilities:Member Accounts')
+        self.assertEqual(members.accounts, 3)
+        self.assertEqual(members.account_balance, Decimal('-90.00'))
+        self.assertEqual(root.find('Assets').account_balance,
+                         Decimal('60.00'))
+        self.assertIsNone(root.find('Assets:Nowhere'))
+
+    def test_subtree(self):
+        root = chart_of_accounts('Income')
+        self.assertEqual(list(root.children), ['Income'])
+        self.assertEqual(root.find('Income').accounts, 2)
+        self.assertEqual(
+            chart_of_accounts('Liabilities').find('Liabilities').accounts, 3)
+        self.assertEqual(chart_of_accounts('Inc').accounts, 0)
+
+    def test_view(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+        url = reverse('chart-of-accounts')
+        with mock.patch('accounting.views.ACCOUNTS_PER_PAGE', 2):
+            data = json.loads(self.client.get(
+                url, {'path': 'Liabilities:Member Accounts'}).content.decode())
+            self.assertEqual(data['tree']['account_balance'], '-90.00')
+            self.assertEqual([a['id'] for a in data['accounts']],
+                             [a.pk for a in self.members[:2]])
+            data = json.loads(self.client.get(url, {
+                'path': 'Liabilities:Member Accounts',
+                'cursor': data['next']}).content.decode())
+            self.assertEqual([a['id'] for a in data['accounts']],
+                             [self.members[2].pk])
+            self.assertIsNone(data['next'])
+        data = json.loads(self.client.get(url).content.decode())
+        self.assertEqual([c['name'] for c in data['tree']['children']],
+                         ['Assets', 'Income', 'Liabilities'])
+        self.assertEqual(self.client.get(url, {'path': 'Nope'}).status_code,
+                         404)
+
+
+class BalanceCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.cache = BalanceCache('default')
+        self.bank = LedgerAccount.objects.create(
+            gnucash_account="Assets:Bank",
+            account_type=LedgerAccount.TYPE_ASSET)
+        self.member = LedgerAccount.objects.create(
+            account_type=LedgerAccount.TYPE_LIABILITY)
+        LedgerEntry.objects.create(debit_account=self.bank,
+                                   credit_account=self.member,
+                                   amount="20.00", details="payment")
+        for target in ('accounting.cache.balance_cache',
+                       'members.models.balance_cache'):
+            patcher = mock.patch(target, self.cache)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_get_many(self):
+        pks = [self.bank.pk, self.member.pk, 999]
+        with self.assertNumQueries(1):
+            balances = self.cache.get_many(pks)
+        self.assertEqual(balances[self.bank.pk].account_balance,
+                         Decimal('20.00'))
+        self.assertEqual(balances[self.member.pk].account_balance,
+                         Decimal('20.00'))
+        self.assertNotIn(999, balances)
+        with self.assertNumQueries(1):
+            # The unknown account is looked up again
+            self.assertEqual(self.cache.get_many(pks), balances)
+        self.assertEqual(self.cache.stats,
+                         {'hits': 2, 'misses': 4, 'invalidations': 0})
+
+    def test_missing_versions_read_together(self):
+        pks = [self.bank.pk, self.member.pk, 999]
+        backend = self.cache.cache
+        with mock.patch.object(backend, 'get_many',
+                               wraps=backend.get_many) as get_many:
+            self.cache.get_many(pks)
+        # Versions, the versions just added, and the balances
+        self.assertEqual(get_many.call_count, 3)
+        self.assertEqual(sorted(get_many.call_args_list[1][0][0]),
+                         sorted(self.cache._version_key(pk) for pk in pks))
+
+    def test_invalidation(self):
+        self.cache.get_many([self.bank.pk, self.member.pk])
+        LedgerEntry.objects.create(debit_account=self.member,
+                                   credit_account=self.bank,
+                                   amount="5.00", details="refund")
+        self.assertEqual(self.cache.stats['invalidations'], 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.cache.get(self.member.pk).account_balance,
+                             Decimal('15.00'))
+
+        # Bulk postings and rebuilds bump the versions too
+        LedgerEntry.objects.bulk_post([LedgerEntry(
+            debit_account=self.member, credit_account=self.bank,
+            amount="5.00", details="refund")])
+        self.assertEqual(self.cache.get(self.member.pk).account_balance,
+                         Decimal('10.00'))
+        LedgerAccount.objects.filter(pk=self.member.pk).update(
+            debit_total=Decimal('0.00'))
+        LedgerAccount.objects.rebuild_balances()
+        self.assertEqual(self.cache.get(self.member.pk).account_balance,
+                         Decimal('10.00'))
+
+    def test_evicted_version(self):
+        self.cache.get(self.member.pk)
+        cache.delete(self.cache._version_key(self.member.pk))
+        LedgerAccount.objects.filter(pk=self.member.pk).update(
+            credit_total=Decimal('99.00'))
+        self.assertEqual(self.cache.get(self.member.pk).credits,
+                         Decimal('99.00'))
+
+    def test_member_balance(self):
+        member = Member.objects.create(name="Member", email="m@example.com",
+                                       account=self.member)
+        member = Member.objects.get(pk=member.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(member.balance, Decimal('20.00'))
+        # Only the member is loaded; the balance comes from the cache
+        with self.assertNumQueries(1):
+            self.assertEqual(Member.objects.get(pk=member.pk).balance,
+                             Decimal('20.00'))
+
+    def test_disabled(self):
+        disabled = BalanceCache(None)
+        with self.assertNumQueries(2):
+            disabled.get(self.member.pk)
+            disabled.get(self.member.pk)
+        self.assertEqual(disabled.stats['misses'], 2)
+
+        # Without a cache the member keeps its loaded account
+        member = Member.objects.create(name="Member", email="m@example.com",
+                                       account=self.member)
+        member = Member.objects.get(pk=member.pk)
+        with mock.patch('members.models.balance_cache', disabled), \
+                self.assertNumQueries(1):
+            for i in range(3):
+                self.assertEqual(member.balance, Decimal('20.00'))
+        self.assertEqual(disabled.stats['misses'], 2)
@@ -0,0 +1,11 @@
+from django.conf.urls import url
+
+from . import views
+
+urlpatterns = [
+    url(r'^chart\.json$', views.chart, name='chart-of-accounts'),
+    url(r'^accounts/(?P<pk>\d+)/statement\.(?P<format>csv|json)$',
+        views.statement, name='account-statement'),
+    url(r'^accounts/(?P<pk>\d+)/entries\.json$', views.entries,
+        name='account-entries'),
+]
@@ -1,3 +1,144 @@
-from django.shortcuts import render
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponseBadRequest, JsonResponse, \
+    StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.dateparse import parse_date
 
-# Create your views here.
+import csv
+import json
+
+from .models import LedgerAccount
+from .pagination import KeysetPaginator
+from .reports import account_statement, accounts_under, chart_of_accounts
+
+#: Entries per page of :py:func:`entries`.
+ENTRIES_PER_PAGE = 100
+#: Accounts per page of :py:func:`chart`.
+ACCOUNTS_PER_PAGE = 100
+
+
+class _Echo(object):
+    """File-like object that hands back what is written, so that
+    :func:`csv.writer` can feed a streaming response."""
+    def write(self, value):
+        return value
+
+
+def _csv_rows(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(['entry', 'effective_date', 'details', 'amount',
+                           'balance'])
+    for row in rows:
+        yield writer.writerow([row.entry_id, row.effective_date.isoformat(),
+                               row.details, row.net, row.account_balance])
+
+
+def _json_rows(rows):
+    yield '['
+    separator = ''
+    for row in rows:
+        yield separator + json.dumps({
+            'entry': row.entry_id,
+            'effective_date': row.effective_date.isoformat(),
+            'details': row.details,
+            'amount': str(row.net),
+            'balance': str(row.account_balance),
+        })
+        separator = ',\n'
+    yield ']\n'
+
+
+def _get_date(request, key):
+    value = request.GET.get(key)
+    if not value:
+        return None
+    date = parse_date(value)
+    if date is None:
+        raise ValueError(value)
+    return date
+
+
+@staff_member_required
+def statement(request, pk, format='csv'):
+    """Streams the statement of a :py:class:`LedgerAccount` as CSV or JSON,
+    with the running balance in the account's normal sign.
+
+    Accepts optional ``start`` and ``end`` dates (``YYYY-MM-DD``) in the
+    query string.
+    """
+    account = get_object_or_404(LedgerAccount, pk=pk)
+    try:
+        start = _get_date(request, 'start')
+        end = _get_date(request, 'end')
+    except ValueError:
+        return HttpResponseBadRequest("Dates must be YYYY-MM-DD")
+
+    rows = account_statement(account, start=start, end=end)
+    if format == 'json':
+        response = StreamingHttpResponse(_json_rows(rows),
+                                         content_type='application/json')
+    else:
+        response = StreamingHttpResponse(_csv_rows(rows),
+                                         content_type='text/csv')
+        response['Content-Disposition'] = \
+            'attachment; filename="statement-%d.csv"' % account.pk
+    return response
+
+
+@staff_member_required
+def entries(request, pk):
+    """One page of the entries of a :py:class:`LedgerAccount` as JSON, in
+    :py:meth:`LedgerAccount.get_account_transactions` order.
+
+    The ``next`` member of the response is the ``cursor`` query string
+    parameter for the following page, or null on the last page.
+    """
+    account = get_object_or_404(LedgerAccount, pk=pk)
+    paginator = KeysetPaginator(account.get_account_transactions(),
+                                ENTRIES_PER_PAGE,
+                                ('effective_date', 'created_date', 'id'))
+    try:
+        page = paginator.page(request.GET.get('cursor') or None)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid cursor")
+    return JsonResponse({
+        'entries': [{
+            'entry': txn.pk,
+            'effective_date': txn.effective_date.isoformat(),
+            'details': txn.details,
+            'amount': str(txn.account_net(account)),
+        } for txn in page],
+        'next': page.next_cursor,
+    })
+
+
+@staff_member_required
+def chart(request):
+    """The chart of accounts as JSON: the tree below the optional ``path``
+    query string parameter with rolled-up balances, and one page of the
+    :py:class:`LedgerAccount` instances at exactly that path.
+
+    The ``next`` member of the response is the ``cursor`` query string
+    parameter for the following page of accounts, or null on the last page.
+    """
+    path = request.GET.get('path', '')
+    node = chart_of_accounts(path).find(path)
+    if node is None:
+        return JsonResponse({'error': "No accounts under %s" % path},
+                            status=404)
+    paginator = KeysetPaginator(
+        accounts_under(path, exact=True).select_related('member'),
+        ACCOUNTS_PER_PAGE, ('id',))
+    try:
+        page = paginator.page(request.GET.get('cursor') or None)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid cursor")
+    return JsonResponse({
+        'tree': node.as_dict(),
+        'accounts': [{
+            'id': acct.pk,
+            'name': str(acct),
+            'account_balance': str(acct.account_balance),
+        } for acct in page],
+        'next': page.next_cursor,
+    })
@@ -0,0 +1,78 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, \
+    teardown_test_environment
+
+from benchmarks.suite import Suite
+from benchmarks.synthetic import Dataset, generate
+
+import django
+import json
+import platform
+import time
+
+
+class Command(BaseCommand):
+    help = ("Generates a synthetic dataset in a throwaway test database, "
+            "times the ledger, billing, Stripe posting and admin hot paths "
+            "and prints the results as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=1000)
+        parser.add_argument('--levels', type=int, default=4)
+        parser.add_argument('--entries', type=int, default=20000)
+        parser.add_argument('--charges', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--repeat', type=int, default=5,
+            help="Number of times each case runs.")
+        parser.add_argument(
+            '--sample', type=int, default=100,
+            help="Number of accounts used by the per-account cases.")
+        parser.add_argument(
+            '--case', dest='cases', action='append', choices=Suite.cases,
+            help="Case to run; may be given more than once.  Defaults to "
+                 "all of them.")
+        parser.add_argument(
+            '--output', default=None,
+            help="File to write the JSON results to, instead of stdout.")
+
+    def handle(self, *args, **options):
+        dataset = Dataset(members=options['members'],
+                          levels=options['levels'],
+                          entries=options['entries'],
+                          charges=options['charges'],
+                          seed=options['seed'])
+        if dataset.charges > dataset.members:
+            raise CommandError("Cannot have more charges than members")
+
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            start = time.time()
+            data = generate(dataset, stdout=self.stderr)
+            generated = time.time() - start
+            self.stderr.write("Generated in %.2fs; running cases" % generated)
+            results = Suite(data, sample=options['sample'],
+                            seed=dataset.seed).run(
+                repeat=options['repeat'], cases=options['cases'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report = json.dumps({
+            'dataset': dataset.as_dict(),
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+            },
+            'generate_seconds': generated,
+            'results': results,
+        }, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report + '\n')
+        else:
+            self.stdout.write(report)
@@ -0,0 +1,138 @@
+"""Timed benchmark cases for the ledger, billing, Stripe posting and admin
+hot paths.
+
+Each case is called :py:data:`repeat` times against a dataset from
+:py:mod:`benchmarks.synthetic`; cases that write to the database do so in
+a transaction that is rolled back, so every repetition starts from the
+same data.
+"""
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from accounting.models import LedgerAccount
+from members.billing import run_billing
+from members.forecast import forecast_billing
+from payments_stripe.models import Charge
+
+from decimal import Decimal
+import random
+import time
+
+#: Charges posted per :py:meth:`ChargeManager.post_successful` call, as
+#: the reconciler does.
+CHARGE_BATCH_SIZE = 100
+
+
+def _rolled_back(func):
+    def run(*args):
+        with transaction.atomic():
+            func(*args)
+            transaction.set_rollback(True)
+    return run
+
+
+def measure(func, repeat):
+    """Calls *func* *repeat* times.
+
+    :return: dict with the ``min``, ``median`` and ``mean`` wall-clock
+        seconds per call and the number of ``queries`` of the last call.
+    """
+    timings = []
+    for i in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            func()
+            timings.append(time.time() - start)
+    timings.sort()
+    return {
+        'repeat': repeat,
+        'min': timings[0],
+        'median': timings[len(timings) // 2],
+        'mean': sum(timings) / len(timings),
+        'queries': len(queries),
+    }
+
+
+class Suite(object):
+    """The benchmark cases, bound to a generated dataset.
+
+    :param data: as returned by :py:func:`benchmarks.synthetic.generate`.
+    :param sample: number of accounts used by the per-account cases.
+    """
+    def __init__(self, data, sample=100, seed=0):
+        rng = random.Random(seed)
+        accounts = data['accounts']
+        self.accounts = rng.sample(accounts, min(sample, len(accounts)))
+        User.objects.create_superuser('benchmark', 'bench@example.com',
+                                      'benchmark')
+        self.client = Client()
+        self.client.login(username='benchmark', password='benchmark')
+
+    def ledger_balance(self):
+        """:py:attr:`LedgerAccount.balance` of freshly loaded accounts."""
+        for pk in self.accounts:
+            LedgerAccount.objects.get(pk=pk).balance
+
+    def ledger_computed_balance(self):
+        """Balances aggregated from the entries, as a baseline for the
+        stored totals."""
+        LedgerAccount.objects.computed_totals(self.accounts)
+
+    def account_transactions(self):
+        """Full :py:meth:`LedgerAccount.get_account_transactions`
+        listings."""
+        for pk in self.accounts:
+            list(LedgerAccount(pk=pk).get_account_transactions())
+
+    @_rolled_back
+    def billing_run(self):
+        """:py:func:`members.billing.run_billing` up to today."""
+        run_billing(timezone.now().date())
+
+    def billing_forecast(self):
+        """:py:func:`members.forecast.forecast_billing` for two years."""
+        forecast_billing(24)
+
+    @_rolled_back
+    def charge_posting(self):
+        """Posting every successful charge, in reconciler-sized batches."""
+        charges = list(Charge.objects.filter(state=Charge.STATE_SUCCESSFUL)
+                       .order_by('pk'))
+        for i in range(0, len(charges), CHARGE_BATCH_SIZE):
+            Charge.objects.post_successful([
+                (c, [{'amount': c.amount, 'fee': Decimal('1.75'),
+                      'net': c.amount - Decimal('1.75')}])
+                for c in charges[i:i + CHARGE_BATCH_SIZE]])
+
+    def _admin(self, url):
+        response = self.client.get(url)
+        assert response.status_code == 200, response.status_code
+
+    def admin_members(self):
+        """Member changelist."""
+        self._admin('/admin/members/member/')
+
+    def admin_accounts(self):
+        """Ledger account changelist, sorted by balance."""
+        self._admin('/admin/accounting/ledgeraccount/?o=2')
+
+    def admin_entries(self):
+        """Ledger entry changelist."""
+        self._admin('/admin/accounting/ledgerentry/')
+
+    #: Case names, in the order they run.
+    cases = ['ledger_balance', 'ledger_computed_balance',
+             'account_transactions', 'billing_run', 'billing_forecast',
+             'charge_posting', 'admin_members', 'admin_accounts',
+             'admin_entries']
+
+    def run(self, repeat=5, cases=None):
+        """Runs the *cases* (by default all) and returns a dict of case
+        name to :py:func:`measure` result."""
+        results = {}
+        for name in cases or self.cases:
+            results[name] = measure(getattr(self, name), repeat)
+        return results
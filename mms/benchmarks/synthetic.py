@@ -0,0 +1,166 @@
+"""Generation of synthetic datasets for the benchmarks.
+
+Everything is inserted in bulk, in chunks, so that datasets with tens of
+thousands of members and millions of ledger entries can be built in
+reasonable time.  The same seed always gives the same dataset.
+"""
+from django.db import transaction
+from django.utils import timezone
+
+from accounting.models import LedgerAccount, LedgerEntry, PaymentMethod
+from members.models import Member, MembershipLevel
+from payments_stripe.models import Customer, Charge
+
+from datetime import timedelta
+from decimal import Decimal
+import os
+import random
+
+#: Prefix of the generated member accounts' GnuCash names.
+MEMBER_ACCOUNT_PREFIX = "Liabilities:Member Accounts:"
+
+
+class Dataset(object):
+    """Size of a synthetic dataset.
+
+    :param members: number of members.
+    :param levels: number of membership levels.
+    :param entries: number of ledger entries.
+    :param charges: number of successful, unposted Stripe charges.
+    :param seed: random seed.
+    """
+    def __init__(self, members=1000, levels=4, entries=20000, charges=500,
+                 seed=0):
+        self.members = members
+        self.levels = levels
+        self.entries = entries
+        self.charges = charges
+        self.seed = seed
+
+    def as_dict(self):
+        return {'members': self.members, 'levels': self.levels,
+                'entries': self.entries, 'charges': self.charges,
+                'seed': self.seed}
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _create_accounts(names, account_type, chunk_size):
+    """Bulk creates accounts and returns their primary keys in order;
+    ``bulk_create`` does not set them on every backend."""
+    for chunk in _chunks(names, chunk_size):
+        LedgerAccount.objects.bulk_create([
+            LedgerAccount(gnucash_account=name, account_type=account_type)
+            for name in chunk])
+    prefix = os.path.commonprefix(names)
+    pks = LedgerAccount.objects.filter(gnucash_account__startswith=prefix)
+    pks = dict(pks.values_list('gnucash_account', 'pk'))
+    return [pks[name] for name in names]
+
+
+def generate(dataset, chunk_size=10000, stdout=None):
+    """Fills the (empty) database with *dataset*.
+
+    :param stdout: optional stream for progress messages.
+    :return: dict with the ``accounts`` primary keys of the members.
+    """
+    rng = random.Random(dataset.seed)
+    today = timezone.now().date()
+
+    def progress(message):
+        if stdout is not None:
+            stdout.write(message)
+
+    with transaction.atomic():
+        bank = LedgerAccount.objects.create(
+            gnucash_account="Assets:Bank",
+            account_type=LedgerAccount.TYPE_ASSET)
+        method = PaymentMethod.objects.create(
+            name="Credit card", is_recurring=True, is_automated=True,
+            api=PaymentMethod.API_STRIPEIO,
+            revenue_account=LedgerAccount.objects.create(
+                gnucash_account="Assets:Stripe",
+                account_type=LedgerAccount.TYPE_ASSET),
+            fee_account=LedgerAccount.objects.create(
+                gnucash_account="Expenses:Bank Fees",
+                account_type=LedgerAccount.TYPE_EXPENSE))
+
+        levels = []
+        pers = [MembershipLevel.PER_MONTH, MembershipLevel.PER_QUARTER,
+                MembershipLevel.PER_YEAR]
+        for i in range(dataset.levels):
+            levels.append(MembershipLevel.objects.create(
+                name="Level %d" % i, cost=Decimal(25 + 10 * i),
+                per=pers[i % len(pers)], has_keyfob=True,
+                has_room_key=bool(i % 2), has_voting=True,
+                has_powertool_access=bool(i % 3),
+                account=LedgerAccount.objects.create(
+                    gnucash_account="Income:Dues:Level %d" % i,
+                    account_type=LedgerAccount.TYPE_INCOME)))
+
+    progress("Creating %d members" % dataset.members)
+    names = ["%s%06d" % (MEMBER_ACCOUNT_PREFIX, i)
+             for i in range(dataset.members)]
+    account_pks = _create_accounts(names, LedgerAccount.TYPE_LIABILITY,
+                                   chunk_size)
+    level_of = {}
+    members = []
+    for i, account_pk in enumerate(account_pks):
+        # Some members have lapsed and have no level
+        level = rng.choice(levels) if levels and rng.random() < 0.9 else None
+        level_of[account_pk] = level
+        members.append(Member(
+            name="Member %06d" % i, email="member%06d@example.com" % i,
+            account_id=account_pk,
+            membership_id=level.pk if level else None,
+            last_billed=today - timedelta(days=rng.randint(0, 120))))
+    for chunk in _chunks(members, chunk_size):
+        Member.objects.bulk_create(chunk)
+    Member.objects.update_next_bill_dates()
+
+    progress("Creating %d ledger entries" % dataset.entries)
+    remaining = dataset.entries
+    while remaining > 0 and account_pks:
+        entries = []
+        for i in range(min(chunk_size, remaining)):
+            account_pk = rng.choice(account_pks)
+            level = level_of[account_pk] or levels[0]
+            date = today - timedelta(days=rng.randint(0, 730))
+            if rng.random() < 0.5:
+                # Dues billed to the member
+                entries.append(LedgerEntry(
+                    debit_account_id=account_pk,
+                    credit_account_id=level.account_id,
+                    amount=level.cost, effective_date=date,
+                    details="Dues"))
+            else:
+                # Payment received from the member
+                entries.append(LedgerEntry(
+                    debit_account_id=bank.pk, credit_account_id=account_pk,
+                    amount=level.cost, effective_date=date,
+                    details="Payment"))
+        LedgerEntry.objects.bulk_create(entries)
+        remaining -= len(entries)
+    # Once at the end, rather than one update per account per chunk
+    LedgerAccount.objects.rebuild_balances()
+
+    progress("Creating %d charges" % dataset.charges)
+    member_pks = list(Member.objects.order_by('pk')
+                      .values_list('pk', flat=True)[:dataset.charges])
+    Customer.objects.bulk_create([
+        Customer(member_id=pk, stripe_id="cus_bench_%06d" % pk)
+        for pk in member_pks])
+    customer_pks = list(Customer.objects.order_by('pk')
+                        .values_list('pk', flat=True))
+    charges = [Charge(customer_id=pk, payment_method=method,
+                      stripe_id="ch_bench_%06d" % pk,
+                      amount=Decimal(rng.randint(2000, 10000)) / 100,
+                      state=Charge.STATE_SUCCESSFUL)
+               for pk in customer_pks]
+    for chunk in _chunks(charges, chunk_size):
+        Charge.objects.bulk_create(chunk)
+
+    return {'accounts': account_pks}
@@ -0,0 +1,24 @@
+from django.test import TestCase
+from accounting.models import LedgerAccount, LedgerEntry
+from benchmarks.suite import Suite
+from benchmarks.synthetic import Dataset, generate
+from members.models import Member
+from payments_stripe.models import Charge
+
+
+class BenchmarkTestCase(TestCase):
+    def test_small_run(self):
+        data = generate(Dataset(members=20, levels=3, entries=200,
+                                charges=5), chunk_size=50)
+        self.assertEqual(Member.objects.count(), 20)
+        self.assertEqual(LedgerEntry.objects.count(), 200)
+        self.assertEqual(LedgerAccount.objects.verify_balances(), [])
+
+        results = Suite(data, sample=5).run(repeat=2)
+        self.assertEqual(sorted(results), sorted(Suite.cases))
+        for result in results.values():
+            self.assertEqual(result['repeat'], 2)
+            self.assertTrue(result['min'] <= result['mean'])
+        # Writing cases are rolled back
+        self.assertEqual(Charge.objects.filter(
+            state=Charge.STATE_SUCCESSFUL).count(), 5)
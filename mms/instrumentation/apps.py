@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class InstrumentationConfig(AppConfig):
+    name = 'instrumentation'
+
+    def ready(self):
+        if getattr(settings, "MMS_INSTRUMENTATION", False):
+            from . import recorder
+            recorder.install()
+            recorder.instrument_commands()
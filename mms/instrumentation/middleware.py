@@ -0,0 +1,66 @@
+"""Per-request instrumentation.
+
+Add ``instrumentation.middleware.InstrumentationMiddleware`` near the top of
+``MIDDLEWARE_CLASSES``.  Every request is then logged to the
+``mms.instrumentation`` logger, its totals are sent back in ``X-MMS-*``
+response headers and, if ``MMS_INSTRUMENTATION_PANEL`` is set (the default
+when ``DEBUG`` is), HTML pages get a small panel with the summary and the
+first queries.
+"""
+from django.conf import settings
+from django.utils.html import escape
+
+from .recorder import install, logger, start_recording, stop_recording
+
+INSTRUMENTATION_PANEL = getattr(settings, "MMS_INSTRUMENTATION_PANEL",
+                                settings.DEBUG)
+
+PANEL_TEMPLATE = (
+    '<div id="mms-instrumentation" style="position: fixed; bottom: 0; '
+    'right: 0; max-width: 50%%; max-height: 40%%; overflow: auto; '
+    'background: #ffd; border: 1px solid #999; padding: 4px; '
+    'font: 11px monospace; z-index: 10000;">'
+    '<pre>%s</pre><details><summary>Queries</summary><pre>%s</pre>'
+    '</details></div>')
+
+
+class InstrumentationMiddleware(object):
+    def __init__(self):
+        install()
+
+    def process_request(self, request):
+        request._mms_recording = start_recording(
+            "%s %s" % (request.method, request.path))
+
+    def _stop(self, request):
+        recording = getattr(request, '_mms_recording', None)
+        if recording is not None:
+            stop_recording(recording)
+        return recording
+
+    def process_exception(self, request, exception):
+        self._stop(request)
+
+    def process_response(self, request, response):
+        recording = self._stop(request)
+        if recording is None:
+            return response
+
+        logger.info(recording.summary())
+        response['X-MMS-Queries'] = str(recording.queries)
+        response['X-MMS-DB-Time'] = "%.1f" % (recording.db_time * 1000)
+        response['X-MMS-Stripe-Calls'] = str(recording.stripe_calls)
+        response['X-MMS-Stripe-Time'] = "%.1f" % (
+            recording.stripe_time * 1000)
+
+        if INSTRUMENTATION_PANEL and not response.streaming and \
+                response.get('Content-Type', '').startswith('text/html'):
+            panel = PANEL_TEMPLATE % (escape(recording.summary()),
+                                      escape('\n\n'.join(recording.sql)))
+            content = response.content.decode(response.charset)
+            if '</body>' in content:
+                content = content.replace('</body>', panel + '</body>', 1)
+                response.content = content.encode(response.charset)
+                if response.has_header('Content-Length'):
+                    response['Content-Length'] = str(len(response.content))
+        return response
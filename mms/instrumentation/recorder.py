@@ -0,0 +1,249 @@
+"""Recording of query counts, database time and Stripe API time.
+
+A :py:class:`Recording` collects everything that happens on the current
+thread between :py:func:`start_recording` and :py:func:`stop_recording`
+(or inside :py:func:`record`).  Recordings nest: a query counts towards
+every recording that is active.  While recording, selected model
+properties, such as :py:attr:`accounting.models.LedgerAccount.balance`,
+also keep per-property statistics, which is how hidden query storms in
+``__str__`` methods and properties show up.
+
+Nothing is patched until :py:func:`install` is called, which the app does
+when ``MMS_INSTRUMENTATION`` is set, and the overhead outside recordings
+is one thread-local lookup per query.
+
+Settings:
+
+``MMS_INSTRUMENTATION``
+    Install the instrumentation and log a summary of every management
+    command.  Defaults to False.
+``MMS_INSTRUMENTED_PROPERTIES``
+    ``app_label.Model.property`` names to keep statistics for.
+"""
+from django.apps import apps
+from django.conf import settings
+from django.db.backends import utils
+from django.db.backends.base.base import BaseDatabaseWrapper
+
+from contextlib import contextmanager
+import logging
+import stripe
+import threading
+import time
+
+INSTRUMENTED_PROPERTIES = getattr(settings, "MMS_INSTRUMENTED_PROPERTIES", (
+    'accounting.LedgerAccount.balance',
+    'accounting.LedgerAccount.account_balance',
+    'members.Member.balance',
+    'members.Member.billing_up_to_date',
+    'payments_stripe.Customer.stripe_object',
+    'payments_stripe.Customer.cards',
+    'payments_stripe.Charge.stripe_object',
+))
+
+#: Statements kept per recording, for failure messages and the panel.
+MAX_SQL = 100
+
+logger = logging.getLogger('mms.instrumentation')
+
+_local = threading.local()
+_installed = False
+
+
+class PropertyStats(object):
+    """Totals for one instrumented property within a recording."""
+    def __init__(self):
+        self.calls = 0
+        self.queries = 0
+        self.db_time = 0.0
+        self.elapsed = 0.0
+
+
+class Recording(object):
+    """Query count, database time and Stripe API time of a piece of work.
+
+    :param label: description, e.g. the request path.
+    """
+    def __init__(self, label):
+        self.label = label
+        self.queries = 0
+        self.db_time = 0.0
+        self.stripe_calls = 0
+        self.stripe_time = 0.0
+        self.elapsed = 0.0
+        #: First :py:data:`MAX_SQL` statements executed.
+        self.sql = []
+        #: Property name to :py:class:`PropertyStats`.
+        self.properties = {}
+        self._start = time.time()
+
+    def _add_property(self, name, inner):
+        stats = self.properties.setdefault(name, PropertyStats())
+        stats.calls += 1
+        stats.queries += inner.queries
+        stats.db_time += inner.db_time
+        stats.elapsed += inner.elapsed
+
+    def summary(self):
+        """One-line summary, followed by the properties that ran
+        queries."""
+        lines = ["%s: %d queries (%.1f ms), %d Stripe calls (%.1f ms), "
+                 "%.1f ms total" % (self.label, self.queries,
+                                    self.db_time * 1000, self.stripe_calls,
+                                    self.stripe_time * 1000,
+                                    self.elapsed * 1000)]
+        for name, stats in sorted(self.properties.items(),
+                                  key=lambda item: -item[1].queries):
+            if stats.queries:
+                lines.append("  %s: %d calls, %d queries (%.1f ms)" % (
+                    name, stats.calls, stats.queries, stats.db_time * 1000))
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.summary()
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+def start_recording(label):
+    """Starts and returns a :py:class:`Recording` on this thread."""
+    recording = Recording(label)
+    _stack().append(recording)
+    return recording
+
+
+def stop_recording(recording):
+    """Stops *recording*; calling it again has no effect."""
+    stack = _stack()
+    if recording in stack:
+        recording.elapsed = time.time() - recording._start
+        stack.remove(recording)
+    return recording
+
+
+@contextmanager
+def record(label):
+    """Context manager recording the enclosed block."""
+    recording = start_recording(label)
+    try:
+        yield recording
+    finally:
+        stop_recording(recording)
+
+
+def _db_hit(sql, duration):
+    for recording in _stack():
+        recording.queries += 1
+        recording.db_time += duration
+        if len(recording.sql) < MAX_SQL:
+            recording.sql.append(sql)
+
+
+class _InstrumentedCursorMixin(object):
+    def execute(self, sql, params=None):
+        if not _stack():
+            return super(_InstrumentedCursorMixin, self).execute(sql, params)
+        start = time.time()
+        try:
+            return super(_InstrumentedCursorMixin, self).execute(sql, params)
+        finally:
+            _db_hit(sql, time.time() - start)
+
+    def executemany(self, sql, param_list):
+        if not _stack():
+            return super(_InstrumentedCursorMixin, self).executemany(
+                sql, param_list)
+        start = time.time()
+        try:
+            return super(_InstrumentedCursorMixin, self).executemany(
+                sql, param_list)
+        finally:
+            _db_hit(sql, time.time() - start)
+
+
+class InstrumentedCursorWrapper(_InstrumentedCursorMixin,
+                                utils.CursorWrapper):
+    pass
+
+
+class InstrumentedCursorDebugWrapper(_InstrumentedCursorMixin,
+                                     utils.CursorDebugWrapper):
+    pass
+
+
+def instrument_property(model, name):
+    """Keeps :py:class:`PropertyStats` for property *name* of *model*."""
+    prop = getattr(model, name)
+    if getattr(prop.fget, 'instrumented', False):
+        return
+    label = '%s.%s' % (model.__name__, name)
+    fget = prop.fget
+
+    def instrumented(obj):
+        if not _stack():
+            return fget(obj)
+        with record(label) as inner:
+            value = fget(obj)
+        for recording in _stack():
+            recording._add_property(label, inner)
+        return value
+    instrumented.instrumented = True
+    setattr(model, name, property(instrumented, prop.fset, prop.fdel,
+                                  prop.__doc__))
+
+
+def install():
+    """Hooks the recorder into database cursors, Stripe API requests and
+    the :py:data:`INSTRUMENTED_PROPERTIES`.  Safe to call repeatedly."""
+    global _installed
+    if _installed:
+        return
+    _installed = True
+
+    BaseDatabaseWrapper.make_cursor = \
+        lambda self, cursor: InstrumentedCursorWrapper(cursor, self)
+    BaseDatabaseWrapper.make_debug_cursor = \
+        lambda self, cursor: InstrumentedCursorDebugWrapper(cursor, self)
+
+    request_raw = stripe.api_requestor.APIRequestor.request_raw
+
+    def instrumented_request_raw(*args, **kwargs):
+        if not _stack():
+            return request_raw(*args, **kwargs)
+        start = time.time()
+        try:
+            return request_raw(*args, **kwargs)
+        finally:
+            duration = time.time() - start
+            for recording in _stack():
+                recording.stripe_calls += 1
+                recording.stripe_time += duration
+    stripe.api_requestor.APIRequestor.request_raw = instrumented_request_raw
+
+    for path in INSTRUMENTED_PROPERTIES:
+        model, name = path.rsplit('.', 1)
+        instrument_property(apps.get_model(model), name)
+
+
+def instrument_commands():
+    """Logs a :py:class:`Recording` summary of every management command."""
+    from django.core.management.base import BaseCommand
+    execute = BaseCommand.execute
+    if getattr(execute, 'instrumented', False):
+        return
+
+    def instrumented_execute(self, *args, **options):
+        name = self.__module__.rsplit('.', 1)[-1]
+        recording = start_recording("command %s" % name)
+        try:
+            return execute(self, *args, **options)
+        finally:
+            logger.info(stop_recording(recording).summary())
+    instrumented_execute.instrumented = True
+    BaseCommand.execute = instrumented_execute
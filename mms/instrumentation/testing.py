@@ -0,0 +1,32 @@
+"""Test helpers for asserting query budgets on key paths."""
+from contextlib import contextmanager
+
+from .recorder import install, record
+
+
+class QueryBudgetMixin(object):
+    """Mixin for :class:`django.test.TestCase` adding
+    :py:meth:`assertQueryBudget`."""
+
+    @contextmanager
+    def assertQueryBudget(self, queries=None, stripe_calls=None,
+                          label="Query budget"):
+        """Fails if the enclosed block runs more than *queries* database
+        queries or makes more than *stripe_calls* Stripe API requests.
+
+        Unlike :meth:`~django.test.TransactionTestCase.assertNumQueries`,
+        this sets an upper bound, so that harmless improvements do not
+        break the test.  Yields the
+        :py:class:`instrumentation.recorder.Recording`, e.g. to check
+        per-property statistics.
+        """
+        install()
+        with record(label) as recording:
+            yield recording
+        if queries is not None and recording.queries > queries:
+            self.fail("%s: %d queries, budget is %d\n%s" % (
+                label, recording.queries, queries,
+                '\n'.join(recording.sql)))
+        if stripe_calls is not None and recording.stripe_calls > stripe_calls:
+            self.fail("%s: %d Stripe calls, budget is %d" % (
+                label, recording.stripe_calls, stripe_calls))
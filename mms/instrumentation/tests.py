@@ -0,0 +1,89 @@
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.six import StringIO
+from accounting.models import LedgerAccount, LedgerEntry
+from instrumentation import recorder
+from instrumentation.testing import QueryBudgetMixin
+from members.models import Member
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class RecorderTestCase(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        recorder.install()
+        self.account = LedgerAccount.objects.create(
+            account_type=LedgerAccount.TYPE_LIABILITY)
+        self.member = Member.objects.create(name="Member 1",
+                                            email="member1@example.com",
+                                            account=self.account)
+
+    def test_nested_recordings(self):
+        with recorder.record("outer") as outer:
+            Member.objects.count()
+            with recorder.record("inner") as inner:
+                LedgerAccount.objects.count()
+        self.assertEqual((outer.queries, inner.queries), (2, 1))
+        self.assertEqual(len(outer.sql), 2)
+        self.assertTrue(outer.db_time >= inner.db_time)
+        # Not recording any more
+        LedgerAccount.objects.count()
+        self.assertEqual(outer.queries, 2)
+
+    def test_properties(self):
+        with recorder.record("balances") as recording:
+            for member in Member.objects.all():
+                member.balance
+        stats = recording.properties['Member.balance']
+        self.assertEqual((stats.calls, stats.queries), (1, 1))
+        # Stored totals, so only the account lookup runs a query
+        self.assertEqual(recording.properties['LedgerAccount.account_balance']
+                         .queries, 0)
+        self.assertIn("Member.balance: 1 calls, 1 queries",
+                      recording.summary())
+
+    def test_budget(self):
+        with self.assertQueryBudget(1):
+            LedgerAccount.objects.get(pk=self.account.pk).balance
+        with self.assertRaises(AssertionError) as cm:
+            with self.assertQueryBudget(1, label="members"):
+                for member in Member.objects.all():
+                    member.balance
+        self.assertIn("members: 2 queries, budget is 1", str(cm.exception))
+
+    def test_command(self):
+        recorder.instrument_commands()
+        with mock.patch.object(recorder.logger, 'info') as info:
+            call_command('rebuild_balances', check=True, stdout=StringIO())
+        self.assertIn("command rebuild_balances: ", info.call_args[0][0])
+
+
+@override_settings(MIDDLEWARE_CLASSES=(
+    'instrumentation.middleware.InstrumentationMiddleware',
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+))
+class MiddlewareTestCase(TestCase):
+    def test_headers_and_panel(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+        LedgerEntry.objects.create(
+            debit_account=LedgerAccount.objects.create(
+                account_type=LedgerAccount.TYPE_ASSET),
+            credit_account=LedgerAccount.objects.create(
+                account_type=LedgerAccount.TYPE_INCOME),
+            amount="10.00", details="dues")
+        with mock.patch('instrumentation.middleware.INSTRUMENTATION_PANEL',
+                        True):
+            response = self.client.get(
+                reverse('admin:accounting_ledgerentry_changelist'))
+        self.assertTrue(int(response['X-MMS-Queries']) > 0)
+        self.assertEqual(response['X-MMS-Stripe-Calls'], '0')
+        self.assertContains(response, 'id="mms-instrumentation"')
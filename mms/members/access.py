@@ -0,0 +1,208 @@
+"""Access decisions (keyfob, room key, power tools) for the door
+controller.
+
+Decisions are derived from each member's :py:class:`MembershipLevel`
+privileges and their account balance, and are kept in an in-process cache
+so that a lookup is a dictionary access.  The cache is loaded with a single
+query and individual entries are dropped by signal handlers whenever a
+:py:class:`Member`, :py:class:`MembershipLevel` or the totals of a member's
+:py:class:`accounting.models.LedgerAccount` change.  Other processes only
+notice changes after :py:data:`ACCESS_CACHE_TTL` seconds.
+
+Settings:
+
+``MMS_ACCESS_ARREARS_LIMIT``
+    Amount a member may owe before losing keyfob, room key and power tool
+    access.  Defaults to None, meaning the cost of one billing period of
+    their membership level.
+``MMS_ACCESS_CACHE_TTL``
+    Seconds after which the whole cache is reloaded.  Defaults to 300.
+"""
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from accounting.signals import totals_changed
+
+from collections import namedtuple
+from decimal import Decimal
+import threading
+import time
+
+from .models import Member, MembershipLevel
+
+KEYFOB = 1
+ROOM_KEY = 2
+VOTING = 4
+POWERTOOL = 8
+
+#: Privileges revoked from members in arrears; voting is unaffected.
+ARREARS_REVOKES = KEYFOB | ROOM_KEY | POWERTOOL
+
+ACCESS_ARREARS_LIMIT = getattr(settings, "MMS_ACCESS_ARREARS_LIMIT", None)
+ACCESS_CACHE_TTL = getattr(settings, "MMS_ACCESS_CACHE_TTL", 300)
+
+
+class AccessDecision(namedtuple('AccessDecision',
+                                ['member_id', 'privileges', 'in_arrears'])):
+    """Effective privileges of one member.
+
+    :param member_id: :py:class:`Member` primary key.
+    :param privileges:
+        Bitmask of :py:data:`KEYFOB`, :py:data:`ROOM_KEY`,
+        :py:data:`VOTING` and :py:data:`POWERTOOL`, after applying the
+        arrears rule.
+    :param in_arrears: True if the member owes more than the arrears limit.
+    """
+    __slots__ = ()
+
+    def allows(self, privilege):
+        return bool(self.privileges & privilege)
+
+
+def decide(member):
+    """Computes the :py:class:`AccessDecision` for *member*, which should
+    have ``membership`` and ``account`` already loaded."""
+    level = member.membership
+    if level is None:
+        return AccessDecision(member.pk, 0, False)
+
+    privileges = ((KEYFOB if level.has_keyfob else 0) |
+                  (ROOM_KEY if level.has_room_key else 0) |
+                  (VOTING if level.has_voting else 0) |
+                  (POWERTOOL if level.has_powertool_access else 0))
+
+    in_arrears = False
+    if member.account is not None:
+        limit = ACCESS_ARREARS_LIMIT
+        if limit is None:
+            limit = level.cost
+        in_arrears = member.account.account_balance < -Decimal(limit)
+    if in_arrears:
+        privileges &= ~ARREARS_REVOKES
+    return AccessDecision(member.pk, privileges, in_arrears)
+
+
+class AccessCache(object):
+    """In-process cache of member primary key to
+    :py:class:`AccessDecision`."""
+    def __init__(self, ttl=ACCESS_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._decisions = {}
+        self._accounts = {}
+        self._loaded_at = None
+        # Bumped under the lock by every invalidation, so that a lookup
+        # racing with one can tell its result may be stale
+        self._generation = 0
+
+    def _queryset(self):
+        return Member.objects.select_related('membership', 'account')
+
+    def _store(self, member):
+        decision = decide(member)
+        self._decisions[member.pk] = decision
+        if member.account_id is not None:
+            self._accounts[member.account_id] = member.pk
+        return decision
+
+    def load(self):
+        """(Re)loads every member's decision with one query."""
+        with self._lock:
+            self._decisions = {}
+            self._accounts = {}
+            for member in self._queryset().iterator():
+                self._store(member)
+            self._loaded_at = time.time()
+
+    def _is_fresh(self):
+        return (self._loaded_at is not None and
+                time.time() - self._loaded_at < self.ttl)
+
+    def get(self, member_id):
+        """Returns the :py:class:`AccessDecision` for *member_id*, or None
+        if there is no such member."""
+        if not self._is_fresh():
+            self.load()
+        with self._lock:
+            try:
+                return self._decisions[member_id]
+            except KeyError:
+                generation = self._generation
+        member = self._queryset().filter(pk=member_id).first()
+        with self._lock:
+            if generation != self._generation:
+                # Invalidated while querying; answer without caching
+                return decide(member) if member is not None else None
+            if member is None:
+                # Remember unknown ids too; creating the member invalidates
+                self._decisions[member_id] = None
+                return None
+            return self._store(member)
+
+    def check(self, member_id, privilege):
+        """True if *member_id* currently holds *privilege*, e.g.
+        :py:data:`KEYFOB`."""
+        decision = self.get(member_id)
+        return decision is not None and decision.allows(privilege)
+
+    def invalidate_members(self, member_ids):
+        with self._lock:
+            self._generation += 1
+            for pk in member_ids:
+                self._decisions.pop(pk, None)
+
+    def invalidate_accounts(self, account_ids):
+        with self._lock:
+            self._generation += 1
+            for pk in account_ids:
+                member_id = self._accounts.get(pk)
+                if member_id is not None:
+                    self._decisions.pop(member_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._decisions = {}
+            self._accounts = {}
+            self._loaded_at = None
+
+    def export(self):
+        """Compact snapshot of every decision, for loading into the door
+        controller when it is offline.
+
+        :return:
+            dict with the ``generated`` UNIX timestamp and ``members``, a
+            list of ``[member_id, privileges]`` pairs for members with any
+            privileges.
+        """
+        self.load()
+        decisions = sorted(d for d in self._decisions.values()
+                           if d is not None)
+        return {
+            'generated': int(self._loaded_at),
+            'members': [[d.member_id, d.privileges]
+                        for d in decisions if d.privileges],
+        }
+
+
+#: Shared :py:class:`AccessCache` for this process.
+access_cache = AccessCache()
+
+
+@receiver(post_save, sender=Member)
+@receiver(post_delete, sender=Member)
+def _member_changed(sender, instance, **kwargs):
+    access_cache.invalidate_members([instance.pk])
+
+
+@receiver(post_save, sender=MembershipLevel)
+@receiver(post_delete, sender=MembershipLevel)
+def _membershiplevel_changed(sender, instance, **kwargs):
+    # Affects every member on the level, so start over
+    access_cache.clear()
+
+
+@receiver(totals_changed)
+def _totals_changed(sender, accounts, **kwargs):
+    access_cache.invalidate_accounts(accounts)
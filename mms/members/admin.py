@@ -1,10 +1,114 @@
+from django.conf.urls import url
 from django.contrib import admin
+from django.db import models
+from django.db.models import Value
+from django.db.models.functions import Coalesce
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.shortcuts import render
+from django.utils import timezone
+
+from accounting.models import balance_annotations
+
+from datetime import datetime
+import csv
 
 from .models import MembershipLevel, Member
+from .reports import revenue_report
+
+
+def _parse_month(value):
+    return datetime.strptime(value, '%Y-%m').date()
+
+
+@admin.register(MembershipLevel)
+class MembershipLevelAdmin(admin.ModelAdmin):
+    def get_urls(self):
+        return [
+            url(r'^revenue/$',
+                self.admin_site.admin_view(self.revenue_view),
+                name='members_membershiplevel_revenue'),
+        ] + super(MembershipLevelAdmin, self).get_urls()
+
+    def revenue_view(self, request):
+        """Monthly :py:func:`members.reports.revenue_report`, as a page or,
+        with ``format=csv``, as CSV.  ``start`` and ``end`` months
+        (``YYYY-MM``) default to the last twelve months."""
+        today = timezone.now().date()
+        try:
+            end = _parse_month(request.GET.get('end') or
+                               today.strftime('%Y-%m'))
+            start = request.GET.get('start')
+            start = _parse_month(start) if start else \
+                Member.add_n_months(end, -11)
+        except ValueError:
+            return HttpResponseBadRequest("Months must be YYYY-MM")
+        report = revenue_report(start, end)
+
+        if request.GET.get('format') == 'csv':
+            response = HttpResponse(content_type='text/csv')
+            response['Content-Disposition'] = \
+                'attachment; filename="revenue-%s-%s.csv"' % (
+                    start.strftime('%Y%m'), end.strftime('%Y%m'))
+            writer = csv.writer(response)
+            writer.writerow(['Category', 'Name'] +
+                            [m.strftime('%Y-%m') for m in report.months] +
+                            ['Total'])
+            for category, name, amounts, total in report.rows():
+                writer.writerow([category, name] + amounts + [total])
+            return response
 
-admin.site.register(MembershipLevel)
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            title="Revenue by month",
+            report=report,
+            start=start,
+            end=end,
+        )
+        return render(request,
+                      'admin/members/membershiplevel/revenue_report.html',
+                      context)
+
+
+class BillingUpToDateFilter(admin.SimpleListFilter):
+    title = 'billing up to date'
+    parameter_name = 'billing_up_to_date'
+
+    def lookups(self, request, model_admin):
+        return (('1', 'Yes'), ('0', 'No'))
+
+    def queryset(self, request, queryset):
+        today = timezone.now().date()
+        if self.value() == '1':
+            return queryset.filter(next_bill_date__gt=today)
+        if self.value() == '0':
+            return queryset.filter(next_bill_date__lte=today)
+        return queryset
 
 
 @admin.register(Member)
 class MemberAdmin(admin.ModelAdmin):
     list_display = ('__str__', 'membership', 'billing_up_to_date', 'balance')
+    list_filter = (BillingUpToDateFilter, 'membership')
+
+    def get_queryset(self, request):
+        qs = super(MemberAdmin, self).get_queryset(request)
+        qs = qs.select_related('membership')
+        qs = qs.annotate(**balance_annotations('account__'))
+        # Django 1.8 joins the account of the annotations with an INNER
+        # JOIN, which would hide members without an account
+        qs.query.promote_joins(list(qs.query.alias_map))
+        # Those sort as a zero balance, rather than first or last
+        # depending on the database
+        return qs.annotate(balance_order=Coalesce(
+            'annotated_account_balance', Value(0),
+            output_field=models.DecimalField(max_digits=15,
+                                             decimal_places=2)))
+
+    def billing_up_to_date(self, obj):
+        return obj.billing_up_to_date
+    billing_up_to_date.boolean = True
+
+    def balance(self, obj):
+        return obj.annotated_account_balance
+    balance.admin_order_field = 'balance_order'
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class MembersConfig(AppConfig):
+    name = 'members'
+
+    def ready(self):
+        # Connects the access cache's signal handlers
+        from . import access  # NOQA
@@ -0,0 +1,200 @@
+from django.db import connection, connections, transaction
+from django.db.models import Min, Max
+from django.utils import timezone
+
+from accounting.models import LedgerEntry
+
+from collections import defaultdict
+from decimal import Decimal
+import multiprocessing
+import time
+
+from .models import Member
+
+
+class BillingRun(object):
+    """Summary of a :py:func:`run_billing` call.
+
+    :param as_of: date billing was brought up to.
+    :param members: number of members billed for at least one period.
+    :param entries: number of :py:class:`LedgerEntry` instances created.
+    :param amount: total amount billed.
+    :param elapsed: wall-clock seconds the run took.
+    :param shards: number of shards the members were split into.
+    """
+    def __init__(self, as_of):
+        self.as_of = as_of
+        self.members = 0
+        self.entries = 0
+        self.amount = Decimal('0.00')
+        self.elapsed = 0.0
+        self.shards = 1
+
+    def merge(self, other):
+        """Adds the counts of another (e.g. per-shard) run to this one."""
+        self.members += other.members
+        self.entries += other.entries
+        self.amount += other.amount
+
+    def __str__(self):
+        return "Billed %d member(s), %d entries totalling %.2f as of %s " \
+               "in %.2fs" % (self.members, self.entries, self.amount,
+                             self.as_of, self.elapsed)
+
+
+def get_billable_members(as_of):
+    """Returns a :class:`django.db.models.query.QuerySet` of members due for
+    billing on *as_of* who have an account, with everything
+    :py:meth:`Member.make_billing_entry` needs joined in."""
+    qs = Member.objects.due(as_of).filter(account__isnull=False)
+    return qs.select_related('account', 'membership', 'membership__account')
+
+
+def get_due_periods(member, as_of):
+    """Computes every period *member* still has to be billed for, in
+    memory.
+
+    :return: list of bill dates, oldest first; empty if up to date.
+    """
+    dates = []
+    bill_date = member.next_bill_date
+    while bill_date is not None and bill_date <= as_of:
+        dates.append(bill_date)
+        bill_date = member.add_n_months(bill_date, member.membership.per)
+    return dates
+
+
+def bill_members(members, as_of, run):
+    """Bills *members* for all their due periods in one transaction.
+
+    The due members are locked first (``SELECT ... FOR UPDATE``, without
+    joins so only member rows are locked) and the due filter is re-applied
+    under the lock, so a concurrent run or
+    :py:meth:`Member.do_regular_billing` can never bill a period twice.
+    ``last_billed``/``next_bill_date`` are then updated with one query per
+    distinct pair of new dates, and all entries go through
+    :py:meth:`LedgerEntryManager.bulk_post`.
+
+    :param members: :class:`django.db.models.query.QuerySet` of
+        :py:class:`Member`, as returned by :py:func:`get_billable_members`.
+    :param as_of: date to bring billing up to.
+    :param run: :py:class:`BillingRun` to add the results to.
+    """
+    with transaction.atomic():
+        locked = list(members.select_related(None).select_for_update()
+                      .order_by('pk').values_list('pk', flat=True))
+        if not locked:
+            return
+
+        entries = []
+        billed = defaultdict(list)
+        count = 0
+        for member in members.filter(pk__in=locked):
+            dates = get_due_periods(member, as_of)
+            if not dates:
+                continue
+            for bill_date in dates:
+                entries.append(member.make_billing_entry(bill_date))
+            last_billed = dates[-1]
+            next_bill_date = member.add_n_months(last_billed,
+                                                 member.membership.per)
+            billed[(last_billed, next_bill_date)].append(member.pk)
+            count += 1
+
+        for (last_billed, next_bill_date), pks in billed.items():
+            Member.objects.filter(pk__in=pks).update(
+                last_billed=last_billed, next_bill_date=next_bill_date)
+        # Posting last keeps the shared income account rows locked for as
+        # short a time as possible
+        LedgerEntry.objects.bulk_post(entries)
+
+    run.members += count
+    run.entries += len(entries)
+    run.amount += sum((e.amount for e in entries), Decimal('0.00'))
+
+
+def bill_shard(as_of, first_pk=None, last_pk=None, chunk_size=500):
+    """Bills all due members with a primary key between *first_pk* and
+    *last_pk* (inclusive, either may be None for no bound), *chunk_size*
+    members per transaction.
+
+    :return: :py:class:`BillingRun` with the shard's counts.
+    """
+    run = BillingRun(as_of)
+    qs = get_billable_members(as_of)
+    if first_pk is not None:
+        qs = qs.filter(pk__gte=first_pk)
+    if last_pk is not None:
+        qs = qs.filter(pk__lte=last_pk)
+    # Billing moves members out of the due set, so fix the list up front
+    # rather than updating rows under an open cursor
+    pks = list(qs.order_by('pk').values_list('pk', flat=True))
+    for i in range(0, len(pks), chunk_size):
+        bill_members(qs.filter(pk__in=pks[i:i + chunk_size]), as_of, run)
+    return run
+
+
+def _bill_shard_worker(args):
+    # Entry point for pool workers; each opens its own connections
+    try:
+        return bill_shard(*args)
+    finally:
+        connections.close_all()
+
+
+def get_shards(as_of, count):
+    """Splits the primary key range of the members due on *as_of* into
+    *count* contiguous (first, last) ranges."""
+    bounds = get_billable_members(as_of).aggregate(Min('pk'), Max('pk'))
+    low, high = bounds['pk__min'], bounds['pk__max']
+    if low is None:
+        return []
+    size = max(1, (high - low + count) // count)
+    return [(start, min(start + size - 1, high))
+            for start in range(low, high + 1, size)]
+
+
+def run_billing(as_of=None, chunk_size=500, workers=1):
+    """Brings billing up to date for every member, like calling
+    :py:meth:`Member.do_regular_billing` until it returns None, but with a
+    handful of queries per chunk of members instead of several per period.
+
+    :param as_of:
+        :class:`datetime.date` to bill up to (inclusive).  Defaults to
+        today.
+    :param chunk_size:
+        Number of members to bill per transaction.
+    :param workers:
+        Number of processes to bill with.  Members are sharded by primary
+        key range and each shard is billed by one process.  SQLite only
+        allows one writer at a time, so it always uses a single process.
+    :return: :py:class:`BillingRun` summary.
+    """
+    if as_of is None:
+        as_of = timezone.now().date()
+    run = BillingRun(as_of)
+    start = time.time()
+
+    if connection.vendor == 'sqlite':
+        workers = 1
+
+    if workers <= 1:
+        run.merge(bill_shard(as_of, chunk_size=chunk_size))
+    else:
+        # A few shards per worker smooths out uneven pk distributions
+        shards = get_shards(as_of, workers * 4)
+        run.shards = len(shards)
+        # Children must not share the parent's database connections
+        connections.close_all()
+        pool = multiprocessing.Pool(workers)
+        try:
+            args = [(as_of, first, last, chunk_size)
+                    for first, last in shards]
+            for result in pool.imap_unordered(_bill_shard_worker, args):
+                run.merge(result)
+        finally:
+            pool.close()
+            pool.join()
+
+    run.elapsed = time.time() - start
+    return run
@@ -0,0 +1,111 @@
+"""Forecast of the dues billing will produce in the coming months.
+
+Every billable member is billed ``membership.cost`` on each date of the
+chain :py:attr:`Member.next_bill_date`, then :py:meth:`Member.add_n_months`
+of the previous date by ``membership.per``, just as
+:py:func:`members.billing.get_due_periods` computes them.  Members sharing
+a next bill date and level share the whole chain, so the roster is loaded
+as (next bill date, level, number of members) groups with one grouped
+query, and each distinct (date, interval) chain is computed once.  The
+work then depends on the number of distinct dates, not on the number of
+members.
+"""
+from django.db.models import Count
+from django.utils import timezone
+
+from collections import OrderedDict, defaultdict
+from decimal import Decimal
+
+from .models import Member
+from .reports import month_start, months_between
+
+
+class Forecast(object):
+    """Expected billing per month.
+
+    :param months: first days of the months covered.
+    :param levels: :class:`collections.OrderedDict` mapping each
+        :py:class:`MembershipLevel` primary key to its name.
+    :param amounts: dict mapping (level primary key, month) to the amount
+        billed.
+    :param bills: dict mapping (level primary key, month) to the number of
+        bills.
+    :param overdue: amount of the periods already due before the first
+        month, which the next billing run bills.
+    """
+    def __init__(self, months, levels, amounts, bills, overdue):
+        self.months = months
+        self.levels = levels
+        self.amounts = amounts
+        self.bills = bills
+        self.overdue = overdue
+
+    def rows(self):
+        """Yields (level name, [amount per month], total) per level."""
+        for pk, name in self.levels.items():
+            amounts = [self.amounts.get((pk, m), Decimal('0.00'))
+                       for m in self.months]
+            yield name, amounts, sum(amounts, Decimal('0.00'))
+
+    def totals(self):
+        """Amount per month over all levels."""
+        return [sum((self.amounts.get((pk, m), Decimal('0.00'))
+                     for pk in self.levels), Decimal('0.00'))
+                for m in self.months]
+
+
+def bill_dates(first, per, until):
+    """Bill dates from *first* up to, but excluding, *until*, each *per*
+    months after the previous one."""
+    dates = []
+    bill_date = first
+    while bill_date < until:
+        dates.append(bill_date)
+        bill_date = Member.add_n_months(bill_date, per)
+    return dates
+
+
+def forecast_billing(months=12, start=None):
+    """Forecasts the dues billed per level and month.
+
+    :param months: number of months to cover.
+    :param start: :class:`datetime.date` in the first month; defaults to
+        today.  Periods due earlier count towards
+        :py:attr:`Forecast.overdue`.
+    :return: :py:class:`Forecast`.
+    """
+    if start is None:
+        start = timezone.now().date()
+    first = month_start(start)
+    # First day after the forecast
+    until = Member.add_n_months(first, months)
+    covered = months_between(first, Member.add_n_months(first, months - 1))
+
+    groups = Member.objects.filter(
+        membership__isnull=False, account__isnull=False,
+        next_bill_date__isnull=False).order_by().values(
+        'next_bill_date', 'membership', 'membership__name',
+        'membership__per', 'membership__cost').annotate(members=Count('id'))
+
+    levels = OrderedDict()
+    amounts = defaultdict(Decimal)
+    bills = defaultdict(int)
+    overdue = Decimal('0.00')
+    chains = {}
+    for group in sorted(groups, key=lambda g: (g['membership__name'],
+                                               g['membership'])):
+        level = group['membership']
+        levels[level] = group['membership__name']
+        key = (group['next_bill_date'], group['membership__per'])
+        if key not in chains:
+            chains[key] = bill_dates(key[0], key[1], until)
+        count = group['members']
+        cost = group['membership__cost'] * count
+        for bill_date in chains[key]:
+            if bill_date < first:
+                overdue += cost
+            else:
+                month = month_start(bill_date)
+                amounts[(level, month)] += cost
+                bills[(level, month)] += count
+    return Forecast(covered, levels, dict(amounts), dict(bills), overdue)
@@ -0,0 +1,287 @@
+"""Bulk import of a member roster from CSV or JSON Lines.
+
+Rows are read one at a time and validated, then created in chunks: one
+``bulk_create`` for the members' liability accounts, one for the members
+themselves and, for rows with an opening balance, one
+:py:meth:`LedgerEntryManager.bulk_post`, all in one transaction per chunk.
+Memory use therefore depends on the chunk size, not on the size of the
+roster.
+
+Rows that fail validation are reported with their line number and
+skipped.  If a chunk cannot be inserted as a whole, its rows are retried
+one at a time, so one bad row only loses itself.
+
+Columns (CSV header or JSON keys):
+
+``name``
+    Required.
+``email``
+    Required; must be a valid address.
+``membership``
+    Optional :py:class:`MembershipLevel` name or primary key.
+``last_billed``
+    Optional date (``YYYY-MM-DD``); defaults to today.
+``opening_balance``
+    Optional amount, in the sign of :py:attr:`Member.balance`: positive is
+    a credit owed to the member, negative an amount the member owes.
+"""
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from accounting.models import LedgerAccount, LedgerEntry
+
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+import csv
+import json
+import time
+import uuid
+
+from .access import access_cache
+from .models import Member, MembershipLevel
+
+#: Default :py:attr:`LedgerAccount.gnucash_account` of the equity account
+#: opening balances are posted against.
+OPENING_BALANCE_ACCOUNT = "Equity:Opening Balances"
+
+#: A row that was not imported.
+RowError = namedtuple('RowError', ['line', 'message'])
+
+#: A validated row.
+MemberRow = namedtuple('MemberRow', ['line', 'name', 'email', 'membership',
+                                     'last_billed', 'opening_balance'])
+
+
+class ImportRun(object):
+    """Summary of an :py:func:`import_members` call.
+
+    :param rows: number of rows read.
+    :param members: number of members created.
+    :param entries: number of opening-balance entries posted.
+    :param errors: list of :py:class:`RowError`.
+    :param elapsed: wall-clock seconds the import took.
+    """
+    def __init__(self):
+        self.rows = 0
+        self.members = 0
+        self.entries = 0
+        self.errors = []
+        self.elapsed = 0.0
+
+    def __str__(self):
+        return "Imported %d of %d member(s) with %d opening balance(s), " \
+               "%d error(s) in %.2fs" % (self.members, self.rows,
+                                         self.entries, len(self.errors),
+                                         self.elapsed)
+
+
+def read_csv(stream):
+    """Yields (line number, dict) for every row of a CSV *stream* with a
+    header line."""
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def read_jsonl(stream):
+    """Yields (line number, dict) for every object in a JSON Lines
+    *stream*, one object per line.  Malformed lines give None."""
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield number, row if isinstance(row, dict) else None
+
+
+class RowValidator(object):
+    """Turns roster dicts into :py:class:`MemberRow` instances.
+
+    :param levels: iterable of every :py:class:`MembershipLevel`.
+    :param today: default ``last_billed``.
+    """
+    def __init__(self, levels, today):
+        self.today = today
+        self.levels = {}
+        for level in levels:
+            self.levels[str(level.pk)] = level
+            self.levels.setdefault(level.name, level)
+
+    def __call__(self, line, row):
+        """Returns the :py:class:`MemberRow` for *row*.
+
+        :raise ValueError: with a message for the user if *row* is invalid.
+        """
+        if row is None:
+            raise ValueError("Not a JSON object")
+
+        def value(key):
+            return ('%s' % (row.get(key) or '')).strip()
+
+        name = value('name')
+        if not name:
+            raise ValueError("Missing name")
+        email = value('email')
+        try:
+            validate_email(email)
+        except ValidationError:
+            raise ValueError("Invalid email %r" % email)
+
+        membership = None
+        if value('membership'):
+            membership = self.levels.get(value('membership'))
+            if membership is None:
+                raise ValueError("Unknown membership level %r" %
+                                 value('membership'))
+
+        last_billed = self.today
+        if value('last_billed'):
+            try:
+                last_billed = parse_date(value('last_billed'))
+            except ValueError:
+                last_billed = None
+            if last_billed is None:
+                raise ValueError("Invalid last_billed date %r" %
+                                 value('last_billed'))
+
+        opening_balance = None
+        if value('opening_balance'):
+            try:
+                opening_balance = Decimal(value('opening_balance'))
+            except InvalidOperation:
+                opening_balance = Decimal('NaN')
+            if not opening_balance.is_finite():
+                raise ValueError("Invalid opening_balance %r" %
+                                 value('opening_balance'))
+            field = LedgerEntry._meta.get_field('amount')
+            # Magnitude first: quantizing a huge value raises
+            # InvalidOperation
+            if abs(opening_balance) >= Decimal(10) ** (
+                    field.max_digits - field.decimal_places) or \
+                    opening_balance != opening_balance.quantize(
+                        Decimal(10) ** -field.decimal_places):
+                raise ValueError("opening_balance %s out of range" %
+                                 opening_balance)
+
+        return MemberRow(line, name, email, membership, last_billed,
+                         opening_balance)
+
+
+def _create_accounts(count):
+    """Bulk creates *count* member liability accounts and returns them with
+    primary keys.
+
+    Where the database does not return primary keys from a bulk insert,
+    the accounts are inserted with a unique marker in ``gnucash_account``,
+    read back by it (along the ``gnucash_account`` index) and the marker
+    cleared again.
+    """
+    can_return_pks = getattr(connection.features,
+                             'can_return_ids_from_bulk_insert', False)
+    if can_return_pks:
+        return LedgerAccount.objects.bulk_create([
+            LedgerAccount(account_type=LedgerAccount.TYPE_LIABILITY)
+            for i in range(count)])
+
+    marker = 'import:%s:' % uuid.uuid4().hex
+    width = len(str(count))
+    LedgerAccount.objects.bulk_create([
+        LedgerAccount(gnucash_account='%s%0*d' % (marker, width, i),
+                      account_type=LedgerAccount.TYPE_LIABILITY)
+        for i in range(count)])
+    qs = LedgerAccount.objects.filter(gnucash_account__startswith=marker)
+    accounts = sorted(qs, key=lambda a: a.gnucash_account)
+    qs.update(gnucash_account='')
+    for acct in accounts:
+        acct.gnucash_account = ''
+    return accounts
+
+
+def _create_chunk(rows, opening_account, run):
+    """Creates the accounts, members and opening balances of *rows* in one
+    transaction."""
+    with transaction.atomic():
+        accounts = _create_accounts(len(rows))
+        Member.objects.bulk_create([
+            Member(name=row.name, email=row.email, account_id=acct.pk,
+                   membership=row.membership, last_billed=row.last_billed,
+                   next_bill_date=Member.add_n_months(
+                       row.last_billed, row.membership.per)
+                   if row.membership is not None else None)
+            for row, acct in zip(rows, accounts)])
+
+        entries = []
+        for row, acct in zip(rows, accounts):
+            if not row.opening_balance:
+                continue
+            # A positive balance is a credit to the member's account
+            debit, credit = opening_account.pk, acct.pk
+            if row.opening_balance < 0:
+                debit, credit = credit, debit
+            entries.append(LedgerEntry(
+                debit_account_id=debit, credit_account_id=credit,
+                amount=abs(row.opening_balance),
+                effective_date=row.last_billed,
+                details="Opening balance"))
+        if entries:
+            LedgerEntry.objects.bulk_post(entries)
+    run.members += len(rows)
+    run.entries += len(entries)
+
+
+def _flush(rows, opening_account, run):
+    if not rows:
+        return
+    try:
+        _create_chunk(rows, opening_account, run)
+    except DatabaseError:
+        # Find the offending rows
+        for row in rows:
+            try:
+                _create_chunk([row], opening_account, run)
+            except DatabaseError as exc:
+                run.errors.append(RowError(row.line, str(exc)))
+
+
+def import_members(rows, chunk_size=1000, opening_account=None):
+    """Imports a roster.
+
+    :param rows: iterable of (line number, dict) pairs, e.g. from
+        :py:func:`read_csv` or :py:func:`read_jsonl`.
+    :param chunk_size: number of members created per transaction.
+    :param opening_account: :py:class:`LedgerAccount` to post opening
+        balances against; defaults to the :py:data:`OPENING_BALANCE_ACCOUNT`
+        equity account, which is created if needed.
+    :return: :py:class:`ImportRun` summary.
+    """
+    run = ImportRun()
+    start = time.time()
+    validate = RowValidator(MembershipLevel.objects.all(),
+                            timezone.now().date())
+    if opening_account is None:
+        opening_account, created = LedgerAccount.objects.get_or_create(
+            gnucash_account=OPENING_BALANCE_ACCOUNT,
+            defaults={'account_type': LedgerAccount.TYPE_EQUITY})
+
+    chunk = []
+    for line, row in rows:
+        run.rows += 1
+        try:
+            chunk.append(validate(line, row))
+        except ValueError as exc:
+            run.errors.append(RowError(line, str(exc)))
+            continue
+        if len(chunk) >= chunk_size:
+            _flush(chunk, opening_account, run)
+            chunk = []
+    _flush(chunk, opening_account, run)
+
+    # bulk_create sends no post_save, so nothing told the cache
+    access_cache.clear()
+    run.elapsed = time.time() - start
+    return run
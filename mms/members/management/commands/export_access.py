@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from members.access import access_cache
+
+import json
+
+
+class Command(BaseCommand):
+    help = ("Writes a compact JSON export of every member's effective "
+            "access privileges, for the door controller to load offline.")
+
+    def handle(self, *args, **options):
+        self.stdout.write(json.dumps(access_cache.export(),
+                                     separators=(',', ':')))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from members.forecast import forecast_billing
+
+
+class Command(BaseCommand):
+    help = ("Prints the dues billing is expected to produce per level and "
+            "month.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--months', dest='months', type=int, default=12,
+            help="Number of months to forecast.")
+        parser.add_argument(
+            '--start', dest='start', default=None,
+            help="Date in the first month (YYYY-MM-DD).  Defaults to today.")
+
+    def handle(self, *args, **options):
+        start = None
+        if options['start'] is not None:
+            start = parse_date(options['start'])
+            if start is None:
+                raise CommandError("Invalid date: %s" % options['start'])
+        forecast = forecast_billing(options['months'], start)
+
+        line = "%-30s" + "%12s" * (len(forecast.months) + 1)
+        self.stdout.write(line % tuple(
+            ["Level"] + [m.strftime('%Y-%m') for m in forecast.months] +
+            ["Total"]))
+        for name, amounts, total in forecast.rows():
+            self.stdout.write(line % tuple([name] + amounts + [total]))
+        totals = forecast.totals()
+        self.stdout.write(line % tuple(["Total"] + totals + [sum(totals)]))
+        self.stdout.write("Overdue before %s: %s" % (
+            forecast.months[0].strftime('%Y-%m'), forecast.overdue))
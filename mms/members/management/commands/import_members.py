@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounting.models import LedgerAccount
+from members.importer import import_members, read_csv, read_jsonl
+
+import io
+
+
+class Command(BaseCommand):
+    help = ("Imports members, with a liability account each and optional "
+            "opening balances, from a CSV or JSON Lines roster.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument(
+            '--format', dest='format', choices=['csv', 'jsonl'],
+            default=None,
+            help="Roster format; defaults to the file extension.")
+        parser.add_argument(
+            '--chunk-size', dest='chunk_size', type=int, default=1000,
+            help="Number of members to create per transaction.")
+        parser.add_argument(
+            '--opening-account', dest='opening_account', default=None,
+            help="GnuCash name of the account to post opening balances "
+                 "against.  Defaults to Equity:Opening Balances.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or path.rsplit('.', 1)[-1].lower()
+        if fmt not in ('csv', 'jsonl'):
+            raise CommandError("Cannot tell the format of %s" % path)
+
+        opening_account = None
+        if options['opening_account'] is not None:
+            opening_account = LedgerAccount.objects.filter(
+                gnucash_account=options['opening_account']).first()
+            if opening_account is None:
+                raise CommandError("No account %s" %
+                                   options['opening_account'])
+
+        read = read_csv if fmt == 'csv' else read_jsonl
+        with io.open(path, encoding='utf-8', newline='') as stream:
+            run = import_members(read(stream),
+                                 chunk_size=options['chunk_size'],
+                                 opening_account=opening_account)
+        for error in run.errors:
+            self.stderr.write("Line %d: %s" % error)
+        self.stdout.write(str(run))
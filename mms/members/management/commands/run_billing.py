@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from members.billing import run_billing
+
+
+class Command(BaseCommand):
+    help = "Bills every member for all periods due up to the given date."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--as-of', dest='as_of', default=None,
+            help="Bill periods starting on or before this date (YYYY-MM-DD). "
+                 "Defaults to today.")
+        parser.add_argument(
+            '--chunk-size', dest='chunk_size', type=int, default=500,
+            help="Number of members to bill per transaction.")
+        parser.add_argument(
+            '--workers', dest='workers', type=int, default=1,
+            help="Number of processes to bill with (ignored on SQLite).")
+
+    def handle(self, *args, **options):
+        as_of = None
+        if options['as_of'] is not None:
+            as_of = parse_date(options['as_of'])
+            if as_of is None:
+                raise CommandError("Invalid date: %s" % options['as_of'])
+        run = run_billing(as_of, chunk_size=options['chunk_size'],
+                          workers=options['workers'])
+        self.stdout.write(str(run))
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def add_n_months(original, months):
+    # Copy of Member.add_n_months as of this migration, so that later
+    # changes to the live model can't alter what the backfill computes
+    year = original.year
+    month = original.month + months
+    day = original.day
+
+    while True:
+        while month < 1:
+            year -= 1
+            month += 12
+
+        while month > 12:
+            year += 1
+            month -= 12
+
+        try:
+            return original.replace(year=year, month=month, day=day)
+        except ValueError:
+            # day is most likely out of range (e.g. February 30)
+            day -= 1
+
+
+def backfill_next_bill_date(apps, schema_editor):
+    Member = apps.get_model('members', 'Member')
+    pairs = Member.objects.filter(membership__isnull=False).order_by()
+    pairs = pairs.values_list('last_billed', 'membership__per').distinct()
+    for last_billed, per in list(pairs):
+        Member.objects.filter(last_billed=last_billed,
+                              membership__per=per).update(
+            next_bill_date=add_n_months(last_billed, per))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0006_auto_20150405_2030'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='member',
+            name='next_bill_date',
+            field=models.DateField(blank=True, null=True, db_index=True, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='membershiplevel',
+            name='per',
+            field=models.PositiveSmallIntegerField(default=1, choices=[(1, '1 month'), (3, '1 quarter'), (12, '1 year')]),
+        ),
+        migrations.RunPython(backfill_next_bill_date,
+                             migrations.RunPython.noop),
+    ]
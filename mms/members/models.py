@@ -1,6 +1,7 @@
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 
+from accounting.cache import balance_cache
 from accounting.models import LedgerAccount, LedgerEntry
 
 
@@ -44,6 +45,48 @@ class MembershipLevel(models.Model):
     def __str__(self):
         return "%s ($%.2f/%s)" % (self.name, self.cost, self.get_per_display())
 
+    def save(self, *args, **kwargs):
+        """Saves the level and, if :py:attr:`per` changed, recomputes
+        :py:attr:`Member.next_bill_date` for its members."""
+        old_per = None
+        if self.pk is not None:
+            old_per = MembershipLevel.objects.filter(pk=self.pk).values_list(
+                'per', flat=True).first()
+        super(MembershipLevel, self).save(*args, **kwargs)
+        if old_per is not None and old_per != self.per:
+            Member.objects.update_next_bill_dates(
+                Member.objects.filter(membership=self))
+
+
+class MemberManager(models.Manager):
+    def due(self, as_of=None):
+        """Returns a :class:`django.db.models.query.QuerySet` of members
+        whose :py:attr:`Member.next_bill_date` is on or before *as_of*,
+        i.e. whose billing is not up to date.
+
+        :param as_of: :class:`datetime.date`; defaults to today.
+        """
+        if as_of is None:
+            as_of = timezone.now().date()
+        return self.filter(membership__isnull=False,
+                           next_bill_date__lte=as_of)
+
+    def update_next_bill_dates(self, queryset=None):
+        """Recomputes the stored :py:attr:`Member.next_bill_date`, with one
+        update per distinct (last billed, billing interval) pair.
+
+        :param queryset: Members to update; defaults to all of them.
+        """
+        if queryset is None:
+            queryset = self.all()
+        queryset.filter(membership__isnull=True).update(next_bill_date=None)
+        pairs = queryset.filter(membership__isnull=False).order_by()
+        pairs = pairs.values_list('last_billed', 'membership__per').distinct()
+        for last_billed, per in list(pairs):
+            queryset.filter(last_billed=last_billed,
+                            membership__per=per).update(
+                next_bill_date=Member.add_n_months(last_billed, per))
+
 
 class Member(models.Model):
     """A member of our august institution.
@@ -60,6 +103,11 @@ class Member(models.Model):
     :param last_billed:
         :class:`django.db.models.DateField` storing the last date this member
         was billed.  Defaults to :func:`django.utils.timezone.now`.
+    :param next_bill_date:
+        :class:`django.db.models.DateField` storing the next date this member
+        is due to be billed: :py:attr:`last_billed` plus the billing interval
+        of :py:attr:`membership`, or None without a membership.  Indexed and
+        kept in sync by :py:meth:`save`; see :py:meth:`MemberManager.due`.
     """
     name = models.CharField(max_length=200)
     email = models.EmailField()
@@ -70,6 +118,10 @@ class Member(models.Model):
         blank=True, null=True)
     membership = models.ForeignKey(MembershipLevel, blank=True, null=True)
     last_billed = models.DateField(default=timezone.now)
+    next_bill_date = models.DateField(blank=True, null=True, editable=False,
+                                      db_index=True)
+
+    objects = MemberManager()
 
     def __str__(self):
         if self.membership is not None:
@@ -121,7 +173,7 @@ class Member(models.Model):
 
         return new
 
-    def _get_next_bill_date(self):
+    def compute_next_bill_date(self):
         """Computes the next billing date for the member.
 
         :return:
@@ -133,7 +185,18 @@ class Member(models.Model):
             return self.add_n_months(self.last_billed, self.membership.per)
         else:
             return None
-    next_bill_date = property(_get_next_bill_date)
+
+    def save(self, *args, **kwargs):
+        """Saves the member, updating :py:attr:`next_bill_date` first."""
+        self.last_billed = self._meta.get_field('last_billed').to_python(
+            self.last_billed)
+        self.next_bill_date = self.compute_next_bill_date()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and (
+                'last_billed' in update_fields or
+                'membership' in update_fields):
+            kwargs['update_fields'] = list(update_fields) + ['next_bill_date']
+        super(Member, self).save(*args, **kwargs)
 
     def _get_billing_up_to_date(self):
         """Determines if the member's billing is up-to-date, i.e. if their
@@ -161,36 +224,61 @@ class Member(models.Model):
             :py:class:`LedgerEntry` object if created,
             None otherwise.
         """
-        # Debit account: member.account
-        # Credit account: member.membership.account
         txn = None
-        if self.membership is not None and self.billing_up_to_date is False:
-            txn = LedgerEntry.objects.create(
-                effective_date=self.next_bill_date,
-                debit_account=self.account,
-                credit_account=self.membership.account,
-                amount=self.membership.cost,
-                details="%s, %s (%s to %s)" % (
-                    self.membership.name,
-                    self.membership.get_per_display(),
-                    self.next_bill_date,
-                    self.add_n_months(self.next_bill_date, self.membership.per)
-                ),
-            )
-            self.last_billed = self.next_bill_date
-            self.save()
+        with transaction.atomic():
+            if self.pk is not None:
+                # Lock the row and pick up any billing done concurrently,
+                # e.g. by a billing run
+                self.last_billed = Member.objects.select_for_update().filter(
+                    pk=self.pk).values_list('last_billed', flat=True).get()
+                self.next_bill_date = self.compute_next_bill_date()
+            if (self.membership is not None and
+                    self.billing_up_to_date is False):
+                txn = self.make_billing_entry(self.next_bill_date)
+                txn.save()
+                self.last_billed = self.next_bill_date
+                self.save()
         return txn
 
+    def make_billing_entry(self, bill_date):
+        """Builds (but does not save) the :py:class:`LedgerEntry` billing
+        this member for the period starting on *bill_date*.
+
+        :param bill_date: :class:`datetime.date` the period starts on.
+        :return: unsaved :py:class:`LedgerEntry`.
+        """
+        # Debit account: member.account
+        # Credit account: member.membership.account
+        return LedgerEntry(
+            effective_date=bill_date,
+            debit_account=self.account,
+            credit_account=self.membership.account,
+            amount=self.membership.cost,
+            details="%s, %s (%s to %s)" % (
+                self.membership.name,
+                self.membership.get_per_display(),
+                bill_date,
+                self.add_n_months(bill_date, self.membership.per)
+            ),
+        )
+
     def _get_balance(self):
         """Retrieve the account balance for the member's account.
 
+        If a balance cache is configured and the account is not loaded yet,
+        this goes through :py:data:`accounting.cache.balance_cache`;
+        otherwise the account is loaded and kept on the instance.
+
         :return:
             None if there is no member account, or
             a decimal value, with positive as a credit owed to the member and
             negative as an amount due from the member
         """
-        if self.account is not None:
-            return self.account.account_balance
-        else:
+        if self.account_id is None:
             return None
+        if balance_cache.cache is None or hasattr(
+                self, self._meta.get_field('account').get_cache_name()):
+            return self.account.account_balance
+        balance = balance_cache.get(self.account_id)
+        return balance.account_balance if balance is not None else None
     balance = property(_get_balance)
@@ -0,0 +1,240 @@
+"""Monthly revenue reports: dues per :py:class:`MembershipLevel` and money
+received and fees per :py:class:`accounting.models.PaymentMethod`.
+
+Figures are summed in the database by month and account, with one grouped
+query over both sides of :py:class:`accounting.models.LedgerEntry`, which
+the (account, effective_date) indexes serve directly.
+
+Months closed with :py:meth:`BalanceSnapshotManager.close_period` can be
+cached.  A month counts as closed once every account in the report has a
+snapshot at or after its last day; a back-dated entry drops those
+snapshots, so the month is computed afresh until it is closed again, and
+the new snapshots give its cached figures a new key.
+
+Settings:
+
+``MMS_REVENUE_REPORT_CACHE``
+    Alias in ``CACHES`` of the cache for closed months.  Defaults to None,
+    which disables caching.
+``MMS_REVENUE_REPORT_CACHE_TTL``
+    Seconds closed months stay cached.  Defaults to one day.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+
+from accounting.models import BalanceSnapshot, LedgerEntry, PaymentMethod
+
+from collections import OrderedDict, defaultdict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from .models import Member, MembershipLevel
+
+REVENUE_REPORT_CACHE = getattr(settings, "MMS_REVENUE_REPORT_CACHE", None)
+REVENUE_REPORT_CACHE_TTL = getattr(settings, "MMS_REVENUE_REPORT_CACHE_TTL",
+                                   86400)
+
+#: Report categories, in output order.
+DUES = 'Dues'
+PAYMENTS = 'Net payments'
+FEES = 'Fees'
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def month_end(day):
+    return Member.add_n_months(month_start(day), 1) - timedelta(days=1)
+
+
+def months_between(start, end):
+    """First days of the months from *start* to *end*, inclusive."""
+    months = []
+    month = month_start(start)
+    while month <= end:
+        months.append(month)
+        month = Member.add_n_months(month, 1)
+    return months
+
+
+def _to_date(value):
+    # date_trunc_sql gives a string on SQLite and a datetime elsewhere
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+
+def _to_decimal(value):
+    return Decimal(str(value or 0)).quantize(Decimal('0.01'))
+
+
+def monthly_totals(accounts, start, end):
+    """Debit and credit totals per month of each of *accounts*, from one
+    grouped query.
+
+    :param accounts: iterable of :py:class:`LedgerAccount` primary keys.
+    :param start: first :class:`datetime.date` to include.
+    :param end: last :class:`datetime.date` to include.
+    :return: dict mapping (first day of month, account primary key) to a
+        (debits, credits) tuple.
+    """
+    accounts = sorted(set(accounts))
+    if not accounts:
+        return {}
+    meta = LedgerEntry._meta
+    qn = connection.ops.quote_name
+    cols = dict((name, qn(meta.get_field(name).column))
+                for name in ('effective_date', 'debit_account',
+                             'credit_account', 'amount'))
+    month = connection.ops.date_trunc_sql('month', cols['effective_date'])
+    date_field = meta.get_field('effective_date')
+    dates = [date_field.get_db_prep_value(d, connection)
+             for d in (start, end)]
+    table = qn(meta.db_table)
+    placeholders = ', '.join(['%s'] * len(accounts))
+
+    def side(account, dr, cr):
+        return ("SELECT %s AS month, %s AS acct, %s AS dr, %s AS cr FROM %s "
+                "WHERE %s IN (%s) AND %s BETWEEN %%s AND %%s" % (
+                    month, account, dr, cr, table, account, placeholders,
+                    cols['effective_date']))
+    sql = ("SELECT month, acct, SUM(dr), SUM(cr) FROM (%s UNION ALL %s) "
+           "sides GROUP BY month, acct" % (
+               side(cols['debit_account'], cols['amount'], '0'),
+               side(cols['credit_account'], '0', cols['amount'])))
+    params = (accounts + dates) * 2
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return dict(((_to_date(m), acct), (_to_decimal(dr), _to_decimal(cr)))
+                    for m, acct, dr, cr in cursor.fetchall())
+
+
+class RevenueReport(object):
+    """Monthly revenue figures.
+
+    :param months: first days of the months covered.
+    :param dues: :class:`collections.OrderedDict` mapping each
+        :py:class:`MembershipLevel` to a dict of month to dues earned, net
+        of reversals.
+    :param payments: like *dues*, mapping each
+        :py:class:`PaymentMethod` to the money received through it, net of
+        fees.
+    :param fees: like *payments*, with the fees paid on it.
+    """
+    def __init__(self, months, dues, payments, fees):
+        self.months = months
+        self.dues = dues
+        self.payments = payments
+        self.fees = fees
+
+    def _sections(self):
+        return ((DUES, self.dues), (PAYMENTS, self.payments),
+                (FEES, self.fees))
+
+    def rows(self):
+        """Yields (category, name, [amount per month], total) for every
+        level and payment method."""
+        for category, section in self._sections():
+            for obj, by_month in section.items():
+                amounts = [by_month.get(m, Decimal('0.00'))
+                           for m in self.months]
+                yield (category, obj.name, amounts,
+                       sum(amounts, Decimal('0.00')))
+
+    def totals(self, category):
+        """Amount per month summed over *category*, e.g. :py:data:`DUES`."""
+        section = dict(self._sections())[category]
+        return [sum((by_month.get(m, Decimal('0.00'))
+                     for by_month in section.values()), Decimal('0.00'))
+                for m in self.months]
+
+
+def _closed_keys(accounts, months):
+    """Cache keys of the *months* closed for all of *accounts*.
+
+    A key names the first snapshot of each account covering the month.
+    Closing later months leaves those alone, whereas re-closing the month
+    after a back-dated entry replaces them with new rows.
+    """
+    snapshots = defaultdict(list)
+    for acct, period_end, pk in BalanceSnapshot.objects.filter(
+            account__in=accounts).values_list('account', 'period_end', 'pk'):
+        snapshots[acct].append((period_end, pk))
+    keys = {}
+    for month in months:
+        end = month_end(month)
+        first = []
+        for acct in accounts:
+            covering = [s for s in snapshots[acct] if s[0] >= end]
+            if not covering:
+                break
+            first.append(min(covering))
+        else:
+            keys[month] = 'mms:revenue:%s:%d' % (
+                month.isoformat(), max(pk for period_end, pk in first))
+    return keys
+
+
+def revenue_report(start, end, use_cache=True):
+    """Computes the :py:class:`RevenueReport` for the months from *start*
+    to *end*.
+
+    :param start: :class:`datetime.date` in the first month.
+    :param end: :class:`datetime.date` in the last month.
+    :param use_cache: look up and store closed months in the
+        ``MMS_REVENUE_REPORT_CACHE`` cache, if one is configured.
+    """
+    months = months_between(start, end)
+    levels = list(MembershipLevel.objects.order_by('name', 'pk'))
+    methods = list(PaymentMethod.objects.order_by('name', 'pk'))
+    accounts = set(level.account_id for level in levels)
+    for m in methods:
+        accounts.update([m.revenue_account_id, m.fee_account_id])
+
+    cache = None
+    if use_cache and REVENUE_REPORT_CACHE is not None and months:
+        cache = caches[REVENUE_REPORT_CACHE]
+    totals = {}
+    keys = {}
+    missing = months
+    if cache is not None and accounts:
+        keys = _closed_keys(accounts, months)
+        cached = cache.get_many(list(keys.values()))
+        for key in keys.values():
+            totals.update(cached.get(key, {}))
+        missing = [m for m in months if keys.get(m) not in cached]
+
+    if missing:
+        computed = monthly_totals(accounts, missing[0],
+                                  month_end(missing[-1]))
+        totals.update(computed)
+        if cache is not None:
+            by_month = defaultdict(dict)
+            for (month, acct), value in computed.items():
+                by_month[month][(month, acct)] = value
+            cache.set_many(dict((keys[m], by_month[m])
+                                for m in missing if m in keys),
+                           REVENUE_REPORT_CACHE_TTL)
+
+    def section(objs, account, credit_normal=False):
+        result = OrderedDict()
+        for obj in objs:
+            by_month = {}
+            for month in months:
+                debits, credits = totals.get((month, account(obj)),
+                                             (Decimal('0.00'),) * 2)
+                by_month[month] = (credits - debits if credit_normal
+                                   else debits - credits)
+            result[obj] = by_month
+        return result
+
+    return RevenueReport(
+        months,
+        section(levels, lambda level: level.account_id, credit_normal=True),
+        section(methods, lambda m: m.revenue_account_id),
+        section(methods, lambda m: m.fee_account_id))
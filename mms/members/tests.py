@@ -1,15 +1,32 @@
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import DatabaseError, connection
 from django.test import TestCase
-from accounting.models import LedgerAccount
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import cache
+from accounting.models import LedgerAccount, LedgerEntry, PaymentMethod, \
+    BalanceSnapshot
+from members import access, reports
+from members.billing import run_billing, bill_shard, get_shards
+from members.forecast import forecast_billing
+from members.importer import import_members, read_csv, read_jsonl
+from members.reports import revenue_report
 from members.models import Member, MembershipLevel
 from datetime import date
 from decimal import Decimal
+import io
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 
 def dttm_to_date(v):
     return date(v.year, v.month, v.day)
 
 
-class MemberTestCase(TestCase):
+class MemberFixturesTestCase(TestCase):
     def setUp(self):
         self.ml_full_monthly = MembershipLevel.objects.create(
             name="Monthly Full",
@@ -80,6 +97,8 @@ class MemberTestCase(TestCase):
             last_billed=date(2011, 1, 1),
         )
 
+
+class MemberTestCase(MemberFixturesTestCase):
     def test_next_bill_date(self):
         self.assertEqual(dttm_to_date(self.member1.next_bill_date),
                          date(2014, 1, 30))
@@ -143,6 +162,215 @@ class MemberTestCase(TestCase):
         self.assertGreater(self.member2.next_bill_date, date.today())
 
 
+class RunBillingTestCase(MemberFixturesTestCase):
+    def test_run_billing(self):
+        run = run_billing(as_of=date(2015, 4, 5))
+        self.assertEqual(run.members, 2)
+        # member1: 2014-01-30, 2014-02-28, then the 28th through 2015-03-28
+        # member2: 2013-02-28, 2014-02-28, 2015-02-28
+        self.assertEqual(run.entries, 18)
+        self.assertEqual(run.amount, Decimal('50.00')*15 + Decimal('1800.00'))
+
+        member1 = Member.objects.get(pk=self.member1.pk)
+        self.assertEqual(member1.last_billed, date(2015, 3, 28))
+        self.assertEqual(member1.balance, Decimal('-750.00'))
+        member2 = Member.objects.get(pk=self.member2.pk)
+        self.assertEqual(member2.last_billed, date(2015, 2, 28))
+        self.assertEqual(member2.balance, Decimal('-1800.00'))
+        self.assertEqual(LedgerAccount.objects.verify_balances(), [])
+
+        self.assertEqual(run_billing(as_of=date(2015, 4, 5)).entries, 0)
+
+    def test_run_billing_matches_do_regular_billing(self):
+        while self.member1.do_regular_billing() is not None:
+            pass
+        expected = list(LedgerEntry.objects.order_by('effective_date')
+                        .values_list('effective_date', 'amount', 'details'))
+        LedgerEntry.objects.all().delete()
+        Member.objects.filter(pk=self.member1.pk).update(
+            last_billed=date(2013, 12, 30))
+        Member.objects.exclude(pk=self.member1.pk).update(membership=None)
+        Member.objects.update_next_bill_dates()
+
+        run_billing(chunk_size=1)
+        self.assertEqual(
+            list(LedgerEntry.objects.order_by('effective_date')
+                 .values_list('effective_date', 'amount', 'details')),
+            expected)
+
+    def test_shards(self):
+        as_of = date(2015, 4, 5)
+        shards = get_shards(as_of, 4)
+        self.assertEqual(shards[0][0], self.member1.pk)
+        self.assertEqual(shards[-1][1], self.member2.pk)
+        for (_, last), (first, _) in zip(shards, shards[1:]):
+            self.assertEqual(first, last + 1)
+
+        run = bill_shard(as_of, self.member2.pk, self.member2.pk)
+        self.assertEqual((run.members, run.entries), (1, 3))
+        run = run_billing(as_of, workers=4)
+        self.assertEqual((run.members, run.entries), (1, 15))
+
+    def test_stale_instance_does_not_double_bill(self):
+        stale = Member.objects.get(pk=self.member1.pk)
+        run_billing(as_of=date.today())
+        self.assertEqual(stale.do_regular_billing(), None)
+        self.assertEqual(LedgerAccount.objects.verify_balances(), [])
+
+
+class NextBillDateTestCase(MemberFixturesTestCase):
+    def test_due(self):
+        self.assertEqual(set(Member.objects.due(date(2014, 1, 30))),
+                         set([self.member1, self.member2]))
+        self.assertEqual(list(Member.objects.due(date(2014, 1, 29))),
+                         [self.member2])
+        self.assertEqual(list(Member.objects.due(date(2013, 2, 27))), [])
+
+    def test_membership_change(self):
+        self.member1.membership = self.ml_full_yearly
+        self.member1.save()
+        self.assertEqual(Member.objects.get(pk=self.member1.pk).next_bill_date,
+                         date(2014, 12, 30))
+        self.member1.membership = None
+        self.member1.save(update_fields=['membership'])
+        self.assertEqual(Member.objects.get(pk=self.member1.pk).next_bill_date,
+                         None)
+
+    def test_level_per_change(self):
+        self.ml_full_monthly.per = MembershipLevel.PER_QUARTER
+        self.ml_full_monthly.save()
+        self.assertEqual(Member.objects.get(pk=self.member1.pk).next_bill_date,
+                         date(2014, 3, 30))
+
+    def test_update_next_bill_dates(self):
+        Member.objects.update(next_bill_date=None)
+        Member.objects.update_next_bill_dates()
+        self.assertEqual(Member.objects.get(pk=self.member1.pk).next_bill_date,
+                         date(2014, 1, 30))
+        self.assertEqual(Member.objects.get(pk=self.member2.pk).next_bill_date,
+                         date(2013, 2, 28))
+        self.assertEqual(Member.objects.get(pk=self.member3.pk).next_bill_date,
+                         None)
+
+
+class AccessCacheTestCase(MemberFixturesTestCase):
+    def setUp(self):
+        super(AccessCacheTestCase, self).setUp()
+        self.cache = access.access_cache
+        self.cache.clear()
+
+    def test_privileges(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(self.cache.check(self.member1.pk, access.KEYFOB))
+            self.assertTrue(self.cache.check(self.member1.pk, access.VOTING))
+            self.assertFalse(self.cache.check(self.member1.pk,
+                                              access.ROOM_KEY))
+            self.assertFalse(self.cache.check(self.member3.pk,
+                                              access.KEYFOB))
+            self.assertEqual(self.cache.get(self.member4.pk).privileges, 0)
+        # Unknown ids are looked up once, then remembered
+        self.assertEqual(self.cache.get(0), None)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.cache.get(0), None)
+
+    def test_arrears(self):
+        self.assertTrue(self.cache.check(self.member1.pk, access.KEYFOB))
+        # One period owed is within the default limit
+        self.member1.do_regular_billing()
+        self.assertTrue(self.cache.check(self.member1.pk, access.KEYFOB))
+        self.member1.do_regular_billing()
+        decision = self.cache.get(self.member1.pk)
+        self.assertTrue(decision.in_arrears)
+        self.assertFalse(decision.allows(access.KEYFOB))
+        self.assertTrue(decision.allows(access.VOTING))
+
+    def test_bulk_billing_invalidates(self):
+        self.assertTrue(self.cache.check(self.member2.pk, access.KEYFOB))
+        run_billing(as_of=date(2015, 4, 5))
+        self.assertFalse(self.cache.check(self.member2.pk, access.KEYFOB))
+
+    def test_level_change_invalidates(self):
+        self.assertFalse(self.cache.check(self.member1.pk, access.ROOM_KEY))
+        self.ml_full_monthly.has_room_key = True
+        self.ml_full_monthly.save()
+        self.assertTrue(self.cache.check(self.member1.pk, access.ROOM_KEY))
+
+    def test_member_change_invalidates(self):
+        self.assertTrue(self.cache.check(self.member1.pk, access.KEYFOB))
+        self.member1.membership = None
+        self.member1.save()
+        self.assertFalse(self.cache.check(self.member1.pk, access.KEYFOB))
+
+    def test_invalidated_during_lookup(self):
+        self.cache.load()
+        self.cache.invalidate_members([self.member1.pk])
+        stale = self.cache._queryset().get(pk=self.member1.pk)
+
+        def first():
+            # The member changes after the lookup has read it
+            self.member1.membership = None
+            self.member1.save()
+            return stale
+
+        racing = mock.Mock()
+        racing.return_value.filter.return_value.first.side_effect = first
+        with mock.patch.object(self.cache, '_queryset', racing):
+            self.assertTrue(self.cache.check(self.member1.pk,
+                                             access.KEYFOB))
+        self.assertFalse(self.cache.check(self.member1.pk, access.KEYFOB))
+
+    def test_export(self):
+        exported = self.cache.export()
+        full = access.KEYFOB | access.VOTING | access.POWERTOOL
+        self.assertEqual(exported['members'],
+                         [[self.member1.pk, full], [self.member2.pk, full]])
+
+
+class MemberAdminTestCase(MemberFixturesTestCase):
+    def setUp(self):
+        super(MemberAdminTestCase, self).setUp()
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+
+    def changelist_queries(self, params=None):
+        url = reverse('admin:members_member_changelist')
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, params or {})
+        self.assertEqual(response.status_code, 200)
+        return len(ctx), response
+
+    def test_changelist_query_count_is_constant(self):
+        small, _ = self.changelist_queries()
+        for i in range(10):
+            Member.objects.create(
+                name="Extra %d" % i,
+                email="extra%d@example.com" % i,
+                account=LedgerAccount.objects.create(
+                    account_type=LedgerAccount.TYPE_LIABILITY),
+                membership=self.ml_full_monthly,
+            )
+        large, _ = self.changelist_queries()
+        self.assertEqual(large, small)
+
+    def test_changelist_sort_by_balance(self):
+        self.member2.do_regular_billing()
+        # balance is the 4th column
+        _, response = self.changelist_queries({'o': '4'})
+        members = list(response.context['cl'].result_list)
+        self.assertEqual(members[0], self.member2)
+        self.assertEqual(members[0].annotated_account_balance,
+                         Decimal('-600.00'))
+        # Member 4 has no account; it sorts as a zero balance
+        self.assertIn(self.member4, members)
+        order = [m.balance_order for m in members]
+        self.assertEqual(order, sorted(order))
+
+    def test_changelist_billing_filter(self):
+        _, response = self.changelist_queries({'billing_up_to_date': '0'})
+        self.assertEqual(set(response.context['cl'].result_list),
+                         set([self.member1, self.member2]))
+
+
 class MemberAddNMonthsTestCase(TestCase):
     def test_jan1_plus_1(self):
         # 1 month after January 1 is February 1
@@ -199,3 +427,225 @@ class MemberAddNMonthsTestCase(TestCase):
         # or February 29
         self.assertEqual(Member.add_n_months(date(2016, 3, 30), -1),
                          date(2016, 2, 29))
+
+
+class RevenueReportTestCase(MemberFixturesTestCase):
+    def setUp(self):
+        super(RevenueReportTestCase, self).setUp()
+        cache.clear()
+        self.method = PaymentMethod.objects.create(
+            name="Credit card", is_recurring=True, is_automated=True,
+            api=PaymentMethod.API_STRIPEIO,
+            revenue_account=LedgerAccount.objects.create(
+                gnucash_account="Assets:Stripe",
+                account_type=LedgerAccount.TYPE_ASSET),
+            fee_account=LedgerAccount.objects.create(
+                gnucash_account="Expenses:Bank Fees",
+                account_type=LedgerAccount.TYPE_EXPENSE))
+        member = self.member1.account
+        for day in (date(2015, 1, 1), date(2015, 1, 31), date(2015, 3, 15)):
+            self.post(member, self.ml_full_monthly.account, "50.00", day)
+            self.post(self.method.revenue_account, member, "50.00", day)
+            self.post(self.method.fee_account, self.method.revenue_account,
+                      "1.75", day)
+        self.post(member, self.ml_full_yearly.account, "600.00",
+                  date(2015, 3, 1))
+        # A refund
+        self.post(self.ml_full_monthly.account, member, "50.00",
+                  date(2015, 3, 20))
+        # Outside the report
+        self.post(member, self.ml_full_monthly.account, "50.00",
+                  date(2015, 4, 1))
+
+    def post(self, debit, credit, amount, day):
+        LedgerEntry.objects.create(debit_account=debit, credit_account=credit,
+                                   amount=amount, details="test",
+                                   effective_date=day)
+
+    def test_report(self):
+        with self.assertNumQueries(3):
+            report = revenue_report(date(2015, 1, 10), date(2015, 3, 31))
+        self.assertEqual(report.months, [date(2015, 1, 1), date(2015, 2, 1),
+                                         date(2015, 3, 1)])
+        self.assertEqual(report.dues[self.ml_full_monthly],
+                         {date(2015, 1, 1): Decimal('100.00'),
+                          date(2015, 2, 1): Decimal('0.00'),
+                          date(2015, 3, 1): Decimal('0.00')})
+        self.assertEqual(report.totals(reports.DUES),
+                         [Decimal('100.00'), Decimal('0.00'),
+                          Decimal('600.00')])
+        self.assertEqual(report.totals(reports.PAYMENTS),
+                         [Decimal('96.50'), Decimal('0.00'),
+                          Decimal('48.25')])
+        self.assertEqual(report.totals(reports.FEES),
+                         [Decimal('3.50'), Decimal('0.00'),
+                          Decimal('1.75')])
+        rows = list(report.rows())
+        self.assertEqual(rows[0][0:2], (reports.DUES, "Monthly Full"))
+        self.assertEqual(rows[0][3], Decimal('100.00'))
+
+    def test_cached_closed_months(self):
+        for month_end in (date(2015, 1, 31), date(2015, 2, 28)):
+            BalanceSnapshot.objects.close_period(month_end)
+        start, end = date(2015, 1, 1), date(2015, 3, 31)
+        with mock.patch.object(reports, 'REVENUE_REPORT_CACHE', 'default'):
+            expected = revenue_report(start, end).totals(reports.DUES)
+            with mock.patch.object(reports, 'monthly_totals',
+                                   wraps=reports.monthly_totals) as totals:
+                self.assertEqual(revenue_report(start, end).totals(
+                    reports.DUES), expected)
+                # Only the open month was computed
+                self.assertEqual(totals.call_args[0][1:],
+                                 (date(2015, 3, 1), date(2015, 3, 31)))
+
+                # A back-dated entry reopens January
+                self.post(self.member1.account, self.ml_full_monthly.account,
+                          "5.00", date(2015, 1, 2))
+                report = revenue_report(start, end)
+                self.assertEqual(totals.call_args[0][1], date(2015, 1, 1))
+                self.assertEqual(report.totals(reports.DUES)[0],
+                                 Decimal('105.00'))
+                BalanceSnapshot.objects.close_period(date(2015, 1, 31))
+                BalanceSnapshot.objects.close_period(date(2015, 2, 28))
+                self.assertEqual(revenue_report(start, end).totals(
+                    reports.DUES)[0], Decimal('105.00'))
+
+    def test_admin(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+        url = reverse('admin:members_membershiplevel_revenue')
+        response = self.client.get(url, {'start': '2015-01',
+                                         'end': '2015-03'})
+        self.assertContains(response, "Monthly Full")
+        response = self.client.get(url, {'start': '2015-01', 'end': '2015-03',
+                                         'format': 'csv'})
+        lines = response.content.decode().splitlines()
+        self.assertEqual(lines[0],
+                         'Category,Name,2015-01,2015-02,2015-03,Total')
+        self.assertIn('Dues,Monthly Full,100.00,0.00,0.00,100.00', lines)
+        self.assertIn('Fees,Credit card,3.50,0.00,1.75,5.25', lines)
+        self.assertEqual(self.client.get(url, {'end': '2015'}).status_code,
+                         400)
+
+
+class ForecastTestCase(MemberFixturesTestCase):
+    def expected(self, start, until):
+        """Forecast the slow way, one member and period at a time."""
+        amounts = {}
+        overdue = 0
+        for member in Member.objects.filter(membership__isnull=False,
+                                            account__isnull=False):
+            bill_date = member.next_bill_date
+            while bill_date < until:
+                if bill_date >= start:
+                    key = (member.membership_id, bill_date.replace(day=1))
+                    amounts[key] = amounts.get(key, 0) + \
+                        member.membership.cost
+                else:
+                    overdue += member.membership.cost
+                bill_date = Member.add_n_months(bill_date,
+                                                member.membership.per)
+        return amounts, overdue
+
+    def test_forecast(self):
+        # Month-end dates exercise add_n_months' clamping
+        for i, last_billed in enumerate([date(2015, 1, 31), date(2015, 1, 31),
+                                         date(2014, 12, 30),
+                                         date(2015, 2, 28)]):
+            Member.objects.create(
+                name="Extra %d" % i, email="extra%d@example.com" % i,
+                membership=self.ml_full_monthly, last_billed=last_billed,
+                account=LedgerAccount.objects.create(
+                    account_type=LedgerAccount.TYPE_LIABILITY))
+
+        with self.assertNumQueries(1):
+            forecast = forecast_billing(24, date(2015, 3, 10))
+        self.assertEqual(len(forecast.months), 24)
+        self.assertEqual(forecast.months[0], date(2015, 3, 1))
+        self.assertEqual((forecast.amounts, forecast.overdue),
+                         self.expected(date(2015, 3, 1), date(2017, 3, 1)))
+        self.assertEqual(forecast.bills[(self.ml_full_monthly.pk,
+                                         date(2015, 3, 1))],
+                         sum(1 for m in Member.objects.filter(
+                             membership=self.ml_full_monthly,
+                             account__isnull=False)))
+        self.assertEqual(sum(forecast.totals()),
+                         sum(total for name, amounts, total
+                             in forecast.rows()))
+
+
+class ImportMembersTestCase(MemberFixturesTestCase):
+    ROSTER = (
+        "name,email,membership,last_billed,opening_balance\n"
+        "Ada,ada@example.com,Monthly Full,2015-01-31,-25.00\n"
+        "Bob,bob@example.com,,,\n"
+        ",nobody@example.com,,,\n"
+        "Cy,not-an-email,,,\n"
+        "Di,di@example.com,Platinum,,\n"
+        "Ed,ed@example.com,%d,2015-02-30,\n"
+        "Flo,flo@example.com,Yearly Full,2015-03-01,12.50\n"
+        "Gus,gus@example.com,,,1.005\n"
+        "Hal,hal@example.com,,,1e30\n"
+    )
+
+    def test_import_csv(self):
+        before = Member.objects.count()
+        roster = self.ROSTER % self.ml_full_yearly.pk
+        run = import_members(read_csv(io.StringIO(roster)), chunk_size=2)
+        self.assertEqual((run.rows, run.members, run.entries), (9, 3, 2))
+        self.assertEqual([e.line for e in run.errors], [4, 5, 6, 7, 9, 10])
+        self.assertIn("out of range", run.errors[5].message)
+        self.assertIn("Unknown membership level 'Platinum'",
+                      run.errors[2].message)
+        self.assertEqual(Member.objects.count(), before + 3)
+
+        ada = Member.objects.get(name="Ada")
+        self.assertEqual(ada.membership, self.ml_full_monthly)
+        self.assertEqual(ada.next_bill_date, date(2015, 2, 28))
+        self.assertEqual(ada.account.account_type,
+                         LedgerAccount.TYPE_LIABILITY)
+        self.assertEqual(ada.account.gnucash_account, '')
+        self.assertEqual(ada.balance, Decimal('-25.00'))
+        self.assertEqual(Member.objects.get(name="Flo").balance,
+                         Decimal('12.50'))
+        bob = Member.objects.get(name="Bob")
+        self.assertIsNone(bob.membership)
+        self.assertIsNone(bob.next_bill_date)
+        self.assertEqual(bob.balance, Decimal('0.00'))
+        self.assertEqual(LedgerAccount.objects.verify_balances(), [])
+        opening = LedgerAccount.objects.get(
+            gnucash_account="Equity:Opening Balances")
+        self.assertEqual(opening.account_balance, Decimal('12.50'))
+
+    def test_import_jsonl(self):
+        roster = '\n'.join([
+            '{"name": "Ada", "email": "ada@example.com", '
+            '"opening_balance": -10}',
+            '[1, 2]',
+            '',
+            'not json',
+            '{"name": "Bob", "email": "bob@example.com"}',
+        ])
+        run = import_members(read_jsonl(io.StringIO(roster)))
+        self.assertEqual(run.members, 2)
+        self.assertEqual([e.line for e in run.errors], [2, 4])
+        self.assertEqual(Member.objects.get(name="Ada").balance,
+                         Decimal('-10.00'))
+
+    def test_failed_chunk(self):
+        roster = "name,email\nAda,ada@example.com\nBob,bob@example.com\n"
+        real_bulk_create = Member.objects.bulk_create
+
+        def bulk_create(objs, *args, **kwargs):
+            if any(m.name == "Bob" for m in objs):
+                raise DatabaseError("Bob is not welcome")
+            return real_bulk_create(objs, *args, **kwargs)
+        with mock.patch.object(Member.objects, 'bulk_create', bulk_create):
+            run = import_members(read_csv(io.StringIO(roster)))
+        self.assertEqual(run.members, 1)
+        self.assertEqual(run.errors[0].line, 3)
+        self.assertFalse(Member.objects.filter(name="Bob").exists())
+        # Bob's account was rolled back with him
+        self.assertFalse(LedgerAccount.objects.filter(
+            member__isnull=True, account_type=LedgerAccount.TYPE_LIABILITY,
+            gnucash_account='').exists())
@@ -7,4 +7,6 @@ urlpatterns = [
     # url(r'^blog/', include('blog.urls')),
 
     url(r'^admin/', include(admin.site.urls)),
+    url(r'^accounting/', include('accounting.urls')),
+    url(r'^stripe/', include('payments_stripe.urls')),
 ]
@@ -0,0 +1 @@
+default_app_config = 'payments_stripe.apps.PaymentsStripeConfig'
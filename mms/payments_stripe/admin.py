@@ -1,6 +1,13 @@
 from django.contrib import admin
 
-from .models import Customer, Charge
+from .models import Customer, Charge, WebhookEvent
 
 admin.site.register(Customer)
 admin.site.register(Charge)
+
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ('stripe_id', 'type', 'received_date', 'processed_date',
+                    'attempts')
+    list_filter = ('type',)
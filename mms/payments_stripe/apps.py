@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class PaymentsStripeConfig(AppConfig):
+    name = 'payments_stripe'
+
+    def ready(self):
+        # Send all Stripe API calls through the pooled client
+        from . import client
+        client.install()
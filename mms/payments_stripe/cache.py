@@ -0,0 +1,125 @@
+"""Caching of Stripe API resources.
+
+Every :py:class:`StripeObjectMixin` model instance memoizes the Stripe
+object it retrieved, and all instances share an optional TTL cache keyed
+by resource type and Stripe ID.  Each ``retrieve`` is a full HTTPS round
+trip, so both layers count their hits and misses in
+:py:data:`stripe_cache`.
+
+Settings:
+
+``STRIPE_CACHE_TTL``
+    Seconds a retrieved object stays in the shared cache.  Defaults to 0,
+    which disables the shared cache; the per-instance memo is always on.
+"""
+from django.conf import settings
+
+import threading
+import time
+
+STRIPE_CACHE_TTL = getattr(settings, "STRIPE_CACHE_TTL", 0)
+
+
+class StripeCache(object):
+    """Process-wide TTL cache of Stripe objects.
+
+    :param ttl: seconds an object stays cached; 0 disables caching.
+    """
+    def __init__(self, ttl=STRIPE_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._objects = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        #: Lookups answered by an instance's memo.
+        self.memo_hits = 0
+        #: Lookups answered by the shared cache.
+        self.hits = 0
+        #: Lookups that had to call the Stripe API.
+        self.misses = 0
+
+    def _get_stats(self):
+        """Hit and miss counters as a dict."""
+        return {'memo_hits': self.memo_hits, 'hits': self.hits,
+                'misses': self.misses}
+    stats = property(_get_stats)
+
+    def get(self, kind, stripe_id, fetch):
+        """Returns the cached object for (*kind*, *stripe_id*), calling
+        *fetch* on a miss and caching its result."""
+        key = (kind, stripe_id)
+        if self.ttl > 0:
+            with self._lock:
+                cached = self._objects.get(key)
+                if cached is not None and cached[0] > time.time():
+                    self.hits += 1
+                    return cached[1]
+        obj = fetch()
+        with self._lock:
+            self.misses += 1
+            if self.ttl > 0:
+                self._objects[key] = (time.time() + self.ttl, obj)
+        return obj
+
+    def put(self, kind, stripe_id, obj):
+        """Caches an object obtained elsewhere, e.g. from a create call."""
+        if self.ttl > 0:
+            with self._lock:
+                self._objects[(kind, stripe_id)] = (time.time() + self.ttl,
+                                                    obj)
+
+    def invalidate(self, kind, stripe_id):
+        with self._lock:
+            self._objects.pop((kind, stripe_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._objects = {}
+
+
+#: Shared :py:class:`StripeCache` for this process.
+stripe_cache = StripeCache()
+
+
+class StripeObjectMixin(object):
+    """Adds cached access to the Stripe object behind a model with a
+    ``stripe_id`` field.
+
+    Subclasses set :py:attr:`stripe_class` to the :mod:`stripe` resource
+    class, e.g. :class:`stripe.Customer`.
+    """
+    stripe_class = None
+
+    def _stripe_kind(self):
+        return self.stripe_class.__name__
+
+    def get_stripe_object(self, refresh=False):
+        """Returns the Stripe object for this instance.
+
+        :param refresh:
+            If True, bypass both caches and retrieve a fresh copy, e.g. to
+            poll for a state change.
+        """
+        memo = getattr(self, '_stripe_object_memo', None)
+        if memo is not None and not refresh:
+            stripe_cache.memo_hits += 1
+            return memo
+        if refresh:
+            stripe_cache.invalidate(self._stripe_kind(), self.stripe_id)
+        obj = stripe_cache.get(
+            self._stripe_kind(), self.stripe_id,
+            lambda: self.stripe_class.retrieve(self.stripe_id))
+        self._stripe_object_memo = obj
+        return obj
+    stripe_object = property(get_stripe_object)
+
+    def set_stripe_object(self, obj):
+        """Seeds both caches with *obj*, e.g. as returned by ``create``."""
+        self._stripe_object_memo = obj
+        stripe_cache.put(self._stripe_kind(), self.stripe_id, obj)
+
+    def invalidate_stripe_object(self):
+        """Drops the cached Stripe object after a mutation."""
+        self._stripe_object_memo = None
+        stripe_cache.invalidate(self._stripe_kind(), self.stripe_id)
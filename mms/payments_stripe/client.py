@@ -0,0 +1,182 @@
+"""Pooled, keep-alive HTTP client for the Stripe API.
+
+By default the :mod:`stripe` library opens a new connection, including a
+TLS handshake, for every API call.  :py:class:`PooledClient` sends all
+calls through one shared :class:`requests.Session` instead, and retries
+rate limited (HTTP 429) and failed (HTTP 5xx, connection errors) requests
+with exponential backoff and full jitter.  Requests that may have reached
+Stripe are only retried if they are safe to repeat: reads, and writes that
+carry an ``Idempotency-Key`` header.
+
+:py:func:`install` is called when the app is loaded.
+
+Settings:
+
+``STRIPE_HTTP_POOL_SIZE``
+    Maximum number of kept-alive connections to Stripe.  Defaults to 10.
+``STRIPE_HTTP_CONNECT_TIMEOUT``
+    Seconds to wait for a connection.  Defaults to 10.
+``STRIPE_HTTP_READ_TIMEOUT``
+    Seconds to wait for a response.  Defaults to 80, as the stripe library.
+``STRIPE_MAX_RETRIES``
+    Retries after the first attempt before giving up.  Defaults to 3.
+``STRIPE_RETRY_BASE_DELAY``
+    Seconds to wait (at most) before the first retry.  Defaults to 0.5.
+``STRIPE_RETRY_MAX_DELAY``
+    Upper bound for any single wait.  Defaults to 30.
+``STRIPE_RATE_LIMIT``
+    Maximum number of requests per second from this process, shared by all
+    threads.  Defaults to 25, Stripe's limit in test mode; None disables
+    the limit.
+"""
+from django.conf import settings
+
+import os
+import random
+from requests.adapters import HTTPAdapter
+import requests
+import stripe
+import stripe.http_client
+import threading
+import time
+
+STRIPE_HTTP_POOL_SIZE = getattr(settings, "STRIPE_HTTP_POOL_SIZE", 10)
+STRIPE_HTTP_CONNECT_TIMEOUT = getattr(settings,
+                                      "STRIPE_HTTP_CONNECT_TIMEOUT", 10)
+STRIPE_HTTP_READ_TIMEOUT = getattr(settings, "STRIPE_HTTP_READ_TIMEOUT", 80)
+STRIPE_MAX_RETRIES = getattr(settings, "STRIPE_MAX_RETRIES", 3)
+STRIPE_RETRY_BASE_DELAY = getattr(settings, "STRIPE_RETRY_BASE_DELAY", 0.5)
+STRIPE_RETRY_MAX_DELAY = getattr(settings, "STRIPE_RETRY_MAX_DELAY", 30.0)
+STRIPE_RATE_LIMIT = getattr(settings, "STRIPE_RATE_LIMIT", 25)
+
+#: HTTP methods that can always be repeated safely.
+IDEMPOTENT_METHODS = ('get', 'head', 'delete')
+
+
+def backoff_delay(attempt, base_delay=STRIPE_RETRY_BASE_DELAY,
+                  max_delay=STRIPE_RETRY_MAX_DELAY):
+    """Seconds to wait before retry number *attempt* (counting from 0):
+    exponential backoff with full jitter."""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+class RateLimiter(object):
+    """Spaces calls to :py:meth:`wait` so that at most *rate* of them
+    start per second, across all threads.
+
+    :param rate: calls per second; None or 0 disables the limit.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + 1.0 / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class PooledClient(stripe.http_client.RequestsClient):
+    """:class:`stripe.http_client.HTTPClient` using a shared, pooled
+    :class:`requests.Session`, with retries.
+
+    :param pool_size: maximum number of kept-alive connections.
+    :param timeout: (connect, read) timeouts in seconds.
+    :param max_retries: retries after the first attempt.
+    :param rate_limit: maximum requests per second, including retries.
+    """
+    name = 'requests-pooled'
+
+    def __init__(self, verify_ssl_certs=True,
+                 pool_size=STRIPE_HTTP_POOL_SIZE,
+                 timeout=(STRIPE_HTTP_CONNECT_TIMEOUT,
+                          STRIPE_HTTP_READ_TIMEOUT),
+                 max_retries=STRIPE_MAX_RETRIES,
+                 base_delay=STRIPE_RETRY_BASE_DELAY,
+                 max_delay=STRIPE_RETRY_MAX_DELAY,
+                 rate_limit=STRIPE_RATE_LIMIT):
+        super(PooledClient, self).__init__(verify_ssl_certs=verify_ssl_certs)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limiter = RateLimiter(rate_limit)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        #: Number of requests that were retried, for monitoring.
+        self.retries = 0
+
+    def _is_safe(self, method, headers):
+        return (method.lower() in IDEMPOTENT_METHODS or
+                'Idempotency-Key' in (headers or {}))
+
+    def _should_retry(self, attempt, method, headers, status_code):
+        if attempt >= self.max_retries:
+            return False
+        if status_code == 429:
+            # Rejected before doing anything, so always safe
+            return True
+        # None stands for a connection error
+        return self._is_safe(method, headers) and (status_code is None or
+                                                   status_code >= 500)
+
+    def _send(self, method, url, headers, post_data):
+        if self._verify_ssl_certs:
+            verify = os.path.join(
+                os.path.dirname(stripe.http_client.__file__),
+                'data/ca-certificates.crt')
+        else:
+            verify = False
+        result = self.session.request(method, url, headers=headers,
+                                      data=post_data, timeout=self.timeout,
+                                      verify=verify)
+        return result.content, result.status_code
+
+    def request(self, method, url, headers, post_data=None):
+        attempt = 0
+        while True:
+            self.limiter.wait()
+            try:
+                content, status_code = self._send(method, url, headers,
+                                                  post_data)
+            except Exception as e:
+                if not self._should_retry(attempt, method, headers, None):
+                    self._handle_request_error(e)
+            else:
+                if not self._should_retry(attempt, method, headers,
+                                          status_code):
+                    return content, status_code
+            with self._lock:
+                self.retries += 1
+            time.sleep(backoff_delay(attempt, self.base_delay,
+                                     self.max_delay))
+            attempt += 1
+
+
+#: Shared :py:class:`PooledClient`, set by :py:func:`install`.
+client = None
+
+
+def install(new_client=None):
+    """Makes every Stripe API call in this process go through *new_client*,
+    by default a :py:class:`PooledClient` configured from the settings.
+
+    :return: the installed client.
+    """
+    global client
+    client = new_client or PooledClient(
+        verify_ssl_certs=stripe.verify_ssl_certs)
+    # Newer versions of the stripe library read this attribute; older ones
+    # create a client per request through the factory function
+    stripe.default_http_client = client
+    stripe.http_client.new_default_http_client = lambda *a, **kw: client
+    return client
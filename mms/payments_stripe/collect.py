@@ -0,0 +1,291 @@
+"""Collection runs: charging every member who owes money and has a card on
+file at Stripe.
+
+A run first records one :py:attr:`Charge.STATE_INIT` charge per member
+with a negative balance, then submits them to Stripe from a bounded thread
+pool, within the rate limit of :py:mod:`payments_stripe.client`.  Results
+are written back as they come in and posted in batches, as by
+:py:func:`payments_stripe.reconcile.apply_batch`.
+
+Each charge is sent with an idempotency key derived from its primary key
+and its primary key in the Stripe metadata, so a run that is interrupted
+can be started again.  Members with a charge in progress are not charged
+again.  A charge left in :py:attr:`Charge.STATE_INIT` may or may not have
+reached Stripe:
+
+- If it is younger than :py:data:`STRIPE_IDEMPOTENCY_WINDOW` and the
+  member still owes its amount, it is resubmitted under the same key,
+  which Stripe answers with the original charge if there was one.
+- Otherwise Stripe may have forgotten the key, or the amount is out of
+  date, so the charge is looked up at Stripe by its metadata.  If found it
+  is recorded as submitted, for the reconciler to finish.  If not, it is
+  marked failed and the member, if they still owe money, gets a new
+  charge for the current amount.  Charges that cannot be looked up are
+  left alone until the next run.
+
+Overlapping runs are serialised while they prepare their charges, by
+:py:func:`prepare_charges` locking the :py:class:`Customer` rows.
+
+Settings:
+
+``STRIPE_IDEMPOTENCY_WINDOW``
+    Seconds a leftover charge may be resubmitted under its idempotency
+    key.  Defaults to 23 hours, a little under the 24 hours Stripe keeps
+    keys for.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from accounting.models import PaymentMethod, balance_annotations
+
+import calendar
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+import stripe
+import time
+
+from .models import Customer, Charge
+from .reconcile import ReconcileRun, apply_batch, call_with_backoff, \
+    get_max_retries
+
+STRIPE_IDEMPOTENCY_WINDOW = getattr(settings, "STRIPE_IDEMPOTENCY_WINDOW",
+                                    23 * 3600)
+
+#: Charges that are neither finished nor failed.
+IN_PROGRESS_STATES = (Charge.STATE_INIT, Charge.STATE_SENT,
+                      Charge.STATE_SUCCESSFUL)
+
+
+class CollectionRun(ReconcileRun):
+    """Summary of a :py:func:`collect_balances` call.
+
+    In addition to the :py:class:`ReconcileRun` counters:
+
+    :param submitted: charges sent to Stripe.
+    :param declined: charges Stripe declined outright.
+    :param amount: total amount of the submitted charges.
+    """
+    def __init__(self):
+        super(CollectionRun, self).__init__()
+        self.submitted = 0
+        self.declined = 0
+        self.amount = 0
+
+    def __str__(self):
+        return "Submitted %d charge(s) for %.2f: %d completed, %d failed, " \
+               "%d declined, %d pending, %d error(s) in %.2fs" % (
+                   self.submitted, self.amount, self.completed, self.failed,
+                   self.declined, self.pending, len(self.errors),
+                   self.elapsed)
+
+
+def get_default_method():
+    """Returns the recurring Stripe :py:class:`PaymentMethod`, or None."""
+    return PaymentMethod.objects.filter(
+        api=PaymentMethod.API_STRIPEIO, is_recurring=True).order_by('pk') \
+        .first()
+
+
+def get_collectable_customers():
+    """Returns a :class:`django.db.models.query.QuerySet` of every
+    :py:class:`Customer` whose member has a negative balance and no charge
+    in progress, annotated with ``annotated_account_balance``."""
+    prefix = 'member__account__'
+    # Compares the totals directly rather than filtering on the annotation,
+    # which SQLite would compare as text against a decimal parameter
+    owing = (Q(**{prefix + 'account_type__lt': 0,
+                  prefix + 'credit_total__gt': F(prefix + 'debit_total')}) |
+             Q(**{prefix + 'account_type__gte': 0,
+                  prefix + 'debit_total__gt': F(prefix + 'credit_total')}))
+    return Customer.objects.annotate(**balance_annotations(prefix)) \
+        .filter(owing).exclude(charge__state__in=IN_PROGRESS_STATES)
+
+
+def idempotency_key(charge):
+    return 'mms-charge-%d' % charge.pk
+
+
+def find_submitted(charge):
+    """Looks up the Stripe charge an earlier submission of *charge*
+    created, by the ``mms_charge`` metadata it was sent with.
+
+    :return: the :class:`stripe.Charge`, or None if there is none.
+    """
+    # Allow for clock skew between us and Stripe
+    created = calendar.timegm(charge.created_date.utctimetuple()) - 600
+    has_more = True
+    starting_after = None
+    while has_more:
+        response = stripe.Charge.all(customer=charge.customer.stripe_id,
+                                     created={'gte': created},
+                                     starting_after=starting_after)
+        for obj in response.data:
+            metadata = obj.get('metadata') or {}
+            if metadata.get('mms_charge') == str(charge.pk):
+                return obj
+        has_more = response.has_more
+        if len(response.data) > 0:
+            starting_after = response.data[-1].id
+    return None
+
+
+def check_leftovers(charges, run, max_retries=0):
+    """Deals with *charges* left in :py:attr:`Charge.STATE_INIT` by an
+    earlier run, as described in the module documentation.
+
+    :return: the charges that could not be looked up, which must not be
+        submitted in this run.
+    """
+    if not charges:
+        return []
+    owed = dict(
+        (cust.pk, -cust.annotated_account_balance)
+        for cust in Customer.objects.annotate(
+            **balance_annotations('member__account__'))
+        .filter(pk__in=set(c.customer_id for c in charges)))
+    cutoff = timezone.now() - timedelta(seconds=STRIPE_IDEMPOTENCY_WINDOW)
+
+    held = []
+    for charge in charges:
+        if charge.created_date >= cutoff and \
+                charge.amount == owed.get(charge.customer_id):
+            # Safe to resubmit under the same key
+            continue
+        try:
+            obj = call_with_backoff(lambda: find_submitted(charge),
+                                    max_retries=max_retries)
+        except Exception as exc:
+            run.errors.append((charge.pk, exc))
+            held.append(charge)
+            continue
+        if obj is None:
+            # Never reached Stripe.  Kept rather than deleted, so that its
+            # primary key, and with it the idempotency key, is not reused.
+            charge.state = Charge.STATE_FAILED
+            charge.save(update_fields=['state'])
+        else:
+            charge.stripe_id = obj.id
+            charge.state = Charge.STATE_SENT
+            charge.save(update_fields=['stripe_id', 'state'])
+            run.pending += 1
+    return held
+
+
+def prepare_charges(method, run, max_retries=0):
+    """Records a :py:attr:`Charge.STATE_INIT` charge for every collectable
+    customer and returns every unsubmitted charge for *method*, including
+    the ones left over from an interrupted run that
+    :py:func:`check_leftovers` keeps.
+
+    Holds a lock on every :py:class:`Customer` row meanwhile, so that an
+    overlapping run waits and then finds these charges in progress rather
+    than charging the same members again."""
+    with transaction.atomic():
+        list(Customer.objects.select_for_update().order_by('pk')
+             .values_list('pk', flat=True))
+        held = check_leftovers(
+            list(Charge.objects.filter(state=Charge.STATE_INIT,
+                                       payment_method=method)
+                 .select_related('customer')),
+            run, max_retries)
+        Charge.objects.bulk_create([
+            Charge(customer_id=cust.pk, payment_method=method,
+                   amount=-cust.annotated_account_balance,
+                   state=Charge.STATE_INIT)
+            for cust in get_collectable_customers()])
+    return list(Charge.objects.filter(state=Charge.STATE_INIT,
+                                      payment_method=method)
+                .exclude(pk__in=[c.pk for c in held])
+                .select_related('customer').order_by('pk'))
+
+
+def _submit(args):
+    charge, description, max_retries = args
+    try:
+        obj = call_with_backoff(
+            lambda: stripe.Charge.create(
+                idempotency_key=idempotency_key(charge),
+                amount=int(charge.amount*100),
+                currency=charge.currency,
+                customer=charge.customer.stripe_id,
+                description=description,
+                metadata={'mms_charge': charge.pk},
+            ), max_retries=max_retries)
+    except Exception as exc:
+        return charge, None, exc
+    charge.stripe_id = obj.id
+    charge.state = Charge.STATE_SENT
+    charge.set_stripe_object(obj)
+    try:
+        return charge, call_with_backoff(
+            lambda: charge.fetch_stripe_state(refresh=False),
+            max_retries=max_retries), None
+    except Exception:
+        # Submitted; the reconciler picks it up from here
+        return charge, (None, None), None
+
+
+def _record(charge, exc, run):
+    """Writes a submission result to the charge row."""
+    if exc is None:
+        run.submitted += 1
+        run.amount += charge.amount
+        charge.save(update_fields=['stripe_id', 'state'])
+    elif isinstance(exc, stripe.error.CardError):
+        # Declined by Stripe, which keeps the failed charge
+        run.declined += 1
+        body = getattr(exc, 'json_body', None) or {}
+        charge.stripe_id = body.get('error', {}).get('charge') or ''
+        charge.state = Charge.STATE_FAILED
+        charge.save(update_fields=['stripe_id', 'state'])
+    # Other errors leave the charge unsubmitted, to be retried next run
+
+
+def collect_balances(method=None, description="Membership dues", workers=4,
+                     batch_size=100, max_retries=None):
+    """Charges every member with a negative balance and a
+    :py:class:`Customer` the amount they owe.
+
+    :param method: :py:class:`PaymentMethod` to charge through; defaults
+        to :py:func:`get_default_method`.
+    :param workers: maximum number of concurrent Stripe requests.
+    :param batch_size: number of charges posted per transaction.
+    :param max_retries: retries per charge on rate limiting or errors; see
+        :py:func:`payments_stripe.reconcile.get_max_retries`.
+    :return: :py:class:`CollectionRun` summary.
+    """
+    run = CollectionRun()
+    start = time.time()
+    max_retries = get_max_retries(max_retries)
+    if method is None:
+        method = get_default_method()
+        if method is None:
+            raise PaymentMethod.DoesNotExist(
+                "No recurring Stripe payment method")
+
+    charges = prepare_charges(method, run, max_retries)
+    pool = ThreadPool(workers)
+    try:
+        results = pool.imap_unordered(
+            _submit, [(c, description, max_retries) for c in charges])
+        batch = []
+        for charge, state, exc in results:
+            run.checked += 1
+            _record(charge, exc, run)
+            if exc is not None:
+                if not isinstance(exc, stripe.error.CardError):
+                    run.errors.append((charge.pk, exc))
+                continue
+            batch.append((charge, state, None))
+            if len(batch) >= batch_size:
+                apply_batch(batch, run)
+                batch = []
+        apply_batch(batch, run)
+    finally:
+        pool.close()
+        pool.join()
+
+    run.elapsed = time.time() - start
+    return run
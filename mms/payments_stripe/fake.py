@@ -0,0 +1,425 @@
+"""A local stand-in for the Stripe API, for tests and benchmarks.
+
+:py:class:`FakeStripe` implements the parts of the API this app uses --
+customers, their card sources, charges with their metadata, and charge and
+balance transaction listings, with pagination and idempotency keys -- and
+can add latency, server errors and rate limiting.
+:py:class:`FakeStripeServer` serves it over HTTP on localhost and points
+:data:`stripe.api_base` at it, so the models run against it unchanged::
+
+    with FakeStripeServer(FakeStripe(latency=0.05, rate_limit=100)):
+        Customer.objects.create_customer(member)
+
+Every request is recorded in :py:attr:`FakeStripe.log`.
+
+Tokens ``tok_chargeDeclined`` and ``tok_pending`` give cards whose charges
+are declined or stay pending until :py:meth:`FakeStripe.settle`; any other
+token gives a working card.
+"""
+from django.utils.six.moves import BaseHTTPServer, socketserver
+from django.utils.six.moves.urllib.parse import parse_qsl, urlparse
+
+import json
+import random
+import re
+import stripe
+import threading
+import time
+
+DECLINE_TOKEN = 'tok_chargeDeclined'
+PENDING_TOKEN = 'tok_pending'
+
+
+class FakeStripe(object):
+    """In-memory Stripe API.
+
+    :param latency: seconds added to every response.
+    :param failure_rate: fraction of requests answered with HTTP 500.
+    :param rate_limit: requests per second above which requests are
+        answered with HTTP 429; None for no limit.
+    :param page_size: default ``limit`` of list requests.
+    :param seed: seed for the failure draws, for reproducible runs.
+    """
+    def __init__(self, latency=0.0, failure_rate=0.0, rate_limit=None,
+                 page_size=10, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rate_limit = rate_limit
+        self.page_size = page_size
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._recent = []
+        self._forced = []
+        self.customers = {}
+        self.cards = {}
+        self.charges = {}
+        self.balance_transactions = {}
+        self._idempotent = {}
+        #: (method, path, status) of every request, in order.
+        self.log = []
+
+        self._routes = [
+            ('post', r'^/v1/customers$', self._create_customer),
+            ('get', r'^/v1/customers/(?P<cus>[^/]+)$', self._get_customer),
+            ('post', r'^/v1/customers/(?P<cus>[^/]+)$',
+             self._update_customer),
+            ('get', r'^/v1/customers/(?P<cus>[^/]+)/sources$',
+             self._list_sources),
+            ('post', r'^/v1/customers/(?P<cus>[^/]+)/sources$',
+             self._create_source),
+            # Older versions of the library address cards as cards/
+            ('get', r'^/v1/customers/(?P<cus>[^/]+)/(?:sources|cards)/'
+                    r'(?P<card>[^/]+)$', self._get_source),
+            ('delete', r'^/v1/customers/(?P<cus>[^/]+)/(?:sources|cards)/'
+                       r'(?P<card>[^/]+)$', self._delete_source),
+            ('get', r'^/v1/charges$', self._list_charges),
+            ('post', r'^/v1/charges$', self._create_charge),
+            ('get', r'^/v1/charges/(?P<ch>[^/]+)$', self._get_charge),
+            ('get', r'^/v1/balance/history$', self._list_balance),
+        ]
+
+    # Fault injection
+
+    def fail_next(self, count=1, status=500):
+        """Answers the next *count* requests with HTTP *status*."""
+        with self._lock:
+            self._forced.extend([status] * count)
+
+    def _fault(self):
+        with self._lock:
+            if self._forced:
+                return self._forced.pop(0)
+            if self.rate_limit:
+                now = time.time()
+                self._recent = [t for t in self._recent if now - t < 1.0]
+                if len(self._recent) >= self.rate_limit:
+                    return 429
+                self._recent.append(now)
+            if self.failure_rate and \
+                    self._random.random() < self.failure_rate:
+                return 500
+        return None
+
+    # Request handling
+
+    def handle(self, method, path, params, headers):
+        """Answers one API request.
+
+        :param method: lower case HTTP method.
+        :param params: dict of query or form parameters.
+        :param headers: dict of request headers.
+        :return: (HTTP status, JSON-serializable body) tuple.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        status, body = self._dispatch(method, path, params, headers)
+        with self._lock:
+            self.log.append((method, path, status))
+        return status, body
+
+    def _dispatch(self, method, path, params, headers):
+        forced = self._fault()
+        if forced == 429:
+            return 429, self._error('rate_limit_error',
+                                    "Too many requests hit the API too "
+                                    "quickly.")
+        if forced is not None:
+            return forced, self._error('api_error', "Injected failure")
+
+        key = headers.get('Idempotency-Key')
+        if method == 'post' and key:
+            with self._lock:
+                if key in self._idempotent:
+                    return self._idempotent[key]
+
+        for route_method, pattern, view in self._routes:
+            match = re.match(pattern, path)
+            if route_method == method and match:
+                break
+        else:
+            return 404, self._error('invalid_request_error',
+                                    "Unrecognized request URL (%s: %s)" % (
+                                        method.upper(), path))
+
+        with self._lock:
+            result = view(params, **match.groupdict())
+            if method == 'post' and key:
+                self._idempotent[key] = result
+        return result
+
+    def _error(self, kind, message, **extra):
+        error = {'type': kind, 'message': message}
+        error.update(extra)
+        return {'error': error}
+
+    def _missing(self, kind, id):
+        return 404, self._error('invalid_request_error',
+                                "No such %s: %s" % (kind, id), param='id')
+
+    def _next_id(self, prefix):
+        self._counters[prefix] = self._counters.get(prefix, 0) + 1
+        return '%s_%06d' % (prefix, self._counters[prefix])
+
+    def _page(self, url, items, params):
+        """A list object of *items* after ``starting_after``."""
+        limit = int(params.get('limit') or self.page_size)
+        start = 0
+        after = params.get('starting_after')
+        if after:
+            ids = [item['id'] for item in items]
+            if after in ids:
+                start = ids.index(after) + 1
+        page = items[start:start + limit]
+        return {'object': 'list', 'url': url, 'data': page,
+                'has_more': start + limit < len(items)}
+
+    # Customers and cards
+
+    def _customer(self, cus):
+        customer = dict(self.customers[cus])
+        cards = [self.cards[c] for c in customer.pop('card_ids')]
+        customer['sources'] = self._page('/v1/customers/%s/sources' % cus,
+                                         cards, {})
+        return customer
+
+    def _add_card(self, cus, token):
+        card = {'id': self._next_id('card'), 'object': 'card',
+                'customer': cus, 'brand': 'Visa', 'last4': '4242',
+                'token': token}
+        self.cards[card['id']] = card
+        self.customers[cus]['card_ids'].append(card['id'])
+        return card
+
+    def _create_customer(self, params):
+        cus = self._next_id('cus')
+        self.customers[cus] = {
+            'id': cus, 'object': 'customer', 'created': int(time.time()),
+            'description': params.get('description'),
+            'email': params.get('email'), 'default_source': None,
+            'card_ids': [],
+        }
+        return self._update_customer(params, cus)
+
+    def _get_customer(self, params, cus):
+        if cus not in self.customers:
+            return self._missing('customer', cus)
+        return 200, self._customer(cus)
+
+    def _update_customer(self, params, cus):
+        if cus not in self.customers:
+            return self._missing('customer', cus)
+        customer = self.customers[cus]
+        for field in ('description', 'email'):
+            if field in params:
+                customer[field] = params[field]
+        if params.get('source'):
+            customer['default_source'] = self._add_card(
+                cus, params['source'])['id']
+        if params.get('default_source'):
+            customer['default_source'] = params['default_source']
+        return 200, self._customer(cus)
+
+    def _list_sources(self, params, cus):
+        if cus not in self.customers:
+            return self._missing('customer', cus)
+        cards = [self.cards[c] for c in self.customers[cus]['card_ids']]
+        return 200, self._page('/v1/customers/%s/sources' % cus, cards,
+                               params)
+
+    def _create_source(self, params, cus):
+        if cus not in self.customers:
+            return self._missing('customer', cus)
+        card = self._add_card(cus, params.get('card') or
+                              params.get('source'))
+        if self.customers[cus]['default_source'] is None:
+            self.customers[cus]['default_source'] = card['id']
+        return 200, card
+
+    def _get_source(self, params, cus, card):
+        if card not in self.cards or self.cards[card]['customer'] != cus:
+            return self._missing('source', card)
+        return 200, self.cards[card]
+
+    def _delete_source(self, params, cus, card):
+        if card not in self.cards or self.cards[card]['customer'] != cus:
+            return self._missing('source', card)
+        del self.cards[card]
+        customer = self.customers[cus]
+        customer['card_ids'].remove(card)
+        if customer['default_source'] == card:
+            customer['default_source'] = (customer['card_ids'] or [None])[0]
+        return 200, {'id': card, 'object': 'card', 'deleted': True}
+
+    # Charges and balance transactions
+
+    def _create_charge(self, params):
+        cus = params.get('customer')
+        if cus not in self.customers:
+            return self._missing('customer', cus)
+        card = self.cards.get(params.get('source') or
+                              self.customers[cus]['default_source'])
+        if card is None:
+            return 402, self._error('card_error',
+                                    "Cannot charge a customer that has no "
+                                    "active card", code='missing')
+
+        amount = int(params['amount'])
+        charge = {
+            'id': self._next_id('ch'), 'object': 'charge',
+            'created': int(time.time()), 'amount': amount,
+            'currency': params.get('currency', 'usd'), 'customer': cus,
+            'source': card, 'description': params.get('description'),
+            'statement_descriptor': params.get('statement_descriptor'),
+            'status': 'succeeded', 'paid': True, 'refunded': False,
+            'balance_transaction': None,
+            'metadata': _nested(params, 'metadata'),
+        }
+        self.charges[charge['id']] = charge
+
+        if card['token'] == DECLINE_TOKEN:
+            charge.update(status='failed', paid=False)
+            return 402, self._error('card_error', "Your card was declined.",
+                                    code='card_declined',
+                                    charge=charge['id'])
+        if card['token'] == PENDING_TOKEN:
+            charge.update(status='pending', paid=False)
+        else:
+            self._settle(charge)
+        return 200, charge
+
+    def _settle(self, charge):
+        fee = amount_fee(charge['amount'])
+        txn = {'id': self._next_id('txn'), 'object': 'balance_transaction',
+               'source': charge['id'], 'amount': charge['amount'],
+               'fee': fee, 'net': charge['amount'] - fee,
+               'currency': charge['currency'], 'type': 'charge',
+               'created': int(time.time())}
+        self.balance_transactions[txn['id']] = txn
+        charge.update(status='succeeded', paid=True,
+                      balance_transaction=txn['id'])
+
+    def settle(self, charge_id=None):
+        """Lets one or every pending charge succeed."""
+        with self._lock:
+            for charge in self.charges.values():
+                if charge['status'] == 'pending' and \
+                        charge_id in (None, charge['id']):
+                    self._settle(charge)
+
+    def _get_charge(self, params, ch):
+        if ch not in self.charges:
+            return self._missing('charge', ch)
+        return 200, self.charges[ch]
+
+    def _list_charges(self, params):
+        created = _nested(params, 'created')
+        if 'created' in params:
+            created['eq'] = params['created']
+        charges = [c for c in self.charges.values()
+                   if params.get('customer') in (None, c['customer']) and
+                   all(_COMPARE[op](c['created'], int(value))
+                       for op, value in created.items())]
+        # Newest first, as Stripe lists them
+        charges.sort(key=lambda c: c['id'], reverse=True)
+        return 200, self._page('/v1/charges', charges, params)
+
+    def _list_balance(self, params):
+        txns = sorted((t for t in self.balance_transactions.values()
+                       if params.get('source') in (None, t['source'])),
+                      key=lambda t: t['id'])
+        return 200, self._page('/v1/balance/history', txns, params)
+
+
+_COMPARE = {
+    'eq': lambda a, b: a == b,
+    'gt': lambda a, b: a > b,
+    'gte': lambda a, b: a >= b,
+    'lt': lambda a, b: a < b,
+    'lte': lambda a, b: a <= b,
+}
+
+
+def _nested(params, name):
+    """The ``name[key]`` form parameters in *params*, as a dict."""
+    prefix = name + '['
+    return dict((key[len(prefix):-1], value)
+                for key, value in params.items()
+                if key.startswith(prefix) and key.endswith(']'))
+
+
+def amount_fee(amount):
+    """Stripe's standard fee, in cents, for a charge of *amount* cents."""
+    return int(round(amount * 0.029)) + 30
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep connections alive, as the real API does
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self):
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length).decode('utf-8')
+            params.update(parse_qsl(body))
+        status, body = self.server.fake.handle(
+            self.command.lower(), url.path, params, dict(self.headers))
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_DELETE = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeStripeServer(object):
+    """Serves a :py:class:`FakeStripe` on localhost from a background
+    thread.  Used as a context manager, it also points
+    :data:`stripe.api_base` at the server for the duration.
+
+    :param fake: the API to serve; a default :py:class:`FakeStripe` if
+        None.
+    :param port: port to listen on; 0 picks a free one.
+    """
+    def __init__(self, fake=None, host='127.0.0.1', port=0):
+        self.fake = fake or FakeStripe()
+        self.httpd = _Server((host, port), _Handler)
+        self.httpd.fake = self.fake
+        self._thread = None
+        self._old_api_base = None
+
+    def _get_url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+    url = property(_get_url)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        self._old_api_base = stripe.api_base
+        stripe.api_base = self.url
+        return self
+
+    def __exit__(self, *exc_info):
+        stripe.api_base = self._old_api_base
+        self.stop()
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounting.models import PaymentMethod
+from payments_stripe.collect import collect_balances
+
+
+class Command(BaseCommand):
+    help = ("Charges every member with a negative balance and a card on "
+            "file the amount they owe.  Safe to run again after an "
+            "interruption.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--method', dest='method', type=int, default=None,
+            help="Primary key of the payment method to charge through "
+                 "(default: the recurring Stripe method).")
+        parser.add_argument(
+            '--description', dest='description', default="Membership dues",
+            help="Charge description shown to the member.")
+        parser.add_argument(
+            '--workers', dest='workers', type=int, default=4,
+            help="Maximum number of concurrent Stripe requests.")
+        parser.add_argument(
+            '--batch-size', dest='batch_size', type=int, default=100,
+            help="Number of charges to post per transaction.")
+
+    def handle(self, *args, **options):
+        method = None
+        if options['method'] is not None:
+            try:
+                method = PaymentMethod.objects.get(pk=options['method'])
+            except PaymentMethod.DoesNotExist:
+                raise CommandError("No payment method %s" % options['method'])
+        try:
+            run = collect_balances(method=method,
+                                   description=options['description'],
+                                   workers=options['workers'],
+                                   batch_size=options['batch_size'])
+        except PaymentMethod.DoesNotExist as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(str(run))
+        for pk, exc in run.errors:
+            self.stderr.write("Charge %s: %s" % (pk, exc))
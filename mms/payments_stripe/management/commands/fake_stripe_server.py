@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+
+from payments_stripe.fake import FakeStripe, FakeStripeServer
+
+import time
+
+
+class Command(BaseCommand):
+    help = ("Serves a local stand-in for the Stripe API.  Point other "
+            "processes at it with the STRIPE_API_BASE setting.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--port', dest='port', type=int, default=12111,
+            help="Port to listen on.")
+        parser.add_argument(
+            '--latency', dest='latency', type=float, default=0.0,
+            help="Seconds added to every response.")
+        parser.add_argument(
+            '--failure-rate', dest='failure_rate', type=float, default=0.0,
+            help="Fraction of requests answered with HTTP 500.")
+        parser.add_argument(
+            '--rate-limit', dest='rate_limit', type=int, default=None,
+            help="Requests per second above which HTTP 429 is returned.")
+        parser.add_argument(
+            '--seed', dest='seed', type=int, default=0,
+            help="Seed for the failure draws.")
+
+    def handle(self, *args, **options):
+        fake = FakeStripe(latency=options['latency'],
+                          failure_rate=options['failure_rate'],
+                          rate_limit=options['rate_limit'],
+                          seed=options['seed'])
+        server = FakeStripeServer(fake, port=options['port'])
+        server.start()
+        self.stdout.write("Fake Stripe API at %s" % server.url)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
+            self.stdout.write("Served %d request(s)" % len(fake.log))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from payments_stripe.webhooks import process_events
+
+
+class Command(BaseCommand):
+    help = "Applies pending Stripe webhook events in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', dest='batch_size', type=int, default=100,
+            help="Number of events to apply per transaction.")
+        parser.add_argument(
+            '--max-attempts', dest='max_attempts', type=int, default=5,
+            help="Skip events that have failed this many times.")
+
+    def handle(self, *args, **options):
+        total_processed = total_failed = 0
+        while True:
+            processed, failed = process_events(options['batch_size'],
+                                               options['max_attempts'])
+            total_processed += processed
+            total_failed += failed
+            if processed == 0 or processed + failed < options['batch_size']:
+                break
+        self.stdout.write("Processed %d event(s), %d failure(s)." % (
+            total_processed, total_failed))
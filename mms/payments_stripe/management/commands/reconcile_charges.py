@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from payments_stripe.reconcile import reconcile_charges
+
+
+class Command(BaseCommand):
+    help = ("Looks up every submitted or successful charge at Stripe and "
+            "posts the ledger entries for those that went through.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', dest='workers', type=int, default=8,
+            help="Maximum number of concurrent Stripe requests.")
+        parser.add_argument(
+            '--batch-size', dest='batch_size', type=int, default=100,
+            help="Number of charges to apply per transaction.")
+
+    def handle(self, *args, **options):
+        run = reconcile_charges(workers=options['workers'],
+                                batch_size=options['batch_size'])
+        self.stdout.write(str(run))
+        for pk, exc in run.errors:
+            self.stderr.write("Charge %s: %s" % (pk, exc))
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments_stripe', '0005_auto_20150405_1903'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='charge',
+            name='state',
+            field=models.PositiveSmallIntegerField(db_index=True, default=0, choices=[(0, 'Unprocessed'), (1, 'Submitted'), (2, 'Successful'), (3, 'Failed'), (4, 'Completed')]),
+        ),
+    ]
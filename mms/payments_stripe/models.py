@@ -1,13 +1,18 @@
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 
 from members.models import Member
 from accounting.models import PaymentMethod, LedgerEntry
 
 from decimal import Decimal
+import json
 import stripe
+import uuid
+
+from .cache import StripeObjectMixin
 
 stripe.api_key = getattr(settings, "STRIPE_SECRET_KEY", None)
+stripe.api_base = getattr(settings, "STRIPE_API_BASE", stripe.api_base)
 currency = getattr(settings, "DEFAULT_CURRENCY_CODE", None)
 
 
@@ -21,30 +26,30 @@ class CustomerManager(models.Manager):
         )
 
         cust = self.create(member=member, stripe_id=obj.id)
+        cust.set_stripe_object(obj)
 
         return cust
 
 
-class Customer(models.Model):
+class Customer(StripeObjectMixin, models.Model):
     member = models.OneToOneField(Member)
     stripe_id = models.CharField(max_length=200)
 
     objects = CustomerManager()
 
+    stripe_class = stripe.Customer
+
     def __str__(self):
         return "%s - %s" % (self.member.name, self.stripe_id)
 
-    def get_stripe_object(self):
-        return stripe.Customer.retrieve(self.stripe_id)
-    stripe_object = property(get_stripe_object)
-
     # Card management
     def get_cards(self):
         result = []
         has_more = True
         starting_after = None
+        sources = self.stripe_object.sources
         while has_more:
-            response = self.stripe_object.sources.all(
+            response = sources.all(
                 object='card',
                 starting_after=starting_after)
             has_more = response.has_more
@@ -71,16 +76,28 @@ class Customer(models.Model):
             cust.save()
         else:
             self.stripe_object.sources.create(card=token)
+        self.invalidate_stripe_object()
 
     def delete_card(self, card_id):
-        return self.get_card(card_id).delete()
+        result = self.get_card(card_id).delete()
+        self.invalidate_stripe_object()
+        return result
 
 
 class ChargeManager(models.Manager):
     def create_charge(self, customer, amount, method, description,
-                      descriptor=None):
-        """Expects amount in Decimal (3.50)"""
+                      descriptor=None, idempotency_key=None):
+        """Expects amount in Decimal (3.50)
+
+        :param idempotency_key:
+            Sent to Stripe so that retrying the request cannot charge the
+            customer twice.  A random one is used if not given; pass a
+            stable one to make retries by the caller safe as well.
+        """
+        if idempotency_key is None:
+            idempotency_key = str(uuid.uuid4())
         obj = stripe.Charge.create(
+            idempotency_key=idempotency_key,
             amount=int(amount*100),
             currency=currency,
             customer=customer.stripe_id,
@@ -96,13 +113,80 @@ class ChargeManager(models.Manager):
             currency=currency,
             state=Charge.STATE_SENT,
         )
+        chrg.set_stripe_object(obj)
+        customer.invalidate_stripe_object()
 
-        chrg.state_update()
+        chrg.state_update(refresh=False)
 
         return chrg
 
-
-class Charge(models.Model):
+    def post_successful(self, postings):
+        """Posts the ledger entries of many successful charges at once.
+
+        Builds the gross and fee :py:class:`LedgerEntry` rows of every
+        charge in memory, inserts them with
+        :py:meth:`accounting.models.LedgerEntryManager.bulk_post`, links them
+        to their charges with a single insert and marks the charges
+        :py:attr:`Charge.STATE_COMPLETED`, all in one transaction.  Charges
+        that are no longer :py:attr:`Charge.STATE_SUCCESSFUL` in the
+        database, e.g. because another process posted them first, are
+        skipped.
+
+        :param postings: iterable of (charge, amounts) pairs, with amounts
+            as returned by :py:meth:`Charge.fetch_stripe_state`.
+        :return: list of the charges that were posted.
+        """
+        postings = dict((charge.pk, (charge, amounts))
+                        for charge, amounts in postings)
+        if not postings:
+            return []
+
+        with transaction.atomic():
+            pks = list(self.select_for_update()
+                       .filter(pk__in=postings.keys(),
+                               state=Charge.STATE_SUCCESSFUL)
+                       .order_by('pk').values_list('pk', flat=True))
+            rows = (self.filter(pk__in=pks)
+                    .select_related('payment_method', 'customer__member'))
+
+            posted = []
+            entries = []
+            for row in rows:
+                charge, amounts = postings[row.pk]
+                method = row.payment_method
+                details = '%s txn %s' % (method, row.stripe_id)
+                links = []
+                for amts in amounts:
+                    # Full amount and transaction fee
+                    links.append(LedgerEntry(
+                        debit_account_id=method.revenue_account_id,
+                        credit_account_id=row.customer.member.account_id,
+                        amount=amts['amount'],
+                        details=details,
+                    ))
+                    links.append(LedgerEntry(
+                        debit_account_id=method.fee_account_id,
+                        credit_account_id=method.revenue_account_id,
+                        amount=amts['fee'],
+                        details='%s fees' % details,
+                    ))
+                entries.extend(links)
+                posted.append((charge, links))
+
+            LedgerEntry.objects.bulk_post(entries, need_pks=True)
+            through = Charge.transaction.through
+            through.objects.bulk_create([
+                through(charge_id=charge.pk, ledgerentry_id=entry.pk)
+                for charge, links in posted for entry in links])
+            self.filter(pk__in=[charge.pk for charge, links in posted]) \
+                .update(state=Charge.STATE_COMPLETED)
+
+        for charge, links in posted:
+            charge.state = Charge.STATE_COMPLETED
+        return [charge for charge, links in posted]
+
+
+class Charge(StripeObjectMixin, models.Model):
     """A charge against a customer's card.
 
     Responsible for creating LedgerEntries for:
@@ -132,11 +216,14 @@ class Charge(models.Model):
     currency = models.CharField(max_length=3,
                                 default=currency)
     state = models.PositiveSmallIntegerField(choices=STATE_CHOICES,
-                                             default=STATE_INIT)
+                                             default=STATE_INIT,
+                                             db_index=True)
     transaction = models.ManyToManyField(LedgerEntry)
 
     objects = ChargeManager()
 
+    stripe_class = stripe.Charge
+
     def __str__(self):
         if self.stripe_id is not None and len(self.stripe_id) > 0:
             return "%.2f from %s (%s, %s)" % (
@@ -146,10 +233,6 @@ class Charge(models.Model):
             return "%.2f from %s (%s)" % (self.amount, self.customer,
                                           self.get_state_display())
 
-    def get_stripe_object(self):
-        return stripe.Charge.retrieve(self.stripe_id)
-    stripe_object = property(get_stripe_object)
-
     def get_stripe_balance_transactions(self):
         result = []
         has_more = True
@@ -165,45 +248,140 @@ class Charge(models.Model):
         return result
     stripe_balance_transactions = property(get_stripe_balance_transactions)
 
+    @staticmethod
+    def balance_transaction_amounts(bt):
+        """Converts a Stripe balance transaction (object or plain dict, e.g.
+        from a webhook payload) into the decimal amounts used for
+        posting."""
+        return {'amount': Decimal(bt['amount'])/100,
+                'fee':    Decimal(bt['fee'])/100,
+                'net':    Decimal(bt['net'])/100}
+
     def get_transaction_amounts(self):
         for bt in self.stripe_balance_transactions:
-            yield {'amount': Decimal(bt.amount)/100,
-                   'fee':    Decimal(bt.fee)/100,
-                   'net':    Decimal(bt.net)/100}
+            yield self.balance_transaction_amounts(bt)
     transaction_amounts = property(get_transaction_amounts)
 
-    def state_update(self):
+    def fetch_stripe_state(self, refresh=True):
+        """Retrieves everything :py:meth:`apply_stripe_state` needs from
+        Stripe, without touching the database.
+
+        :param refresh:
+            Retrieve a fresh copy of the Stripe charge rather than using a
+            cached one.  Only pass False right after creating it.
+        :return:
+            (status, amounts) tuple: the Stripe charge status if the charge
+            is still :py:attr:`STATE_SENT` (otherwise None), and the list of
+            :py:attr:`transaction_amounts` if the charge is or has just
+            become successful (otherwise None).
+        """
+        status = None
+        amounts = None
         if self.state == self.STATE_SENT:
-            # transaction has been sent, but is in purgatory
-            if self.stripe_object.status == 'succeeded':
-                self.state = self.STATE_SUCCESSFUL
-                self.save()
-            if self.stripe_object.status == 'failed':
-                self.state = self.STATE_FAILED
-                self.save()
+            status = self.get_stripe_object(refresh=refresh).status
+        if self.state == self.STATE_SUCCESSFUL or status == 'succeeded':
+            amounts = list(self.transaction_amounts)
+        return status, amounts
+
+    def apply_stripe_status(self, status):
+        """Moves a :py:attr:`STATE_SENT` charge to
+        :py:attr:`STATE_SUCCESSFUL` or :py:attr:`STATE_FAILED` according to
+        its Stripe *status*.
+
+        The move is a conditional update, so a stale instance cannot undo
+        another process, e.g. the webhook handler, having moved the charge
+        on already; :py:attr:`state` is reloaded in that case.
+
+        :return: True if this call changed the state.
+        """
+        new_state = {
+            'succeeded': self.STATE_SUCCESSFUL,
+            'failed': self.STATE_FAILED,
+        }.get(status)
+        if self.state != self.STATE_SENT or new_state is None:
+            return False
+        # transaction has been sent, but is in purgatory
+        changed = Charge.objects.filter(
+            pk=self.pk, state=self.STATE_SENT).update(state=new_state)
+        if changed:
+            self.state = new_state
+        else:
+            self.state = Charge.objects.values_list(
+                'state', flat=True).get(pk=self.pk)
+        return bool(changed)
+
+    def apply_stripe_state(self, status, amounts):
+        """Moves the charge forward using data from
+        :py:meth:`fetch_stripe_state`, posting ledger entries once it is
+        successful."""
+        self.apply_stripe_status(status)
 
         if self.state == self.STATE_SUCCESSFUL:
-            # transaction was successful, update our ledger
-            for amts in self.transaction_amounts:
-                # Create ledger entry for full amount
-                le_gross = LedgerEntry.objects.create(
-                    debit_account=self.payment_method.revenue_account,
-                    credit_account=self.customer.member.account,
-                    amount=amts['amount'],
-                    details='%s txn %s' % (self.payment_method,
-                                           self.stripe_id),
-                )
-                self.transaction.add(le_gross)
-
-                # Create ledger entry for fee amount
-                le_fee = LedgerEntry.objects.create(
-                    debit_account=self.payment_method.fee_account,
-                    credit_account=self.payment_method.revenue_account,
-                    amount=amts['fee'],
-                    details='%s txn %s fees' % (self.payment_method,
-                                                self.stripe_id),
-                )
-                self.transaction.add(le_fee)
-
-            self.state = self.STATE_COMPLETED
-            self.save()
+            # transaction was successful, update our ledger; skipped there
+            # if someone else posted it in the meantime
+            Charge.objects.post_successful([(self, amounts)])
+
+    def state_update(self, refresh=True):
+        """Moves the charge forward based on its status at Stripe.
+
+        :param refresh:
+            Retrieve a fresh copy of the Stripe charge rather than using a
+            cached one.  Only pass False right after creating it.
+        """
+        self.apply_stripe_state(*self.fetch_stripe_state(refresh=refresh))
+
+
+class WebhookEventManager(models.Manager):
+    def record(self, payload):
+        """Stores a decoded Stripe event in the inbox, ignoring events that
+        have already been received.
+
+        :param payload: decoded JSON event, as sent by Stripe.
+        :return: (:py:class:`WebhookEvent`, created) tuple.
+        """
+        return self.get_or_create(
+            stripe_id=payload['id'],
+            defaults={'type': payload.get('type', ''),
+                      'payload': json.dumps(payload)})
+
+    def pending(self, max_attempts=None):
+        """Returns the events still to be processed, oldest first."""
+        qs = self.filter(processed_date__isnull=True)
+        if max_attempts is not None:
+            qs = qs.filter(attempts__lt=max_attempts)
+        return qs.order_by('pk')
+
+
+class WebhookEvent(models.Model):
+    """An event received from Stripe through the webhook endpoint.
+
+    Events are stored as soon as they arrive and applied later, in
+    batches, by :py:func:`payments_stripe.webhooks.process_events`.
+
+    :param stripe_id: Stripe event ID.  Unique, so redeliveries are ignored.
+    :param type: Stripe event type, e.g. ``charge.succeeded``.
+    :param payload: The complete event, as JSON.
+    :param received_date: When the event arrived.
+    :param processed_date:
+        When the event was applied, or None if it is still pending.
+    :param attempts: Number of times applying the event has been tried.
+    :param error: Error from the last failed attempt, if any.
+    """
+    stripe_id = models.CharField(max_length=200, unique=True)
+    type = models.CharField(max_length=200)
+    payload = models.TextField()
+    received_date = models.DateTimeField(auto_now_add=True)
+    processed_date = models.DateTimeField(blank=True, null=True,
+                                          db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    objects = WebhookEventManager()
+
+    def __str__(self):
+        return "%s %s" % (self.type, self.stripe_id)
+
+    def _get_data(self):
+        """The decoded :py:attr:`payload`."""
+        return json.loads(self.payload)
+    data = property(_get_data)
@@ -0,0 +1,187 @@
+"""Reconciliation of charges stuck in :py:attr:`Charge.STATE_SENT` or
+:py:attr:`Charge.STATE_SUCCESSFUL`.
+
+Stripe is queried from a bounded thread pool, backing off when it rate
+limits us, and the results are then applied to the database in batches,
+one transaction per batch.  When the pooled client of
+:py:mod:`payments_stripe.client` is installed, it does the retrying and
+the calls here are not retried again.
+"""
+from django.db import transaction
+
+from multiprocessing.pool import ThreadPool
+import stripe
+import time
+
+from . import client
+from .client import backoff_delay
+from .models import Charge
+
+#: Retries per charge when the Stripe client does not retry by itself.
+MAX_RETRIES = 5
+
+
+def is_retryable(exc):
+    """True if a Stripe error is worth retrying: rate limiting (HTTP 429),
+    server errors and connection failures."""
+    if isinstance(exc, stripe.error.APIConnectionError):
+        return True
+    status = getattr(exc, 'http_status', None)
+    return status == 429 or (status is not None and status >= 500)
+
+
+def call_with_backoff(func, max_retries=5, base_delay=0.5, max_delay=30.0):
+    """Calls *func*, retrying retryable Stripe errors with exponential
+    backoff and full jitter.
+
+    :param max_retries: attempts after the first before giving up.
+    :param base_delay: seconds to wait (at most) before the first retry.
+    :param max_delay: upper bound for any single wait.
+    """
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except stripe.error.StripeError as exc:
+            if attempt >= max_retries or not is_retryable(exc):
+                raise
+            time.sleep(backoff_delay(attempt, base_delay, max_delay))
+            attempt += 1
+
+
+def get_max_retries(max_retries=None):
+    """Retries per charge for :py:func:`call_with_backoff`.
+
+    :param max_retries: explicit number of retries.  None gives 0 if the
+        installed :py:class:`payments_stripe.client.PooledClient` retries
+        requests itself, so that they are not retried in two layers, and
+        :py:data:`MAX_RETRIES` otherwise.
+    """
+    if max_retries is not None:
+        return max_retries
+    if isinstance(client.client, client.PooledClient) and \
+            client.client.max_retries:
+        return 0
+    return MAX_RETRIES
+
+
+class ReconcileRun(object):
+    """Summary of a :py:func:`reconcile_charges` call.
+
+    :param checked: charges looked up at Stripe.
+    :param completed: charges whose ledger entries were posted.
+    :param failed: charges Stripe reported as failed.
+    :param pending: charges still pending at Stripe.
+    :param errors: list of (charge primary key, exception) that could not
+        be fetched or applied.
+    :param elapsed: wall-clock seconds the run took.
+    """
+    def __init__(self):
+        self.checked = 0
+        self.completed = 0
+        self.failed = 0
+        self.pending = 0
+        self.errors = []
+        self.elapsed = 0.0
+
+    def __str__(self):
+        return "Checked %d charge(s): %d completed, %d failed, %d pending, " \
+               "%d error(s) in %.2fs" % (self.checked, self.completed,
+                                         self.failed, self.pending,
+                                         len(self.errors), self.elapsed)
+
+
+def get_unreconciled_charges():
+    """Returns a :class:`django.db.models.query.QuerySet` of every charge
+    in :py:attr:`Charge.STATE_SENT` or :py:attr:`Charge.STATE_SUCCESSFUL`,
+    with the relations needed for posting joined in."""
+    qs = Charge.objects.filter(state__in=[Charge.STATE_SENT,
+                                          Charge.STATE_SUCCESSFUL])
+    return qs.select_related('payment_method',
+                             'payment_method__revenue_account',
+                             'payment_method__fee_account',
+                             'customer__member__account')
+
+
+def _fetch(args):
+    charge, max_retries = args
+    try:
+        return charge, call_with_backoff(charge.fetch_stripe_state,
+                                         max_retries=max_retries), None
+    except Exception as exc:
+        return charge, None, exc
+
+
+def apply_batch(results, run):
+    """Applies fetched (charge, (status, amounts), error) results in one
+    transaction, posting the ledger entries of every successful charge
+    together, and falls back to one transaction per charge if the batch
+    fails so that one bad charge cannot hold up the rest."""
+    def apply(charges):
+        postings = []
+        for charge, (status, amounts) in charges:
+            charge.apply_stripe_status(status)
+            if charge.state == Charge.STATE_SUCCESSFUL:
+                postings.append((charge, amounts))
+        Charge.objects.post_successful(postings)
+        for charge, state in charges:
+            if charge.state == Charge.STATE_COMPLETED:
+                run.completed += 1
+            elif charge.state == Charge.STATE_FAILED:
+                run.failed += 1
+            else:
+                run.pending += 1
+
+    ok = [(charge, state) for charge, state, exc in results if exc is None]
+    for charge, state, exc in results:
+        if exc is not None:
+            run.errors.append((charge.pk, exc))
+
+    counts = (run.completed, run.failed, run.pending)
+    try:
+        with transaction.atomic():
+            apply(ok)
+    except Exception:
+        run.completed, run.failed, run.pending = counts
+        for charge, state in ok:
+            # Start over from the database state
+            charge = Charge.objects.get(pk=charge.pk)
+            try:
+                with transaction.atomic():
+                    apply([(charge, state)])
+            except Exception as exc:
+                run.errors.append((charge.pk, exc))
+
+
+def reconcile_charges(workers=8, batch_size=100, max_retries=None):
+    """Brings every unreconciled charge up to date with Stripe.
+
+    :param workers: maximum number of concurrent Stripe requests.
+    :param batch_size: number of charges applied per transaction.
+    :param max_retries: retries per charge on rate limiting or errors; see
+        :py:func:`get_max_retries`.
+    :return: :py:class:`ReconcileRun` summary.
+    """
+    run = ReconcileRun()
+    start = time.time()
+    max_retries = get_max_retries(max_retries)
+
+    charges = list(get_unreconciled_charges().order_by('pk'))
+    pool = ThreadPool(workers)
+    try:
+        results = pool.imap_unordered(
+            _fetch, [(c, max_retries) for c in charges])
+        batch = []
+        for result in results:
+            run.checked += 1
+            batch.append(result)
+            if len(batch) >= batch_size:
+                apply_batch(batch, run)
+                batch = []
+        apply_batch(batch, run)
+    finally:
+        pool.close()
+        pool.join()
+
+    run.elapsed = time.time() - start
+    return run
@@ -1,3 +1,762 @@
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models.query import QuerySet
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from accounting.models import LedgerAccount, LedgerEntry, PaymentMethod
+from members.models import Member
+from payments_stripe import client, collect, reconcile, webhooks
+from payments_stripe.cache import stripe_cache
+from payments_stripe.fake import FakeStripe, FakeStripeServer
+from payments_stripe.models import Customer, Charge, WebhookEvent
 
-# Create your tests here.
+from datetime import timedelta
+from decimal import Decimal
+import hashlib
+import hmac
+import json
+import stripe
+import time
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+def fake_customer(default_source='card_1'):
+    cust = mock.Mock(default_source=default_source)
+    cust.sources.all.side_effect = [
+        mock.Mock(has_more=True, data=[mock.Mock(id='card_1')]),
+        mock.Mock(has_more=False, data=[mock.Mock(id='card_2')]),
+    ]
+    return cust
+
+
+class StripeCacheTestCase(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(
+            member=Member.objects.create(name="Member 1",
+                                         email="member1@example.com"),
+            stripe_id='cus_1',
+        )
+        stripe_cache.clear()
+        stripe_cache.reset_stats()
+        self.old_ttl = stripe_cache.ttl
+
+    def tearDown(self):
+        stripe_cache.ttl = self.old_ttl
+        stripe_cache.clear()
+
+    @mock.patch('stripe.Customer.retrieve')
+    def test_memo(self, retrieve):
+        retrieve.return_value = fake_customer()
+        self.assertEqual(len(self.customer.get_cards()), 2)
+        self.customer.get_default_card()
+        self.assertEqual(retrieve.call_count, 1)
+        self.assertEqual(stripe_cache.misses, 1)
+        self.assertEqual(stripe_cache.memo_hits, 2)
+
+    @mock.patch('stripe.Customer.retrieve')
+    def test_invalidate_after_mutation(self, retrieve):
+        retrieve.return_value = fake_customer()
+        self.customer.add_card('tok_1', default=False)
+        self.customer.get_default_card()
+        self.assertEqual(retrieve.call_count, 2)
+
+    @mock.patch('stripe.Customer.retrieve')
+    def test_shared_ttl_cache(self, retrieve):
+        retrieve.return_value = fake_customer()
+        stripe_cache.ttl = 60
+        self.customer.stripe_object
+        Customer.objects.get(pk=self.customer.pk).stripe_object
+        self.assertEqual(retrieve.call_count, 1)
+        self.assertEqual(stripe_cache.stats,
+                         {'memo_hits': 0, 'hits': 1, 'misses': 1})
+
+        self.customer.get_stripe_object(refresh=True)
+        self.assertEqual(retrieve.call_count, 2)
+
+        stripe_cache.ttl = 0
+        stripe_cache.clear()
+        Customer.objects.get(pk=self.customer.pk).stripe_object
+        self.assertEqual(retrieve.call_count, 3)
+
+
+class StripeFixturesTestCase(TestCase):
+    def setUp(self):
+        self.member_account = LedgerAccount.objects.create(
+            gnucash_account="Liability:Member Accounts",
+            account_type=LedgerAccount.TYPE_LIABILITY,
+        )
+        self.customer = Customer.objects.create(
+            member=Member.objects.create(name="Member 1",
+                                         email="member1@example.com",
+                                         account=self.member_account),
+            stripe_id='cus_1',
+        )
+        self.method = PaymentMethod.objects.create(
+            name="Credit card",
+            is_recurring=True,
+            is_automated=True,
+            api=PaymentMethod.API_STRIPEIO,
+            revenue_account=LedgerAccount.objects.create(
+                gnucash_account="Assets:Stripe",
+                account_type=LedgerAccount.TYPE_ASSET,
+            ),
+            fee_account=LedgerAccount.objects.create(
+                gnucash_account="Expenses:Bank Fees",
+                account_type=LedgerAccount.TYPE_EXPENSE,
+            ),
+        )
+
+    def make_charge(self, stripe_id, state=Charge.STATE_SENT,
+                    amount="50.00"):
+        return Charge.objects.create(customer=self.customer,
+                                     payment_method=self.method,
+                                     stripe_id=stripe_id, amount=amount,
+                                     state=state)
+
+
+class PostSuccessfulTestCase(StripeFixturesTestCase):
+    def amounts(self, charge):
+        return [{'amount': Decimal(charge.amount), 'fee': Decimal('1.75'),
+                 'net': Decimal(charge.amount) - Decimal('1.75')}]
+
+    def test_post_many(self):
+        charges = [self.make_charge('ch_%d' % i,
+                                    state=Charge.STATE_SUCCESSFUL)
+                   for i in range(10)]
+        done = self.make_charge('ch_done', state=Charge.STATE_COMPLETED)
+        postings = [(c, self.amounts(c)) for c in charges + [done]]
+
+        posted = Charge.objects.post_successful(postings)
+        self.assertEqual(posted, charges)
+        self.assertTrue(all(c.state == Charge.STATE_COMPLETED
+                            for c in charges))
+        self.assertEqual(Charge.objects.filter(
+            state=Charge.STATE_COMPLETED).count(), 11)
+        self.assertEqual(done.transaction.count(), 0)
+
+        charge = Charge.objects.get(stripe_id='ch_3')
+        self.assertEqual(
+            sorted(e.details for e in charge.transaction.all()),
+            ['Credit card (via Stripe) txn ch_3',
+             'Credit card (via Stripe) txn ch_3 fees'])
+        self.assertEqual(
+            LedgerAccount.objects.get(pk=self.member_account.pk)
+            .account_balance, Decimal('500.00'))
+        self.assertEqual(LedgerAccount.objects.verify_balances(), [])
+
+        # Posting again is a no-op
+        self.assertEqual(Charge.objects.post_successful(postings), [])
+        self.assertEqual(charge.transaction.count(), 2)
+
+    def test_query_count_independent_of_entries(self):
+        def count_queries(n):
+            charges = [self.make_charge('ch_%d_%d' % (n, i),
+                                        state=Charge.STATE_SUCCESSFUL)
+                       for i in range(n)]
+            with CaptureQueriesContext(connection) as ctx:
+                Charge.objects.post_successful(
+                    [(c, self.amounts(c)) for c in charges])
+            # Entry inserts are one per row on backends without bulk ids
+            return len(ctx) - 2 * n
+
+        self.assertEqual(count_queries(2), count_queries(8))
+
+
+def rate_limited():
+    return stripe.error.APIError("Too many requests", http_status=429)
+
+
+class ReconcileTestCase(StripeFixturesTestCase):
+    def fake_fetch(self, statuses):
+        def fetch(charge, refresh=True):
+            status = statuses[charge.stripe_id]
+            if isinstance(status, list):
+                status = status.pop(0)
+            if isinstance(status, Exception):
+                raise status
+            amounts = None
+            if status == 'succeeded' or \
+                    charge.state == Charge.STATE_SUCCESSFUL:
+                amounts = [{'amount': charge.amount,
+                            'fee': Decimal('1.75'),
+                            'net': charge.amount - Decimal('1.75')}]
+            return status, amounts
+        return fetch
+
+    @mock.patch('random.uniform', return_value=0)
+    def test_reconcile(self, uniform):
+        self.make_charge('ch_ok')
+        self.make_charge('ch_retry')
+        self.make_charge('ch_failed')
+        self.make_charge('ch_pending')
+        self.make_charge('ch_posted', state=Charge.STATE_SUCCESSFUL)
+        self.make_charge('ch_broken')
+        self.make_charge('ch_done', state=Charge.STATE_COMPLETED)
+        statuses = {
+            'ch_ok': 'succeeded',
+            'ch_retry': [rate_limited(), rate_limited(), 'succeeded'],
+            'ch_failed': 'failed',
+            'ch_pending': 'pending',
+            'ch_posted': None,
+            'ch_broken': stripe.error.InvalidRequestError("No such", None),
+        }
+        with mock.patch.object(Charge, 'fetch_stripe_state',
+                               self.fake_fetch(statuses)):
+            run = reconcile.reconcile_charges(workers=3, batch_size=2,
+                                              max_retries=5)
+
+        self.assertEqual(run.checked, 6)
+        self.assertEqual(run.completed, 3)
+        self.assertEqual(run.failed, 1)
+        self.assertEqual(run.pending, 1)
+        self.assertEqual(len(run.errors), 1)
+        self.assertEqual(uniform.call_count, 2)
+        states = dict(Charge.objects.values_list('stripe_id', 'state'))
+        self.assertEqual(states['ch_retry'], Charge.STATE_COMPLETED)
+        self.assertEqual(states['ch_posted'], Charge.STATE_COMPLETED)
+        self.assertEqual(states['ch_broken'], Charge.STATE_SENT)
+        self.assertEqual(
+            LedgerAccount.objects.get(pk=self.member_account.pk)
+            .account_balance, Decimal('150.00'))
+
+    def test_webhook_then_reconcile(self):
+        # The reconciler read the charge before the webhook handler posted it
+        stale = self.make_charge('ch_ok')
+        webhooks.apply_event(charge_event('evt_1', 'charge.succeeded',
+                                          'ch_ok'))
+        self.assertEqual(Charge.objects.get().state, Charge.STATE_COMPLETED)
+
+        run = reconcile.ReconcileRun()
+        amounts = [{'amount': Decimal('50.00'), 'fee': Decimal('1.75'),
+                    'net': Decimal('48.25')}]
+        reconcile.apply_batch([(stale, ('succeeded', amounts), None)], run)
+        self.assertEqual(stale.state, Charge.STATE_COMPLETED)
+        self.assertEqual(run.completed, 1)
+        self.assertEqual(Charge.objects.get().state, Charge.STATE_COMPLETED)
+        self.assertEqual(stale.transaction.count(), 2)
+        self.assertEqual(
+            LedgerAccount.objects.get(pk=self.member_account.pk)
+            .account_balance, Decimal('50.00'))
+
+    @mock.patch('random.uniform', return_value=0)
+    def test_backoff_gives_up(self, uniform):
+        func = mock.Mock(side_effect=rate_limited())
+        with self.assertRaises(stripe.error.APIError):
+            reconcile.call_with_backoff(func, max_retries=3)
+        self.assertEqual(func.call_count, 4)
+
+    def test_single_retry_layer(self):
+        # The installed pooled client retries, so the reconciler does not
+        self.assertIsInstance(client.client, client.PooledClient)
+        self.assertEqual(reconcile.get_max_retries(), 0)
+        self.assertEqual(reconcile.get_max_retries(2), 2)
+        with mock.patch.object(client, 'client',
+                               client.PooledClient(max_retries=0)):
+            self.assertEqual(reconcile.get_max_retries(),
+                             reconcile.MAX_RETRIES)
+        with mock.patch.object(client, 'client', None):
+            self.assertEqual(reconcile.get_max_retries(),
+                             reconcile.MAX_RETRIES)
+
+        self.make_charge('ch_limited')
+        fetch = mock.Mock(side_effect=rate_limited())
+        with mock.patch.object(Charge, 'fetch_stripe_state', fetch):
+            run = reconcile.reconcile_charges()
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(len(run.errors), 1)
+
+    def test_backoff_does_not_retry_client_errors(self):
+        func = mock.Mock(side_effect=stripe.error.CardError("no", None, None,
+                                                            http_status=402))
+        with self.assertRaises(stripe.error.CardError):
+            reconcile.call_with_backoff(func)
+        self.assertEqual(func.call_count, 1)
+
+
+@mock.patch('random.uniform', return_value=0)
+class PooledClientTestCase(TestCase):
+    def setUp(self):
+        self.client_ = client.PooledClient(max_retries=2)
+        self.send = mock.patch.object(self.client_, '_send').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_retries_rate_limits(self, uniform):
+        self.send.side_effect = [(b'', 429), (b'', 503), (b'{}', 200)]
+        self.assertEqual(self.client_.request('get', 'https://x', {}),
+                         (b'{}', 200))
+        self.assertEqual(self.send.call_count, 3)
+        self.assertEqual(self.client_.retries, 2)
+
+    def test_gives_up(self, uniform):
+        self.send.return_value = (b'', 429)
+        self.assertEqual(self.client_.request('get', 'https://x', {}),
+                         (b'', 429))
+        self.assertEqual(self.send.call_count, 3)
+
+    def test_unsafe_post_not_retried(self, uniform):
+        self.send.side_effect = [(b'', 500), (b'{}', 200)]
+        self.assertEqual(self.client_.request('post', 'https://x', {}),
+                         (b'', 500))
+        self.send.side_effect = ValueError("reset")
+        with self.assertRaises(stripe.error.APIConnectionError):
+            self.client_.request('post', 'https://x', {})
+
+        self.send.reset_mock()
+        self.send.side_effect = [ValueError("reset"), (b'{}', 200)]
+        self.assertEqual(self.client_.request(
+            'post', 'https://x', {'Idempotency-Key': 'k'}), (b'{}', 200))
+        self.assertEqual(self.send.call_count, 2)
+
+    @mock.patch('time.time', return_value=100.0)
+    @mock.patch('time.sleep')
+    def test_rate_limit(self, sleep, now, uniform):
+        limiter = client.RateLimiter(4)
+        for i in range(3):
+            limiter.wait()
+        self.assertEqual([c[0][0] for c in sleep.call_args_list],
+                         [0.25, 0.5])
+        client.RateLimiter(None).wait()
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_installed(self, uniform):
+        self.assertIs(stripe.http_client.new_default_http_client(),
+                      client.client)
+        self.assertIsInstance(client.client, client.PooledClient)
+
+
+class CreateChargeTestCase(StripeFixturesTestCase):
+    @mock.patch('stripe.Charge.create')
+    def test_idempotency_key(self, create):
+        create.return_value = mock.Mock(id='ch_1', status='failed')
+        charge = Charge.objects.create_charge(
+            self.customer, Decimal('50.00'), self.method, "Dues",
+            idempotency_key='dues-1')
+        self.assertEqual(create.call_args[1]['idempotency_key'], 'dues-1')
+        self.assertEqual(charge.state, Charge.STATE_FAILED)
+
+        Charge.objects.create_charge(self.customer, Decimal('50.00'),
+                                     self.method, "Dues")
+        self.assertTrue(create.call_args[1]['idempotency_key'])
+
+
+class CollectBalancesTestCase(StripeFixturesTestCase):
+    def setUp(self):
+        super(CollectBalancesTestCase, self).setUp()
+        self.dues = LedgerAccount.objects.create(
+            gnucash_account="Income:Dues",
+            account_type=LedgerAccount.TYPE_INCOME,
+        )
+        self.customers = {}
+        for name, owed in (('ok', '50.00'), ('declined', '20.00'),
+                           ('down', '30.00'), ('credit', '-10.00'),
+                           ('busy', '40.00')):
+            account = LedgerAccount.objects.create(
+                gnucash_account="Liability:Member Accounts:%s" % name,
+                account_type=LedgerAccount.TYPE_LIABILITY,
+            )
+            LedgerEntry.objects.create(debit_account=account,
+                                       credit_account=self.dues,
+                                       amount=owed)
+            self.customers[name] = Customer.objects.create(
+                member=Member.objects.create(name=name, account=account,
+                                             email="%s@example.com" % name),
+                stripe_id='cus_%s' % name)
+        Charge.objects.create(customer=self.customers['busy'],
+                              payment_method=self.method, stripe_id='ch_busy',
+                              amount='40.00', state=Charge.STATE_SENT)
+        #: Charges found at Stripe by customer ID
+        self.stripe_charges = {}
+
+    def fake_create(self, fail):
+        def create(customer, idempotency_key, **kwargs):
+            name = customer[4:]
+            if name in fail:
+                raise fail[name]
+            return stripe.Charge.construct_from(
+                {'id': 'ch_' + name, 'status': 'succeeded'}, 'sk')
+        return create
+
+    def fake_balance_transactions(self, source, starting_after=None):
+        # Called from the worker threads, so no database access
+        amount = {'ch_ok': 5000, 'ch_down': 3000, 'ch_declined': 2000}[source]
+        txn = stripe.BalanceTransaction.construct_from(
+            {'id': 'txn_1', 'amount': amount, 'fee': 100,
+             'net': amount - 100}, 'sk')
+        return mock.Mock(has_more=False, data=[txn])
+
+    def fake_list(self, customer, created, starting_after=None):
+        return mock.Mock(has_more=False,
+                         data=self.stripe_charges.get(customer, []))
+
+    def collect(self, fail):
+        with mock.patch('stripe.Charge.create',
+                        side_effect=self.fake_create(fail)) as create, \
+                mock.patch('stripe.Charge.all',
+                           side_effect=self.fake_list), \
+                mock.patch('stripe.BalanceTransaction.all',
+                           side_effect=self.fake_balance_transactions):
+            run = collect.collect_balances(workers=2, batch_size=1,
+                                           max_retries=0)
+        return run, create
+
+    def balance(self, name):
+        return Member.objects.get(name=name).balance
+
+    def test_collect(self):
+        declined = stripe.error.CardError(
+            "Your card was declined.", None, 'card_declined',
+            http_status=402, json_body={'error': {'charge': 'ch_declined'}})
+        down = stripe.error.APIConnectionError("Connection reset")
+        run, create = self.collect({'declined': declined, 'down': down})
+
+        self.assertEqual(create.call_count, 3)
+        self.assertEqual((run.submitted, run.completed, run.declined),
+                         (1, 1, 1))
+        self.assertEqual(len(run.errors), 1)
+        self.assertEqual(self.balance('ok'), Decimal('0.00'))
+        self.assertEqual(self.balance('busy'), Decimal('-40.00'))
+        states = dict(Charge.objects.values_list('customer__member__name',
+                                                 'state'))
+        self.assertEqual(states['declined'], Charge.STATE_FAILED)
+        self.assertEqual(states['down'], Charge.STATE_INIT)
+        self.assertNotIn('credit', states)
+        down_key = [c[1]['idempotency_key'] for c in create.call_args_list
+                    if c[1]['customer'] == 'cus_down']
+
+        # Resuming submits the interrupted charge again under the same key
+        run, create = self.collect({'declined': declined})
+        keys = dict((c[1]['customer'], c[1]['idempotency_key'])
+                    for c in create.call_args_list)
+        self.assertEqual(keys['cus_down'], down_key[0])
+        self.assertNotIn('cus_ok', keys)
+        self.assertEqual(self.balance('down'), Decimal('0.00'))
+        self.assertEqual(Charge.objects.filter(
+            customer=self.customers['down']).count(), 1)
+        self.assertEqual(LedgerAccount.objects.verify_balances(), [])
+
+    def test_overlapping_runs(self):
+        select_for_update = QuerySet.select_for_update
+        locked = []
+
+        def lock(qs, *args, **kwargs):
+            locked.append(qs.model)
+            return select_for_update(qs, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, 'select_for_update', autospec=True,
+                               side_effect=lock):
+            first = collect.prepare_charges(self.method,
+                                            collect.CollectionRun())
+        self.assertIn(Customer, locked)
+        # A second run before the first submitted anything gets the same
+        # charges, to submit under the same idempotency keys
+        second = collect.prepare_charges(self.method, collect.CollectionRun())
+        self.assertEqual(second, first)
+        self.assertEqual(
+            sorted(c.customer.member.name for c in second),
+            ['declined', 'down', 'ok'])
+
+    def leftover(self, name, amount, age=0):
+        charge = Charge.objects.create(
+            customer=self.customers[name], payment_method=self.method,
+            amount=amount, state=Charge.STATE_INIT)
+        Charge.objects.filter(pk=charge.pk).update(
+            created_date=timezone.now() - timedelta(seconds=age))
+        return charge
+
+    def test_leftover_out_of_date(self):
+        # ok has paid since, down owes more than the leftover is for
+        paid = self.leftover('ok', '50.00')
+        LedgerEntry.objects.create(
+            debit_account=self.method.revenue_account,
+            credit_account=self.customers['ok'].member.account,
+            amount='50.00')
+        stale = self.leftover('down', '10.00')
+        run, create = self.collect({})
+
+        keys = dict((c[1]['customer'], (c[1]['idempotency_key'],
+                                        c[1]['amount']))
+                    for c in create.call_args_list)
+        self.assertNotIn('cus_ok', keys)
+        self.assertEqual(Charge.objects.get(pk=paid.pk).state,
+                         Charge.STATE_FAILED)
+        self.assertNotEqual(keys['cus_down'][0],
+                            collect.idempotency_key(stale))
+        self.assertEqual(keys['cus_down'][1], 3000)
+        self.assertEqual(self.balance('ok'), Decimal('0.00'))
+        self.assertEqual(self.balance('down'), Decimal('0.00'))
+
+    def test_leftover_outside_idempotency_window(self):
+        age = collect.STRIPE_IDEMPOTENCY_WINDOW + 60
+        found = self.leftover('ok', '50.00', age)
+        missing = self.leftover('down', '30.00', age)
+        self.stripe_charges['cus_ok'] = [stripe.Charge.construct_from(
+            {'id': 'ch_other', 'metadata': {}}, 'sk'),
+            stripe.Charge.construct_from(
+            {'id': 'ch_found', 'metadata': {'mms_charge': str(found.pk)}},
+            'sk')]
+        run, create = self.collect({})
+
+        customers = [c[1]['customer'] for c in create.call_args_list]
+        self.assertNotIn('cus_ok', customers)
+        found = Charge.objects.get(pk=found.pk)
+        self.assertEqual((found.stripe_id, found.state),
+                         ('ch_found', Charge.STATE_SENT))
+        self.assertEqual(run.pending, 1)
+        # Never reached Stripe, so it is charged afresh under a new key
+        self.assertIn('cus_down', customers)
+        self.assertEqual(Charge.objects.get(pk=missing.pk).state,
+                         Charge.STATE_FAILED)
+        self.assertEqual(self.balance('down'), Decimal('0.00'))
+
+    def test_leftover_lookup_fails(self):
+        old = self.leftover('ok', '50.00',
+                            collect.STRIPE_IDEMPOTENCY_WINDOW + 60)
+        with mock.patch.object(collect, 'find_submitted',
+                               side_effect=rate_limited()):
+            run, create = self.collect({})
+        self.assertEqual(run.errors[0][0], old.pk)
+        self.assertNotIn('cus_ok', [c[1]['customer']
+                                    for c in create.call_args_list])
+        self.assertEqual(Charge.objects.get(pk=old.pk).state,
+                         Charge.STATE_INIT)
+
+
+class FakeStripeTestCase(StripeFixturesTestCase):
+    """Runs the models against :py:class:`FakeStripeServer`."""
+    def setUp(self):
+        super(FakeStripeTestCase, self).setUp()
+        self.fake = FakeStripe(page_size=2)
+        self.server = FakeStripeServer(self.fake)
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        old_client = client.client
+        client.install(client.PooledClient(rate_limit=None, base_delay=0))
+        self.addCleanup(client.install, old_client)
+        stripe_cache.clear()
+        self.customer = Customer.objects.create_customer(
+            Member.objects.create(
+                name="Member 2", email="m2@example.com",
+                account=LedgerAccount.objects.create(
+                    gnucash_account="Liability:Member Accounts:2",
+                    account_type=LedgerAccount.TYPE_LIABILITY)))
+
+    def test_cards(self):
+        self.customer.add_card('tok_visa')
+        for i in range(3):
+            self.customer.add_card('tok_visa', default=False)
+        cards = self.customer.cards
+        self.assertEqual(len(cards), 4)
+        self.assertEqual(self.customer.default_card.id, cards[0].id)
+
+        self.customer.delete_card(cards[0].id)
+        self.assertEqual(len(self.customer.cards), 3)
+        self.assertEqual(self.customer.default_card.id, cards[1].id)
+
+    def test_charges(self):
+        self.customer.add_card('tok_visa')
+        charge = Charge.objects.create_charge(self.customer, Decimal('50.00'),
+                                              self.method, "Dues")
+        self.assertEqual(charge.state, Charge.STATE_COMPLETED)
+        self.assertEqual(sorted(e.amount for e in charge.transaction.all()),
+                         [Decimal('1.75'), Decimal('50.00')])
+        self.assertEqual(Member.objects.get(name="Member 2").balance,
+                         Decimal('50.00'))
+
+        self.customer.add_card('tok_chargeDeclined')
+        with self.assertRaises(stripe.error.CardError):
+            Charge.objects.create_charge(self.customer, Decimal('50.00'),
+                                         self.method, "Dues")
+
+    def test_list_charges(self):
+        self.customer.add_card('tok_visa')
+        other = stripe.Customer.create(source='tok_visa')
+        charges = [Charge.objects.create(customer=self.customer,
+                                         payment_method=self.method,
+                                         amount='10.00',
+                                         state=Charge.STATE_INIT)
+                   for i in range(5)]
+        for charge in charges[:4]:
+            stripe.Charge.create(amount=1000, currency='usd',
+                                 customer=self.customer.stripe_id,
+                                 metadata={'mms_charge': charge.pk})
+        stripe.Charge.create(amount=1000, currency='usd', customer=other.id)
+        # The first one was created before the charge it is for
+        first = min(self.fake.charges)
+        self.fake.charges[first]['created'] -= 3600
+
+        listed = stripe.Charge.all(customer=self.customer.stripe_id,
+                                   created={'gte': int(time.time()) - 600},
+                                   limit=10)
+        self.assertEqual([c.metadata['mms_charge'] for c in listed.data],
+                         [str(c.pk) for c in reversed(charges[1:4])])
+
+        # Looked up across pages of two
+        found = collect.find_submitted(charges[1])
+        self.assertEqual(found.metadata['mms_charge'], str(charges[1].pk))
+        self.assertIsNone(collect.find_submitted(charges[0]))
+        self.assertIsNone(collect.find_submitted(charges[4]))
+
+    @mock.patch('random.uniform', return_value=0)
+    def test_faults(self, uniform):
+        self.customer.add_card('tok_pending')
+        self.fake.fail_next(2, status=429)
+        charge = Charge.objects.create_charge(self.customer, Decimal('20.00'),
+                                              self.method, "Dues")
+        self.assertEqual(charge.state, Charge.STATE_SENT)
+        self.assertEqual([s for m, p, s in self.fake.log[-3:]],
+                         [429, 429, 200])
+
+        # Retried under the same idempotency key
+        self.fake.fail_next(1, status=503)
+        Charge.objects.create_charge(self.customer, Decimal('20.00'),
+                                     self.method, "Dues")
+        self.assertEqual([s for m, p, s in self.fake.log[-2:]],
+                         [503, 200])
+        self.assertEqual(len(self.fake.charges), 2)
+
+        self.fake.settle()
+        run = reconcile.reconcile_charges(workers=2)
+        self.assertEqual(run.completed, 2)
+        self.assertEqual(Member.objects.get(name="Member 2").balance,
+                         Decimal('40.00'))
+
+
+def sign(body, secret='whsec_test', timestamp=None):
+    timestamp = str(int(timestamp or time.time()))
+    sig = hmac.new(secret.encode('utf-8'),
+                   timestamp.encode('utf-8') + b'.' + body,
+                   hashlib.sha256).hexdigest()
+    return 't=%s,v1=%s' % (timestamp, sig)
+
+
+def charge_event(event_id, kind, charge_id, amount=5000, fee=175):
+    return {
+        'id': event_id,
+        'type': kind,
+        'data': {'object': {
+            'id': charge_id,
+            'object': 'charge',
+            'balance_transaction': {'object': 'balance_transaction',
+                                    'amount': amount, 'fee': fee,
+                                    'net': amount - fee},
+        }},
+    }
+
+
+@mock.patch.object(webhooks, 'STRIPE_WEBHOOK_SECRET', 'whsec_test')
+class WebhookTestCase(StripeFixturesTestCase):
+    def post(self, payload, signature=None):
+        body = json.dumps(payload).encode('utf-8')
+        if signature is None:
+            signature = sign(body)
+        return self.client.post(reverse('stripe-webhook'), body,
+                                content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE=signature)
+
+    def test_signature(self):
+        body = b'{}'
+        webhooks.verify_signature(body, sign(body))
+        for header in (None, 'garbage', sign(body, secret='whsec_other'),
+                       sign(body, timestamp=time.time() - 3600),
+                       u't=%d,v1=\u00e9' % time.time()):
+            with self.assertRaises(webhooks.SignatureError):
+                webhooks.verify_signature(body, header)
+
+        event = charge_event('evt_1', 'charge.succeeded', 'ch_1')
+        self.assertEqual(self.post(event, signature='t=1,v1=x').status_code,
+                         400)
+        self.assertEqual(self.post(
+            event, signature=u't=%d,v1=\u00e9' % time.time()).status_code,
+            400)
+        self.assertEqual(WebhookEvent.objects.count(), 0)
+
+    def test_inbox_dedup(self):
+        event = charge_event('evt_1', 'charge.succeeded', 'ch_1')
+        self.assertEqual(self.post(event).status_code, 200)
+        self.assertEqual(self.post(event).status_code, 200)
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+        self.assertEqual(WebhookEvent.objects.pending().count(), 1)
+
+    def test_process_events(self):
+        self.make_charge('ch_ok')
+        self.make_charge('ch_bad')
+        self.post(charge_event('evt_1', 'charge.succeeded', 'ch_ok'))
+        self.post(charge_event('evt_2', 'charge.failed', 'ch_bad'))
+        self.post(charge_event('evt_3', 'customer.created', 'cus_1'))
+        # Stripe may deliver the same change twice under different ids
+        self.post(charge_event('evt_4', 'charge.succeeded', 'ch_ok'))
+
+        self.assertEqual(webhooks.process_events(batch_size=2), (2, 0))
+        self.assertEqual(webhooks.process_events(batch_size=10), (2, 0))
+        self.assertEqual(webhooks.process_events(), (0, 0))
+
+        states = dict(Charge.objects.values_list('stripe_id', 'state'))
+        self.assertEqual(states['ch_ok'], Charge.STATE_COMPLETED)
+        self.assertEqual(states['ch_bad'], Charge.STATE_FAILED)
+        charge = Charge.objects.get(stripe_id='ch_ok')
+        self.assertEqual(charge.transaction.count(), 2)
+        self.assertEqual(
+            LedgerAccount.objects.get(pk=self.member_account.pk)
+            .account_balance, Decimal('50.00'))
+
+    def test_failed_event_is_retried(self):
+        self.make_charge('ch_ok')
+        self.post(charge_event('evt_1', 'charge.succeeded', 'ch_ok'))
+        with mock.patch.object(webhooks, 'apply_event',
+                               side_effect=ValueError("boom")):
+            self.assertEqual(webhooks.process_events(), (0, 1))
+        event = WebhookEvent.objects.get()
+        self.assertEqual(event.attempts, 1)
+        self.assertIn("boom", event.error)
+        self.assertEqual(webhooks.process_events(), (1, 0))
+        self.assertEqual(Charge.objects.get().state, Charge.STATE_COMPLETED)
+
+    def test_reconciler_during_event(self):
+        self.make_charge('ch_ok')
+        amounts = {'amount': Decimal('50.00'), 'fee': Decimal('1.75'),
+                   'net': Decimal('48.25')}
+
+        def transaction_amounts(charge):
+            # The reconciler finishes the charge while the handler looks up
+            # the balance transaction
+            reconcile.apply_batch([(Charge.objects.get(pk=charge.pk),
+                                    ('succeeded', [amounts]), None)],
+                                  reconcile.ReconcileRun())
+            return iter([amounts])
+
+        event = charge_event('evt_1', 'charge.succeeded', 'ch_ok')
+        event['data']['object']['balance_transaction'] = 'txn_1'
+        with mock.patch.object(Charge, 'transaction_amounts',
+                               property(transaction_amounts)):
+            webhooks.apply_event(event)
+        charge = Charge.objects.get()
+        self.assertEqual(charge.state, Charge.STATE_COMPLETED)
+        self.assertEqual(charge.transaction.count(), 2)
+        self.assertEqual(
+            LedgerAccount.objects.get(pk=self.member_account.pk)
+            .account_balance, Decimal('50.00'))
+
+    def test_event_before_charge_is_recorded(self):
+        self.post(charge_event('evt_1', 'charge.succeeded', 'ch_early'))
+        self.post(charge_event('evt_2', 'charge.failed', 'ch_late'))
+        self.assertEqual(webhooks.process_events(), (0, 2))
+        self.assertIn("ChargeNotReady", WebhookEvent.objects.get(
+            stripe_id='evt_1').error)
+
+        # Recorded, but not yet marked as submitted
+        charge = self.make_charge('ch_early', state=Charge.STATE_INIT)
+        self.assertEqual(webhooks.process_events(), (0, 2))
+
+        charge.state = Charge.STATE_SENT
+        charge.save()
+        self.make_charge('ch_late')
+        self.assertEqual(webhooks.process_events(), (2, 0))
+        states = dict(Charge.objects.values_list('stripe_id', 'state'))
+        self.assertEqual(states, {'ch_early': Charge.STATE_COMPLETED,
+                                  'ch_late': Charge.STATE_FAILED})
+        self.assertEqual(WebhookEvent.objects.pending().count(), 0)
@@ -1,3 +1,33 @@
-from django.shortcuts import render
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
-# Create your views here.
+import json
+
+from .models import WebhookEvent
+from .webhooks import verify_signature, SignatureError
+
+
+@csrf_exempt
+@require_POST
+def webhook(request):
+    """Receives Stripe webhook events.
+
+    Events are only verified and stored here; they are applied later by
+    the ``process_webhooks`` management command, so Stripe gets its
+    response quickly and redeliveries are harmless.
+    """
+    try:
+        verify_signature(request.body,
+                         request.META.get('HTTP_STRIPE_SIGNATURE'))
+    except SignatureError as exc:
+        return HttpResponseBadRequest(str(exc))
+
+    try:
+        payload = json.loads(request.body.decode('utf-8'))
+        payload['id']
+    except (ValueError, KeyError, TypeError):
+        return HttpResponseBadRequest("Invalid event")
+
+    WebhookEvent.objects.record(payload)
+    return HttpResponse(status=200)
@@ -0,0 +1,181 @@
+"""Stripe webhook handling: signature verification and batch application
+of the events stored in :py:class:`WebhookEvent`.
+
+Settings:
+
+``STRIPE_WEBHOOK_SECRET``
+    Signing secret of the webhook endpoint (``whsec_...``).
+``STRIPE_WEBHOOK_TOLERANCE``
+    Maximum age in seconds of a signature timestamp.  Defaults to 300.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+import hashlib
+import hmac
+import time
+
+from .models import Charge, WebhookEvent
+
+STRIPE_WEBHOOK_SECRET = getattr(settings, "STRIPE_WEBHOOK_SECRET", None)
+STRIPE_WEBHOOK_TOLERANCE = getattr(settings, "STRIPE_WEBHOOK_TOLERANCE", 300)
+
+
+class SignatureError(Exception):
+    pass
+
+
+class ChargeNotReady(Exception):
+    """Raised for an event about a charge that has not been recorded as
+    submitted yet, so that the event stays pending and is retried."""
+    pass
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def verify_signature(payload, header, secret=None,
+                     tolerance=STRIPE_WEBHOOK_TOLERANCE, now=None):
+    """Checks a ``Stripe-Signature`` header against the raw request body.
+
+    :param payload: raw request body, as bytes.
+    :param header: value of the ``Stripe-Signature`` header.
+    :param secret: endpoint signing secret; defaults to the setting.
+    :raises SignatureError: if the signature is missing, wrong or too old.
+    """
+    if secret is None:
+        secret = STRIPE_WEBHOOK_SECRET
+    if not secret:
+        raise SignatureError("STRIPE_WEBHOOK_SECRET is not configured")
+
+    timestamp = None
+    signatures = []
+    for item in (header or '').split(','):
+        key, _, value = item.strip().partition('=')
+        if key == 't':
+            timestamp = value
+        elif key == 'v1':
+            signatures.append(value)
+    if timestamp is None or not signatures:
+        raise SignatureError("Malformed signature header")
+
+    try:
+        age = (now or time.time()) - int(timestamp)
+    except ValueError:
+        raise SignatureError("Malformed signature timestamp")
+    if tolerance and abs(age) > tolerance:
+        raise SignatureError("Signature timestamp outside tolerance")
+
+    signed = timestamp.encode('utf-8') + b'.' + payload
+    expected = hmac.new(secret.encode('utf-8'), signed,
+                        hashlib.sha256).hexdigest().encode('ascii')
+    # Compared as bytes: compare_digest rejects non-ASCII text
+    if not any(hmac.compare_digest(expected, _to_bytes(s))
+               for s in signatures):
+        raise SignatureError("Signature mismatch")
+
+
+def _charge_for(stripe_id):
+    # Lock the row until the event is applied, so that the reconciler can't
+    # move the charge on in between; by primary key, since FOR UPDATE can't
+    # cover the outer joins of select_related
+    pk = (Charge.objects.select_for_update().filter(stripe_id=stripe_id)
+          .values_list('pk', flat=True).first())
+    if pk is None:
+        return None
+    qs = Charge.objects.select_related(
+        'payment_method', 'payment_method__revenue_account',
+        'payment_method__fee_account', 'customer__member__account')
+    return qs.get(pk=pk)
+
+
+def _submitted_charge(stripe_id):
+    """The :py:class:`Charge` with *stripe_id*, which must have been
+    submitted already.
+
+    Stripe often sends ``charge.*`` events before the process that created
+    the charge has committed its ``stripe_id`` or moved it out of
+    :py:attr:`Charge.STATE_INIT`.
+
+    :raises ChargeNotReady: if there is no such submitted charge yet.
+    """
+    charge = _charge_for(stripe_id)
+    if charge is None or charge.state == Charge.STATE_INIT:
+        raise ChargeNotReady("Charge %s not recorded as submitted yet" %
+                             stripe_id)
+    return charge
+
+
+def apply_event(data):
+    """Applies one decoded Stripe event to :py:class:`Charge` and the
+    ledger.  Applying the same event again is a no-op, since charges only
+    move forward through their states.
+
+    Handles ``charge.succeeded``, ``charge.failed`` and events carrying a
+    ``balance_transaction`` object.  Other events are ignored.
+
+    Runs in a transaction holding the charge's row lock.
+
+    :raises ChargeNotReady: for a ``charge.*`` event that arrived before
+        its charge was recorded; :py:func:`process_events` retries it.
+    """
+    obj = data.get('data', {}).get('object', {})
+    kind = data.get('type')
+
+    with transaction.atomic():
+        if kind == 'charge.failed':
+            charge = _submitted_charge(obj.get('id'))
+            charge.apply_stripe_state('failed', None)
+
+        elif kind == 'charge.succeeded':
+            charge = _submitted_charge(obj.get('id'))
+            if charge.state not in (Charge.STATE_SENT,
+                                    Charge.STATE_SUCCESSFUL):
+                return
+            bt = obj.get('balance_transaction')
+            if isinstance(bt, dict):
+                amounts = [Charge.balance_transaction_amounts(bt)]
+            else:
+                # Not expanded in the payload; one lookup instead of polling
+                amounts = list(charge.transaction_amounts)
+            charge.apply_stripe_state('succeeded', amounts)
+
+        elif obj.get('object') == 'balance_transaction':
+            charge = _charge_for(obj.get('source'))
+            if (charge is not None and
+                    charge.state == Charge.STATE_SUCCESSFUL):
+                charge.apply_stripe_state(
+                    None, [Charge.balance_transaction_amounts(obj)])
+
+
+def process_events(batch_size=100, max_attempts=5):
+    """Applies up to *batch_size* pending :py:class:`WebhookEvent` rows,
+    oldest first, each in its own savepoint so that a failing event is
+    recorded and retried later without holding up the others.
+
+    :param max_attempts: events that failed this many times, e.g. about a
+        charge that never got recorded, are skipped.
+    :return: (processed, failed) counts.
+    """
+    processed = failed = 0
+    with transaction.atomic():
+        events = list(WebhookEvent.objects.pending(max_attempts)
+                      .select_for_update()[:batch_size])
+        for event in events:
+            event.attempts += 1
+            try:
+                with transaction.atomic():
+                    apply_event(event.data)
+            except Exception as exc:
+                event.error = "%s: %s" % (type(exc).__name__, exc)
+                failed += 1
+            else:
+                event.processed_date = timezone.now()
+                event.error = ''
+                processed += 1
+            event.save(update_fields=['attempts', 'processed_date', 'error'])
+    return processed, failed